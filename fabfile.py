@@ -7,6 +7,7 @@ __author__ = 'Engine'
 
 import os
 import re
+import zlib
 from datetime import datetime
 
 # fabric使用ssh直接登录服务器并执行部署命令
@@ -26,12 +27,49 @@ db_password = "www-data"
 
 # 打包任务
 
+# 预压缩静态文件
+# 为static/下可压缩的文件生成同名的.gz文件(安装了brotli模块时还生成.br文件),
+# 服务器直接返回压缩好的文件,见www/coroweb.py的StaticHandler
+# 扩展名需与www/compress.py的COMPRESSIBLE_TYPES对应
+_PRECOMPRESS_EXTS = (".css", ".js", ".html", ".svg", ".json", ".txt", ".ttf", ".otf", ".eot")
+
+def _gzip(data):
+    # wbits=31输出gzip格式,mtime为0,内容不变时压缩文件也不变
+    c = zlib.compressobj(9, zlib.DEFLATED, 31)
+    return c.compress(data) + c.flush()
+
+def _precompress(static_dir):
+    try:
+        import brotli
+    except ImportError:
+        brotli = None
+        print("brotli not installed, only .gz files are generated.")
+    for root, dirs, files in os.walk(static_dir):
+        for name in files:
+            if not name.endswith(_PRECOMPRESS_EXTS):
+                continue
+            path = os.path.join(root, name)
+            with open(path, "rb") as f:
+                data = f.read()
+            outputs = [(".gz", _gzip(data))]
+            if brotli is not None:
+                outputs.append((".br", brotli.compress(data, quality=11)))
+            for suffix, compressed in outputs:
+                # 压缩后节省不到10%的,不值得让客户端解压,删除旧的压缩文件
+                if len(compressed) < len(data) * 0.9:
+                    with open(path + suffix, "wb") as f:
+                        f.write(compressed)
+                elif os.path.exists(path + suffix):
+                    os.remove(path + suffix)
+
 # 打包的目标文件名
 _TAR_FILE = "dist-awesome.tar.gz"
 def build():
     # 打包的内容
     includes = ["static", "templates", "favicon.ico", "*.py"]
     excludes = ["test", ".*", "*.pyc", "*.pyo"]  # 不打包的内容
+    # 先生成静态文件的压缩版本,与原文件一起打包
+    _precompress(os.path.join(os.path.abspath("."), "www", "static"))
     # local来运行本地命令
     # 删除已存在的打包文件
     local("rm -f dist/%s" % _TAR_FILE)
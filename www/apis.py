@@ -6,6 +6,7 @@
 __author__ = 'Engine'
 
 import json
+import base64
 import logging
 import inspect # the module provides several useful functions to help get information about live objects, such as modules, classes, methods, functions.
 import functools # 该模块提供有用的高阶函数.总的来说,任何callable对象都可视为函数
@@ -47,6 +48,68 @@ class Page(object):
 
     __repr__ = __str__
 
+# 游标分页(cursor pagination)所用的游标
+# 游标对客户端是不透明的字符串,实际是某条记录(created_at, id)的json经过base64编码的结果
+def encode_cursor(created_at, pk):
+    s = json.dumps([created_at, pk]).encode("utf-8")
+    return base64.urlsafe_b64encode(s).decode("ascii").rstrip("=")
+
+# 解码游标,返回(created_at, id)元组.空的游标返回None
+# field为游标对应的请求参数名,游标不合法时用于报错
+def decode_cursor(token, field="cursor"):
+    if not token:
+        return None
+    try:
+        s = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+        created_at, pk = json.loads(s.decode("utf-8"))
+        return float(created_at), str(pk)
+    except (ValueError, TypeError):
+        raise APIValueError(field, "Invalid cursor: %s" % token)
+
+# 游标分页的page对象
+# 与Page按页码分页不同,它通过after/before游标定位,不需要总数,翻到多深的页都一样快
+class CursorPage(object):
+    '''Page object for cursor (keyset) pagination.'''
+
+    def __init__(self, after=None, before=None, page_size=10):
+        '''init CursorPage by cursors
+        after - 取该游标之后(更旧)的记录
+        before - 取该游标之前(更新)的记录,after与before都指定时以after为准
+        page_size - 一个页面最多显示的记录数'''
+        self.page_size = page_size
+        # 多取一条记录,用于判断是否还有下一页/上一页
+        self.limit = page_size + 1
+        self.direction = "before" if before and not after else "after"
+        # 只要游标非空,反方向上就一定还有记录(至少有游标对应的那一条)
+        cursor = before if self.direction == "before" else after
+        self.has_next = self.direction == "before" and bool(cursor)
+        self.has_previous = self.direction == "after" and bool(cursor)
+        self.next_cursor = None
+        self.previous_cursor = None
+
+    # 根据取得的记录(按created_at降序排序,最多limit条)设置翻页信息,返回本页的记录
+    def trim(self, items):
+        items = list(items)
+        if len(items) > self.page_size:
+            # 多出的那一条是离游标最远的记录
+            if self.direction == "before":
+                items = items[1:]
+                self.has_previous = True
+            else:
+                items = items[:self.page_size]
+                self.has_next = True
+        if items:
+            if self.has_next:
+                self.next_cursor = encode_cursor(items[-1]["created_at"], items[-1]["id"])
+            if self.has_previous:
+                self.previous_cursor = encode_cursor(items[0]["created_at"], items[0]["id"])
+        return items
+
+    def __str__(self):
+        return "page_size: %s, has_next: %s, has_previous: %s, next_cursor: %s, previous_cursor: %s" % (self.page_size, self.has_next, self.has_previous, self.next_cursor, self.previous_cursor)
+
+    __repr__ = __str__
+
 class APIError(Exception):
     '''
     定义APIError基类,其继承自Exception类,具有它的一切功能
@@ -14,16 +14,26 @@ logging.basicConfig(level=logging.INFO,
 
 import asyncio
 import os
+import sys
+import glob
 import json
 import time
+import hashlib
 from datetime import datetime
 
 from aiohttp import web
+from multidict import CIMultiDict
 from jinja2 import Environment, FileSystemLoader # 从jinja2模板库导入环境与文件系统加载器
 
 import orm
-from coroweb import add_routes, add_static
+import render
+import compress
+from cache import LRUCache
+from metrics import Histogram
+from config import configs
+from coroweb import add_routes, add_static, handler_attr
 from handlers import cookie2user, COOKIE_NAME
+from models import Blog, Comment
 
 
 # 选择jinja2作为模板, 初始化模板
@@ -59,123 +69,429 @@ def init_jinja2(app, **kw):
     # 将jinja环境赋给app的__templating__属性
     app["__templating__"] = env
 
-# 创建应用时,通过指定命名关键字为一些"middle factory"的列表可创建中间件Middleware
-# 每个middle factory接收2个参数,一个app实例,一个handler, 并返回一个新的handler
+# 创建应用时,通过middlewares关键字参数指定中间件(middleware)的列表
+# 每个中间件用@web.middleware声明,接收2个参数,一个request,一个handler(内层的中间件或url处理函数),返回响应
 # 以下是一些middleware(中间件), 可以在url处理函数处理前后对url进行处理
 
+# json序列化时无法直接处理的对象: orm的行对象没有__dict__,通过_asdict()转为dict,其余对象取其__dict__
+def json_default(o):
+    if isinstance(o, orm.Row):
+        return o._asdict()
+    return o.__dict__
+
 # 在处理请求之前,先记录日志
+@web.middleware
 @asyncio.coroutine
-def logger_factory(app, handler):
-    @asyncio.coroutine
-    def logger(request):
-        # 记录日志,包括http method, 和path
-        logging.info("Request: %s %s" % (request.method, request.path))
-        # 日志记录完毕之后, 调用传入的handler继续处理请求
-        return (yield from handler(request))
-    return logger
+def logger_middleware(request, handler):
+    # 记录日志,包括http method, 和path
+    logging.info("Request: %s %s" % (request.method, request.path))
+    # 日志记录完毕之后, 调用传入的handler继续处理请求
+    return (yield from handler(request))
+
+# 压缩响应
+# 可压缩类型(html,json等)且body不小于min_size的响应,按客户端的Accept-Encoding以brotli或gzip压缩
+# 大于offload_size的body交给线程池压缩,不阻塞事件循环
+# 客户端接受压缩时ETag改为弱ETag(与nginx的做法相同),不同编码的响应不会被当作字节完全相同.
+# 为了让304与200给出相同的校验器,这里不看body的长度: 太短而未压缩的响应,以及304,同样带弱ETag与Vary.
+# 压缩结果生成新的响应,不修改内层返回的响应: 它可能由singleflight_middleware共享给Accept-Encoding不同的请求
+@web.middleware
+@asyncio.coroutine
+def compress_middleware(request, handler):
+    resp = yield from handler(request)
+    if type(resp) is not web.Response or resp.prepared or "Content-Encoding" in resp.headers:
+        return resp
+    not_modified = resp.status == 304
+    if not not_modified and (not isinstance(resp.body, bytes) or not compress.compressible(resp.content_type)):
+        return resp
+    headers = CIMultiDict((k, v) for k, v in resp.headers.items() if k != "Content-Length")
+    vary = headers.get("Vary")
+    headers["Vary"] = "Accept-Encoding" if not vary else vary + ", Accept-Encoding"
+    encoding = compress.negotiate(request.headers.get("Accept-Encoding"))
+    etag = headers.get("ETag")
+    if encoding is not None and etag is not None and not etag.startswith("W/"):
+        headers["ETag"] = "W/" + etag
+    body = resp.body
+    if not not_modified and encoding is not None and len(body) >= configs.compress.min_size:
+        body = yield from _compress_body(body, encoding)
+        headers["Content-Encoding"] = encoding
+    compressed = web.Response(body=body, status=resp.status, reason=resp.reason, headers=headers)
+    for name, morsel in resp.cookies.items():
+        compressed.cookies[name] = morsel
+    return compressed
+
+# 压缩结果缓存
+# 按(body的摘要, 编码)缓存压缩后的body.不按ETag缓存: 由版本生成的ETag只保证内容在语义上不变,
+# 页面中"N分钟前"之类的相对时间仍会变化.计算摘要远比压缩便宜.
+# 整页缓存的页面(见page_cache_middleware)缓存的是未压缩的body,命中时由这里取得压缩结果,不必每次重新压缩
+_compressed_cache = LRUCache(None, maxbytes=configs.compress.cache_bytes, sizeof=lambda o: len(o) + 64 if isinstance(o, bytes) else sys.getsizeof(o))
+
+@asyncio.coroutine
+def _compress_body(body, encoding):
+    key = None
+    if _compressed_cache.maxbytes:
+        key = (hashlib.sha1(body).digest(), encoding)
+        compressed = _compressed_cache.get(key)
+        if compressed is not None:
+            return compressed
+    level = configs.compress.brotli_quality if encoding == "br" else configs.compress.gzip_level
+    compressed = yield from compress.compress_async(body, encoding, level, configs.compress.offload_size)
+    if key is not None:
+        _compressed_cache.set(key, compressed)
+    return compressed
 
 # 在处理请求之前,先将cookie解析出来,并将登录用于绑定到request对象上
 # 这样后续的url处理函数就可以直接拿到登录用户
 # 以后的每个请求,都是在这个middle之后处理的,都已经绑定了用户信息
+@web.middleware
 @asyncio.coroutine
-def auth_factory(app, handler):
-    @asyncio.coroutine
-    def auth(request):
-        logging.info("check user: %s %s" % (request.method, request.path))
-        request.__user__ = None # 先绑定一个None到请求的__user__属性
-        cookie_str = request.cookies.get(COOKIE_NAME) # 通过cookie名取得加密cookie字符串(不明白的看看handlers.py)
-        if cookie_str:
-            user = yield from cookie2user(cookie_str) # 验证cookie,并得到用户信息
-            if user:
-                logging.info("set current user: %s" % user.email)
-                request.__user__ = user # 将用户信息绑定到请求上
-            # 请求的路径是管理页面,但用户非管理员,将会重定向到登录页面?
-        if request.path.startswith('/manage/') and (request.__user__ is None or not request.__user__.admin):
-            return web.HTTPFound('/signin')
-        return (yield from handler(request))
-    return auth
+def auth_middleware(request, handler):
+    logging.info("check user: %s %s" % (request.method, request.path))
+    request.__user__ = None # 先绑定一个None到请求的__user__属性
+    cookie_str = request.cookies.get(COOKIE_NAME) # 通过cookie名取得加密cookie字符串(不明白的看看handlers.py)
+    if cookie_str:
+        user = yield from cookie2user(cookie_str) # 验证cookie,并得到用户信息
+        if user:
+            logging.info("set current user: %s" % user.email)
+            request.__user__ = user # 将用户信息绑定到请求上
+            # 以用户id作为数据库会话,用户写入之后的一段时间内,其查询都在主库执行(读己之写)
+            orm.bind_session(user.id)
+        # 请求的路径是管理页面,但用户非管理员,将会重定向到登录页面?
+    if request.path.startswith('/manage/') and (request.__user__ is None or not request.__user__.admin):
+        raise web.HTTPFound('/signin')
+    return (yield from handler(request))
 
 # 解析数据
+@web.middleware
 @asyncio.coroutine
-def data_factory(app, handler):
-    @asyncio.coroutine
-    def parse_data(request):
-        # 解析数据是针对post方法传来的数据,若http method非post,将跳过,直接调用handler处理请求
-        if request.method == "POST":
-            # content_type字段表示post的消息主体的类型, 以application/json打头表示消息主体为json
-            # request.json方法,读取消息主题,并以utf-8解码
-            # 将消息主体存入请求的__data__属性
-            if request.content_type.startswith("application/json"):
-                request.__data__ = yield from request.json()
-                logging.info("request json: %s" % str(request.__data__))
-            # content type字段以application/x-www-form-urlencodeed打头的,是浏览器表单
-            # request.post方法读取post来的消息主体,即表单信息
-            elif request.content_type.startswith("application/x-www-form-urlencoded"):
-                request.__data__ = yield from request.post()
-                logging.info("request form: %s" % str(request.__data__))
-        # 调用传入的handler继续处理请求
-        return (yield from handler(request))
-    return parse_data
+def data_middleware(request, handler):
+    # 解析数据是针对post方法传来的数据,若http method非post,将跳过,直接调用handler处理请求
+    if request.method == "POST":
+        # content_type字段表示post的消息主体的类型, 以application/json打头表示消息主体为json
+        # request.json方法,读取消息主题,并以utf-8解码
+        # 将消息主体存入请求的__data__属性
+        if request.content_type.startswith("application/json"):
+            request.__data__ = yield from request.json()
+            logging.info("request json: %s" % str(request.__data__))
+        # content type字段以application/x-www-form-urlencodeed打头的,是浏览器表单
+        # request.post方法读取post来的消息主体,即表单信息
+        elif request.content_type.startswith("application/x-www-form-urlencoded"):
+            request.__data__ = yield from request.post()
+            logging.info("request form: %s" % str(request.__data__))
+    # 调用传入的handler继续处理请求
+    return (yield from handler(request))
+
+# 条件GET
+# 由版本生成弱ETag: 相同的ETag只保证内容在语义上相同,模板中"N分钟前"之类的相对时间仍会使字节不同(见RFC 7232)
+# 只有以body的摘要生成的ETag才是强ETag
+# 页面可能因登录用户而不同,因此用户id也计入ETag;部署版本也计入,部署新的模板或代码后旧的ETag全部失效
+# 部署版本: 代码与模板文件内容的摘要.同一次部署的各个进程,以及重启之后,得到的ETag都相同
+def deploy_version(root=os.path.dirname(os.path.abspath(__file__))):
+    h = hashlib.sha1()
+    files = glob.glob(os.path.join(root, "*.py")) + glob.glob(os.path.join(root, "templates", "**"), recursive=True)
+    for path in sorted(files):
+        if os.path.isfile(path):
+            h.update(os.path.relpath(path, root).encode("utf-8"))
+            with open(path, "rb") as f:
+                h.update(f.read())
+    return h.hexdigest()
+
+_etag_salt = deploy_version()
+
+def make_etag(request, *version):
+    user = request.__user__
+    key = repr((_etag_salt, None if user is None else user.id) + version)
+    return 'W/"%s"' % hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+# 去掉弱ETag的W/前缀
+def _opaque_tag(etag):
+    return etag[2:] if etag.startswith("W/") else etag
 
-# 上面factory是在url处理函数之前先对请求进行了处理,以下则在url处理函数之后进行处理
+# 判断客户端缓存的响应是否仍然有效
+# 有If-None-Match时只比较ETag,忽略If-Modified-Since(见RFC 7232)
+def not_modified(request, etag, last_modified=None):
+    if_none_match = request.headers.get("If-None-Match")
+    if if_none_match is not None:
+        tags = [t.strip() for t in if_none_match.split(",")]
+        # If-None-Match使用弱比较,W/前缀不影响结果
+        return "*" in tags or _opaque_tag(etag) in map(_opaque_tag, tags)
+    if last_modified is None:
+        return False
+    if_modified_since = request.if_modified_since
+    # http日期只精确到秒
+    return if_modified_since is not None and int(last_modified) <= if_modified_since.timestamp()
+
+def not_modified_response(etag, last_modified=None):
+    resp = web.Response(status=304)
+    resp.headers["ETag"] = etag
+    if last_modified is not None:
+        resp.last_modified = last_modified
+    return resp
+
+# 上面的中间件是在url处理函数之前先对请求进行了处理,以下则在url处理函数之后进行处理
 # 其将request handler的返回值转换为web.Response对象
-@asyncio.coroutine
-def response_factory(app, handler):
-    @asyncio.coroutine
-    def response(request):
-        logging.info("Response handler...")
-        # 调用handler来处理url请求,并返回响应结果
-        r = yield from handler(request)
-        # 若响应结果为StreamResponse,直接返回
-        # StreamResponse是aiohttp定义response的基类,即所有响应类型都继承自该类
-        # StreamResponse主要为流式数据而设计
-        if isinstance(r, web.StreamResponse):
-            return r
-        # 若响应结果为字节流,则将其作为应答的body部分,并设置响应类型为流型
-        if isinstance(r, bytes):
-            resp = web.Response(body=r)
-            resp.content_type = "application/octet-stream"
+# 将url处理函数的返回值r转换为响应
+def make_response(request, r):
+    # 若响应结果为StreamResponse,直接返回
+    # StreamResponse是aiohttp定义response的基类,即所有响应类型都继承自该类
+    # StreamResponse主要为流式数据而设计
+    if isinstance(r, web.StreamResponse):
+        return r
+    # 若响应结果为字节流,则将其作为应答的body部分,并设置响应类型为流型
+    if isinstance(r, bytes):
+        resp = web.Response(body=r)
+        resp.content_type = "application/octet-stream"
+        return resp
+    # 若响应结果为字符串
+    if isinstance(r, str):
+        # 判断响应结果是否为重定向.若是,则重定向到该地址
+        if r.startswith("redirect:"):
+            raise web.HTTPFound(r[9:])
+        # 响应结果不是重定向,则以utf-8对字符串进行编码,作为body.设置相应的响应类型
+        resp = web.Response(body = r.encode("utf-8"))
+        resp.content_type = "text/html;charset=utf-8"
+        return resp
+    # 若响应结果为字典,则获取它的模板属性,此处为jinja2.env(见init_jinja2)
+    if isinstance(r, dict):
+        template = r.get("__template__")
+        # 若不存在对应模板,则将字典调整为json格式返回,并设置响应类型为json
+        if template is None:
+            resp = web.Response(body=json.dumps(r, ensure_ascii=False, default=json_default).encode("utf-8"))
+            resp.content_type = "application/json;charset=utf-8"
             return resp
-        # 若响应结果为字符串
-        if isinstance(r, str):
-            # 判断响应结果是否为重定向.若是,则返回重定向的地址
-            if r.startswith("redirect:"):
-                return web.HTTPFound(r[9:])
-            # 响应结果不是重定向,则以utf-8对字符串进行编码,作为body.设置相应的响应类型
-            resp = web.Response(body = r.encode("utf-8"))
+        # 存在对应模板的,则将套用模板,用request handler的结果进行渲染
+        else:
+            r["__user__"] = request.__user__  # 增加__user__,前端页面将依次来决定是否显示评论框
+            resp = web.Response(body=request.app["__templating__"].get_template(template).render(**r).encode("utf-8"))
             resp.content_type = "text/html;charset=utf-8"
             return resp
-        # 若响应结果为字典,则获取它的模板属性,此处为jinja2.env(见init_jinja2)
-        if isinstance(r, dict):
-            template = r.get("__template__")
-            # 若不存在对应模板,则将字典调整为json格式返回,并设置响应类型为json
-            if template is None:
-                resp = web.Response(body=json.dumps(r, ensure_ascii=False, default=lambda o: o.__dict__).encode("utf-8"))
-                resp.content_type = "application/json;charset=utf-8"
-                return resp
-            # 存在对应模板的,则将套用模板,用request handler的结果进行渲染
-            else:
-                r["__user__"] = request.__user__  # 增加__user__,前端页面将依次来决定是否显示评论框
-                resp = web.Response(body=app["__templating__"].get_template(template).render(**r).encode("utf-8"))
-                resp.content_type = "text/html;charset=utf-8"
-                return resp
-        # 若响应结果为整型的
-        # 此时r为状态码,即404,500等
-        if isinstance(r, int) and r >= 100 and r<600:
-            return web.Response
-        # 若响应结果为元组,并且长度为2
-        if isinstance(r, tuple) and len(r) == 2:
-            t, m = r
-            # t为http状态码,m为错误描述
-            # 判断t是否满足100~600的条件
-            if isinstance(t, int) and t>= 100 and t < 600:
-                # 返回状态码与错误描述
-                return web.Response(t, str(m))
-        # 默认以字符串形式返回响应结果,设置类型为普通文本
-        resp = web.Response(body=str(r).encode("utf-8"))
-        resp.content_type = "text/plain;charset=utf-8"
+    # 若响应结果为整型的
+    # 此时r为状态码,即404,500等
+    if isinstance(r, int) and r >= 100 and r<600:
+        return web.Response(status=r)
+    # 若响应结果为元组,并且长度为2
+    if isinstance(r, tuple) and len(r) == 2:
+        t, m = r
+        # t为http状态码,m为错误描述
+        # 判断t是否满足100~600的条件
+        if isinstance(t, int) and t>= 100 and t < 600:
+            # 返回状态码与错误描述
+            return web.Response(status=t, text=str(m))
+    # 默认以字符串形式返回响应结果,设置类型为普通文本
+    resp = web.Response(body=str(r).encode("utf-8"))
+    resp.content_type = "text/plain;charset=utf-8"
+    return resp
+
+@web.middleware
+@asyncio.coroutine
+def response_middleware(request, handler):
+    logging.info("Response handler...")
+    etag = last_modified = None
+    conditional = request.method == "GET"
+    # 处理函数声明了校验器的,先校验版本,客户端缓存的版本未改变时直接返回304,不再执行处理函数
+    validator = handler_attr(request, "__validator__") if conditional else None
+    if validator is not None:
+        validated = yield from validator(request)
+        if validated is not None:
+            version, last_modified = validated
+            etag = make_etag(request, version)
+            if not_modified(request, etag, last_modified):
+                return not_modified_response(etag, last_modified)
+    # 调用handler来处理url请求,并返回响应结果
+    r = yield from handler(request)
+    # 返回单个model实例的,以其版本字段生成ETag,未修改时不必再序列化
+    if conditional and etag is None and isinstance(r, orm.Model) and r.__version_field__ in r:
+        last_modified = r.get(r.__version_field__)
+        etag = make_etag(request, r.__table__, r.get(r.__primary_key__), last_modified)
+        if not_modified(request, etag, last_modified):
+            return not_modified_response(etag, last_modified)
+    resp = make_response(request, r)
+    if not conditional or type(resp) is not web.Response or resp.status != 200 or not isinstance(resp.body, bytes):
+        return resp
+    # 其余响应以body的摘要作为ETag,虽然仍需执行处理函数,但未修改时不必再发送body
+    if etag is None:
+        etag = '"%s"' % hashlib.sha1(resp.body).hexdigest()
+    if not_modified(request, etag, last_modified):
+        return not_modified_response(etag, last_modified)
+    resp.headers["ETag"] = etag
+    if last_modified is not None:
+        resp.last_modified = last_modified
+    return resp
+
+# 单飞(single-flight): 同时到达的相同GET请求只执行一次处理函数,共享其渲染好的响应
+# 相同指路径,查询字符串,登录用户与条件GET的请求头都相同,因此不同用户之间不会共享页面
+# 只合并注册为@get的url处理函数,静态文件等不经过合并
+# 处理函数在独立的任务中执行,发起请求的客户端断开时,等待同一结果的其他请求不受影响
+# 只共享不设置cookie的普通响应(body为bytes);处理函数抛出异常或响应无法共享时,等待的请求各自重新执行
+class _Flight(object):
+
+    __slots__ = ("task", "followers")
+
+    def __init__(self, task):
+        self.task = task
+        self.followers = 0
+
+_flights = {}  # 正在执行的请求, 键为(路径与查询字符串, 用户id)
+# requests - 可合并的请求数, flights - 实际执行处理函数的次数
+# coalesced - 共享了其他请求结果的请求数, fallbacks - 等待后仍需自己执行的请求数
+_flight_stats = dict(requests=0, flights=0, coalesced=0, fallbacks=0)
+_flight_followers = Histogram((0, 1, 2, 5, 10, 20, 50, 100, 200, 500))  # 每次执行被多少个请求共享
+
+def singleflight_stats():
+    stats = dict(_flight_stats)
+    # 合并率: 不必执行处理函数的请求所占的比例
+    stats["coalescing_ratio"] = (stats["coalesced"] / stats["requests"]) if stats["requests"] else 0.0
+    stats["followers"] = _flight_followers.stats()
+    return stats
+
+# 复制一份可以共享的响应,不可共享时返回None
+def _share_response(resp):
+    if type(resp) is not web.Response or resp.cookies or not isinstance(resp.body, bytes):
+        return None
+    headers = dict((k, v) for k, v in resp.headers.items() if k != "Content-Length")
+    return web.Response(body=resp.body, status=resp.status, reason=resp.reason, headers=headers)
+
+@asyncio.coroutine
+def _fly(handler, request, key):
+    try:
+        return (yield from handler(request))
+    finally:
+        _flight_followers.observe(_flights.pop(key).followers)
+
+@web.middleware
+@asyncio.coroutine
+def singleflight_middleware(request, handler):
+    if request.method != "GET" or handler_attr(request, "__method__") != "GET":
+        return (yield from handler(request))
+    user = request.__user__
+    # 条件GET的请求头不同,响应可能不同(200或304)
+    key = (request.path_qs, None if user is None else user.id, request.headers.get("If-None-Match"), request.headers.get("If-Modified-Since"))
+    _flight_stats["requests"] += 1
+    flight = _flights.get(key)
+    if flight is None:
+        flight = _flights[key] = _Flight(asyncio.ensure_future(_fly(handler, request, key)))
+        _flight_stats["flights"] += 1
+        return (yield from asyncio.shield(flight.task))
+    flight.followers += 1
+    try:
+        resp = _share_response((yield from asyncio.shield(flight.task)))
+    except asyncio.CancelledError:
+        raise
+    except Exception:
+        resp = None
+    if resp is None:
+        _flight_stats["fallbacks"] += 1
+        return (yield from handler(request))
+    _flight_stats["coalesced"] += 1
+    return resp
+
+# 整页缓存
+# 声明了@cache_page的页面,匿名访客的响应(编码后的body与响应头)按路径,查询字符串与是否匿名缓存
+# 新鲜时间(ttl)内直接返回缓存;过期后的stale窗口内仍返回旧页面,同时在后台重新生成一次;再之后视为未命中
+# 同一页面同时未命中的请求已由singleflight_middleware合并,热门页面失效时不会同时生成多次
+# 缓存只在本进程内,多进程部署时各进程各自缓存与失效
+class _Page(object):
+
+    __slots__ = ("body", "headers", "stored")
+
+    def __init__(self, body, headers):
+        self.body = body
+        self.headers = headers
+        self.stored = time.monotonic()
+
+# 缓存的页面按body的长度计算内存
+def _page_sizeof(o):
+    return len(o.body) + 256 if isinstance(o, _Page) else sys.getsizeof(o)
+
+_page_cache = LRUCache(None, maxbytes=configs.page_cache.max_bytes, sizeof=_page_sizeof)
+_page_refreshing = set()  # 正在后台重新生成的页面的缓存键
+_page_stats = dict(stale=0, refreshes=0)
+_page_generation = 0      # 整页缓存的代数,每次清空缓存加1
+
+# 博客与评论的增删改会改变首页与博客详情页,清空整页缓存
+# 写入远少于读取,整体清空足够简单;清空时代数加1,写入之前开始生成的页面不会再存入缓存(见_fill_page),
+# 因此不会返回过期的内容
+@orm.add_listener
+def _invalidate_pages(model, action):
+    global _page_generation
+    if isinstance(model, (Blog, Comment)) or model in (Blog, Comment):
+        _page_generation += 1
+        _page_cache.clear()
+
+def page_cache_stats():
+    stats = _page_cache.stats()
+    stats.update(_page_stats)
+    return stats
+
+# 从响应生成缓存条目,只缓存不设置cookie的200响应
+def _make_page(resp):
+    if type(resp) is not web.Response or resp.status != 200 or resp.cookies or not isinstance(resp.body, bytes):
+        return None
+    headers = dict((k, v) for k, v in resp.headers.items() if k not in ("Content-Length", "Set-Cookie"))
+    return _Page(resp.body, headers)
+
+def _page_response(request, page, state):
+    # 缓存的页面带有response_middleware生成的ETag,客户端的缓存仍有效时返回304
+    etag = page.headers.get("ETag")
+    if etag is not None and not_modified(request, etag):
+        return not_modified_response(etag)
+    resp = web.Response(body=page.body, headers=page.headers)
+    resp.headers["X-Cache"] = state
+    return resp
+
+# 生成页面并存入缓存
+# 生成期间缓存被清空过的(博客或评论被修改),页面可能是修改之前的内容,只返回而不缓存
+@asyncio.coroutine
+def _fill_page(handler, request, key, ttl):
+    generation = _page_generation
+    resp = yield from handler(request)
+    page = _make_page(resp)
+    if page is not None and generation == _page_generation:
+        _page_cache.set(key, page, ttl + configs.page_cache.stale)
+    return resp
+
+# 在后台重新生成过期的页面,失败时只记录日志,旧页面在stale窗口结束后自然失效
+# request是由_refresh_request复制的请求,不是客户端的请求
+@asyncio.coroutine
+def _refresh_page(handler, request, key, ttl):
+    try:
+        yield from _fill_page(handler, request, key, ttl)
+        _page_stats["refreshes"] += 1
+    except Exception:
+        logging.exception("refresh page failed: %s", request.path_qs)
+    finally:
+        _page_refreshing.discard(key)
+
+# 后台重新生成页面所用的请求
+# 客户端的请求在返回旧页面之后就结束了,不能再使用,因此复制一个只保留路径,查询参数与路由匹配结果的请求;
+# 不带任何请求头,否则客户端的If-None-Match会让处理函数返回304,页面无法缓存
+def _refresh_request(request):
+    refresh = request.clone(headers={})
+    refresh.__user__ = None
+    return refresh
+
+@web.middleware
+@asyncio.coroutine
+def page_cache_middleware(request, handler):
+    ttl = handler_attr(request, "__cache_ttl__")
+    # 登录用户的页面包含其个人信息,不缓存
+    anonymous = request.__user__ is None
+    if ttl is None or request.method != "GET" or not anonymous or not _page_cache.maxbytes:
+        return (yield from handler(request))
+    key = (request.path, request.query_string, anonymous)
+    page = _page_cache.get(key)
+    if page is None:
+        resp = yield from _fill_page(handler, request, key, ttl)
+        if isinstance(resp, web.Response) and not resp.prepared:
+            resp.headers["X-Cache"] = "MISS"
         return resp
-    return response
+    if time.monotonic() - page.stored < ttl:
+        return _page_response(request, page, "HIT")
+    # 已过期但仍在stale窗口内,返回旧页面,并在后台重新生成(只生成一次)
+    _page_stats["stale"] += 1
+    if key not in _page_refreshing:
+        _page_refreshing.add(key)
+        asyncio.ensure_future(_refresh_page(handler, _refresh_request(request), key, ttl))
+    return _page_response(request, page, "STALE")
 
 # 时间过滤器
 def datetime_filter(t):
@@ -193,24 +509,38 @@ def datetime_filter(t):
     dt = datetime.fromtimestamp(t)
     return u"%s年%s月%s日" % (dt.year, dt.month, dt.day)
 
-# 初始化
-@asyncio.coroutine
-def init(loop):
-    # 创建全局数据库连接池
-    yield from orm.create_pool(loop = loop, host="127.0.0.1", port = 3306, user = "www-data", password = "www-data", db = "awesome", autocommit = True)
-    # 创建web应用,
-    app = web.Application(loop = loop, middlewares=[logger_factory, auth_factory, response_factory]) # 创建一个循环类型是消息循环的web应用对象
+# 创建web应用: 中间件,模板与全部路由,不涉及数据库与网络,测试中也可以直接使用
+def make_app():
+    app = web.Application(middlewares=[logger_middleware, compress_middleware, auth_middleware, singleflight_middleware, page_cache_middleware, response_middleware])
     # 设置模板为jiaja2, 并以时间为过滤器
     init_jinja2(app, filters=dict(datetime=datetime_filter))
+    # 登记中间件的统计,由/api/stats返回
+    app["__stats__"] = dict(singleflight=singleflight_stats, page_cache=page_cache_stats)
     # 注册所有url处理函数
     add_routes(app, "handlers")
     # 将当前目录下的static目录将如app目录
     add_static(app)
-    # 调用子协程:创建一个TCP服务器,绑定到"127.0.0.1:9000"socket,并返回一个服务器对象
-    srv = yield from loop.create_server(app.make_handler(), "127.0.0.1", 9000)
+    return app
+
+# 初始化
+@asyncio.coroutine
+def init(loop):
+    # 创建全局数据库连接池,连接参数与连接池的各项设置均来自配置文件
+    kw = dict(configs.db)
+    kw["db"] = kw.pop("database")
+    yield from orm.create_pool(loop = loop, **kw)
+    # 创建markdown渲染进程池
+    render.init_executor(configs.render.workers, configs.render.inline_threshold)
+    # 创建web应用
+    app = make_app()
+    # 启动服务器,监听"127.0.0.1:9000",返回的runner用于关闭服务器
+    runner = web.AppRunner(app)
+    yield from runner.setup()
+    yield from web.TCPSite(runner, "127.0.0.1", 9000).start()
     logging.info("server started at http://127.0.0.1:9000")
-    return srv
+    return runner
 
-loop = asyncio.get_event_loop() # loop是一个消息循环对象
-loop.run_until_complete(init(loop)) #在消息循环中执行协程
-loop.run_forever()
+if __name__ == "__main__":
+    loop = asyncio.get_event_loop() # loop是一个消息循环对象
+    loop.run_until_complete(init(loop)) #在消息循环中执行协程
+    loop.run_forever()
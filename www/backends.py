@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''数据库后端
+orm通过后端创建连接池,连接池,连接与游标的接口都与aiomysql保持一致:
+    pool: acquire(), release(conn), size, freesize, minsize, maxsize
+    conn: cursor(cursor_cls), begin(), commit(), rollback(), get_autocommit(), ping(), close(), closed
+    cursor: execute(sql, args), executemany(sql, args_list), fetchmany(size), fetchall(), rowcount, close()
+目前有两种后端:
+    mysql  - aiomysql,生产环境使用
+    sqlite - 内嵌的sqlite3,在线程中执行,不需要MySQL即可运行整个应用,用于基准测试与压力测试'''
+
+__author__ = 'Engine'
+
+import os
+import re
+import logging
+import asyncio
+import sqlite3
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+# 后端基类
+# paramstyle - 驱动所用的占位符风格,"format"为%s,"qmark"为?
+# DictCursor - 以dict形式返回结果的游标类型
+# SSDictCursor - 服务器端(不缓存结果的)游标类型
+class Backend(object):
+
+    name = None
+    paramstyle = "format"
+    DictCursor = None
+    SSDictCursor = None
+
+    # 创建连接池,kw为config_default.configs['db']中的连接参数
+    @asyncio.coroutine
+    def create_pool(self, loop, kw):
+        raise NotImplementedError
+
+# aiomysql后端
+class MySQLBackend(Backend):
+
+    name = "mysql"
+    paramstyle = "format"
+
+    def __init__(self):
+        # 只有使用该后端时才需要安装aiomysql
+        import aiomysql
+        self._aiomysql = aiomysql
+        self.DictCursor = aiomysql.DictCursor
+        self.SSDictCursor = aiomysql.SSDictCursor
+
+    @asyncio.coroutine
+    def create_pool(self, loop, kw):
+        # 调用一个子协程来创建连接池,create_pool的返回值是一个pool实例对象
+        return (yield from self._aiomysql.create_pool(
+            # 前面几项为设置连接的属性
+            # dict.get(key, default)
+            host      = kw.get("host", "localhost"),# 数据库服务器的位置,设在本地
+            port      = kw.get("port", 3306),      # mysql的端口
+            user      = kw["user"],                # 登录用户名
+            password  = kw["password"],            # 口令
+            db        = kw["db"],            # 当前数据库名
+            charset   = kw.get("charset", "utf8"), # 设置连接使用的编码格式为utf-8
+            autocommit= kw.get("autocommit", True),# 自动提交模式,此处默认是False
+
+            #以下三项为可选项
+            # 最大连接池大小,默认是10,此处设为10
+            maxsize   = kw.get("maxsize", 10),
+            # 最小连接池大小,默认是10,此处设为1,保证了任何时候都有一个数据库连接
+            minsize   = kw.get("minsize", 1),
+            loop      = loop # 设置消息循环,何用?
+        ))
+
+# sqlite3游标,每个操作都交给连接的专属线程执行
+class SQLiteCursor(object):
+
+    def __init__(self, conn, cur):
+        self._conn = conn
+        self._cur = cur
+        self.rowcount = -1
+
+    # 将sqlite3返回的元组转换为dict
+    def _rows(self, rows):
+        names = [d[0] for d in self._cur.description or ()]
+        return [dict(zip(names, r)) for r in rows]
+
+    def _execute(self, sql, args):
+        self._cur.execute(sql, args or ())
+        self.rowcount = self._cur.rowcount
+
+    def _executemany(self, sql, args_list):
+        self._cur.executemany(sql, args_list)
+        self.rowcount = self._cur.rowcount
+
+    @asyncio.coroutine
+    def execute(self, sql, args=None):
+        yield from self._conn._run(self._execute, sql, args)
+
+    @asyncio.coroutine
+    def executemany(self, sql, args_list):
+        yield from self._conn._run(self._executemany, sql, args_list)
+
+    @asyncio.coroutine
+    def fetchmany(self, size):
+        return self._rows((yield from self._conn._run(self._cur.fetchmany, size)))
+
+    @asyncio.coroutine
+    def fetchall(self):
+        return self._rows((yield from self._conn._run(self._cur.fetchall)))
+
+    @asyncio.coroutine
+    def close(self):
+        yield from self._conn._run(self._cur.close)
+
+# sqlite3连接
+# sqlite3的调用是阻塞的,因此每条连接有一个专属线程,该连接上的所有操作都在这个线程中依次执行
+class SQLiteConnection(object):
+
+    def __init__(self, db, loop):
+        self._db = db
+        self._loop = loop
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    @asyncio.coroutine
+    def _run(self, fn, *args):
+        return (yield from self._loop.run_in_executor(self._executor, fn, *args))
+
+    # statement_cache - 每条连接缓存的预处理语句数,同一条语句再次执行时不必重新解析
+    @asyncio.coroutine
+    def connect(self, path, statement_cache=128):
+        def _connect():
+            # isolation_level=None: 自动提交模式,与aiomysql的autocommit=True一致,显式begin开始事务
+            return sqlite3.connect(path, isolation_level=None, check_same_thread=False, uri=path.startswith("file:"),
+                                   cached_statements=statement_cache)
+        self._db = yield from self._run(_connect)
+        return self
+
+    @property
+    def closed(self):
+        return self._db is None
+
+    # 游标类型对sqlite3没有意义,结果总是以dict形式返回
+    @asyncio.coroutine
+    def cursor(self, cursor_cls=None):
+        return SQLiteCursor(self, (yield from self._run(self._db.cursor)))
+
+    @asyncio.coroutine
+    def begin(self):
+        yield from self._run(self._db.execute, "begin")
+
+    @asyncio.coroutine
+    def commit(self):
+        yield from self._run(self._db.commit)
+
+    @asyncio.coroutine
+    def rollback(self):
+        yield from self._run(self._db.rollback)
+
+    def get_autocommit(self):
+        return True
+
+    def get_transaction_status(self):
+        return self._db is not None and self._db.in_transaction
+
+    @asyncio.coroutine
+    def ping(self):
+        yield from self._run(self._db.execute, "select 1")
+
+    def close(self):
+        if self._db is not None:
+            self._executor.submit(self._db.close)
+            self._executor.shutdown(wait=False)
+            self._db = None
+
+# sqlite3连接池,接口与aiomysql的连接池一致
+class SQLitePool(object):
+
+    def __init__(self, path, minsize, maxsize, loop, statement_cache=128):
+        self._path = path
+        self._statement_cache = statement_cache
+        self._minsize = minsize
+        self._maxsize = maxsize
+        self._loop = loop
+        self._free = deque()
+        self._used = set()
+        self._acquiring = 0
+        self._cond = asyncio.Condition()
+        self._closed = False
+
+    @property
+    def minsize(self):
+        return self._minsize
+
+    @property
+    def maxsize(self):
+        return self._maxsize
+
+    @property
+    def size(self):
+        return self.freesize + len(self._used) + self._acquiring
+
+    @property
+    def closed(self):
+        return self._closed
+
+    @property
+    def freesize(self):
+        return len(self._free)
+
+    @asyncio.coroutine
+    def _connect(self):
+        self._acquiring += 1
+        try:
+            return (yield from SQLiteConnection(None, self._loop).connect(self._path, self._statement_cache))
+        finally:
+            self._acquiring -= 1
+
+    @asyncio.coroutine
+    def fill(self):
+        while self.size < self._minsize:
+            self._free.append((yield from self._connect()))
+
+    @asyncio.coroutine
+    def acquire(self):
+        yield from self._cond.acquire()
+        try:
+            while True:
+                if self._free:
+                    conn = self._free.popleft()
+                    break
+                if self.size < self._maxsize:
+                    conn = yield from self._connect()
+                    break
+                yield from self._cond.wait()
+            self._used.add(conn)
+            return conn
+        finally:
+            self._cond.release()
+
+    def release(self, conn):
+        self._used.discard(conn)
+        if conn.closed:
+            pass
+        elif self._closed or conn.get_transaction_status():
+            # 事务未结束的连接状态不确定,直接关闭
+            conn.close()
+        else:
+            self._free.append(conn)
+        return asyncio.ensure_future(self._wakeup(), loop=self._loop)
+
+    @asyncio.coroutine
+    def _wakeup(self):
+        yield from self._cond.acquire()
+        try:
+            self._cond.notify()
+        finally:
+            self._cond.release()
+
+    def close(self):
+        self._closed = True
+        while self._free:
+            self._free.popleft().close()
+
+# 将schema.sql(MySQL的DDL)转换为sqlite3可以执行的语句
+# 只保留create table语句,去掉引擎与字符集等MySQL特有的选项,
+# 并将表定义中的key/unique key转换为单独的create index语句
+_RE_CREATE_TABLE = re.compile(r"create\s+table\s+`?(\w+)`?\s*\((.*?)\)\s*(engine[^;]*)?;", re.I | re.S)
+_RE_KEY = re.compile(r"^(unique\s+)?key\s+`?(\w+)`?\s*\((.*)\)$", re.I)
+
+def schema_to_sqlite(schema):
+    statements = []
+    for table, body, _ in _RE_CREATE_TABLE.findall(schema):
+        columns, indexes = [], []
+        for line in body.split("\n"):
+            line = line.strip().rstrip(",")
+            if not line:
+                continue
+            m = _RE_KEY.match(line)
+            if m:
+                unique, name, cols = m.groups()
+                indexes.append("create %sindex if not exists `%s_%s` on `%s` (%s);" % ("unique " if unique else "", table, name, table, cols))
+            else:
+                columns.append("    " + line)
+        statements.append("create table if not exists `%s` (\n%s\n);" % (table, ",\n".join(columns)))
+        statements.extend(indexes)
+    return statements
+
+# sqlite3后端
+# path为数据库文件路径,":memory:"表示内存数据库.
+# 内存数据库使用共享缓存的URI,使连接池中的所有连接访问同一个数据库
+# schema为建表的sql文件,默认为本目录下的schema.sql,连接池创建时自动建表(表已存在时跳过)
+# statement_cache为每条连接缓存的预处理语句数,应不小于应用中不同语句的数量
+class SQLiteBackend(Backend):
+
+    name = "sqlite"
+    paramstyle = "qmark"
+
+    _memory_id = 0
+
+    @asyncio.coroutine
+    def create_pool(self, loop, kw):
+        path = kw.get("path", ":memory:")
+        maxsize = kw.get("maxsize", 10)
+        if path == ":memory:":
+            SQLiteBackend._memory_id += 1
+            path = "file:awesome%s?mode=memory&cache=shared" % SQLiteBackend._memory_id
+        pool = SQLitePool(path, max(kw.get("minsize", 1), 1), maxsize, loop, kw.get("statement_cache", 256))
+        # 内存数据库至少保持一条连接,否则最后一条连接关闭时数据库就被销毁了
+        yield from pool.fill()
+        schema = kw.get("schema") or os.path.join(os.path.dirname(os.path.abspath(__file__)), "schema.sql")
+        with open(schema, encoding="utf-8") as f:
+            statements = schema_to_sqlite(f.read())
+        conn = yield from pool.acquire()
+        try:
+            cur = yield from conn.cursor()
+            for sql in statements:
+                yield from cur.execute(sql)
+            yield from cur.close()
+        finally:
+            pool.release(conn)
+        logging.info("sqlite database ready: %s (%s statements from %s)", path, len(statements), schema)
+        return pool
+
+_backends = {
+    "mysql": MySQLBackend,
+    "sqlite": SQLiteBackend
+}
+
+# 按名称取得后端
+def get_backend(name):
+    try:
+        return _backends[name]()
+    except KeyError:
+        raise ValueError("Unknown database backend: %s" % name)
@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''一次性脚本: 为已有的博客生成预渲染的html
+先执行migrations/001_blog_html_content.sql与003_blog_updated_at.sql为blogs表增加列,再运行本脚本.
+只会处理html缺失或已过期的博客,因此可以重复运行.'''
+
+__author__ = 'Engine'
+
+import logging
+logging.basicConfig(level=logging.INFO)
+
+import asyncio
+
+import orm
+from config import configs
+from models import Blog
+from handlers import render_blog, save_rendered, content_digest
+
+# 每批处理的博客数
+BATCH_SIZE = 100
+
+@asyncio.coroutine
+def backfill(loop):
+    db = configs.db
+    yield from orm.create_pool(loop=loop, host=db.host, port=db.port, user=db.user, password=db.password, db=db.database)
+    offset = 0
+    updated = 0
+    while True:
+        # 按创建时间分批取出博客,避免一次把全部博客读入内存;只取出渲染所需的列
+        blogs = yield from Blog.findAll(fields=("content", "html_content", "content_hash"), orderBy="created_at", limit=(offset, BATCH_SIZE))
+        if not blogs:
+            break
+        for blog in blogs:
+            if blog.html_content is None or blog.content_hash != content_digest(blog.content):
+                yield from render_blog(blog)
+                if (yield from save_rendered(blog)):
+                    updated += 1
+        offset += len(blogs)
+    logging.info("backfill done: %s blogs checked, %s updated." % (offset, updated))
+
+if __name__ == "__main__":
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(backfill(loop))
+    loop.close()
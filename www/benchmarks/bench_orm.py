@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''ORM基准测试
+使用内嵌的sqlite后端,无需MySQL即可运行.先写入一批博客,再分别测量:
+    raw      - 直接用sqlite3执行同样的查询,作为基准
+    find     - Blog.find按主键查询(并发的查询会被合并为一条)
+    findAll  - Blog.findAll分页查询
+    save     - Blog.save写入
+比较ORM与直接查询的差距,即ORM本身(线程切换,结果转换,统计等)的开销.
+
+用法: python3 bench_orm.py [博客数] [查询次数] [并发数]'''
+
+__author__ = 'Engine'
+
+import os
+import sys
+import time
+import random
+import sqlite3
+import asyncio
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import orm
+from models import Blog, next_id
+
+# 计算百分位数
+def percentile(values, p):
+    values = sorted(values)
+    k = min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))
+    return values[k]
+
+def report(name, elapsed, latencies):
+    ms = lambda v: "%.3fms" % (v * 1000)
+    print("%-8s total %.2fs  %8.0f ops/s  p50 %s  p99 %s" % (
+        name, elapsed, len(latencies) / elapsed, ms(percentile(latencies, 50)), ms(percentile(latencies, 99))))
+
+def make_blog(i):
+    return Blog(id=next_id(), user_id="u%s" % (i % 10), user_name="user", user_image="about:blank",
+                name="blog %s" % i, summary="summary %s" % i, content="content " * 50, created_at=time.time() + i)
+
+# 并发执行requests次op,返回总耗时与每次的延迟
+@asyncio.coroutine
+def run(op, requests, concurrency):
+    latencies = []
+    sem = asyncio.Semaphore(concurrency)
+
+    @asyncio.coroutine
+    def one(i):
+        yield from sem.acquire()
+        try:
+            start = time.perf_counter()
+            yield from op(i)
+            latencies.append(time.perf_counter() - start)
+        finally:
+            sem.release()
+
+    start = time.perf_counter()
+    yield from asyncio.wait([asyncio.ensure_future(one(i)) for i in range(requests)])
+    return time.perf_counter() - start, latencies
+
+def bench_raw(path, ids, requests):
+    db = sqlite3.connect(path, isolation_level=None)
+    latencies = []
+    start = time.perf_counter()
+    for i in range(requests):
+        t = time.perf_counter()
+        cur = db.execute("select * from `blogs` where `id`=?", (random.choice(ids),))
+        names = [d[0] for d in cur.description]
+        [dict(zip(names, r)) for r in cur.fetchall()]
+        latencies.append(time.perf_counter() - t)
+    elapsed = time.perf_counter() - start
+    db.close()
+    return elapsed, latencies
+
+def main():
+    blogs = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    requests = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    concurrency = int(sys.argv[3]) if len(sys.argv) > 3 else 20
+    path = os.path.join(tempfile.mkdtemp(), "bench.db")
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(orm.create_pool(loop=loop, backend="sqlite", path=path, maxsize=4, slow_query_ms=None))
+    print("backend: sqlite (%s), blogs: %s, requests: %s, concurrency: %s" % (path, blogs, requests, concurrency))
+
+    start = time.perf_counter()
+    loop.run_until_complete(Blog.save_many([make_blog(i) for i in range(blogs)]))
+    print("save_many %s blogs: %.2fs" % (blogs, time.perf_counter() - start))
+    ids = [b.id for b in loop.run_until_complete(Blog.findAll())]
+
+    report("raw", *bench_raw(path, ids, requests))
+
+    @asyncio.coroutine
+    def find(i):
+        yield from Blog.find(random.choice(ids))
+    report("find", *loop.run_until_complete(run(find, requests, concurrency)))
+
+    @asyncio.coroutine
+    def find_all(i):
+        yield from Blog.findAll(orderBy="created_at desc", limit=(i % 50 * 10, 10))
+    report("findAll", *loop.run_until_complete(run(find_all, requests, concurrency)))
+
+    @asyncio.coroutine
+    def save(i):
+        yield from make_blog(blogs + i).save()
+    report("save", *loop.run_until_complete(run(save, requests, concurrency)))
+
+    print("loader: %s" % orm.loader_stats())
+    loop.close()
+
+if __name__ == "__main__":
+    main()
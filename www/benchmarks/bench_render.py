@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''markdown渲染基准测试
+模拟并发请求: 一部分请求渲染大博客,其余为轻量请求(渲染一条短评论).
+分别在"全部直接渲染"与"大内容交给进程池"两种模式下运行,比较轻量请求的延迟分布.
+大博客在事件循环中渲染时,所有轻量请求都要排队等它,尾延迟(p99)会明显升高.
+
+用法: python3 bench_render.py [并发数] [请求数] [进程数]'''
+
+__author__ = 'Engine'
+
+import os
+import sys
+import time
+import asyncio
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import markdown2
+import render
+
+# 构造一篇较大的markdown博客,包含标题,列表,代码块与链接
+def make_blog(sections=200):
+    parts = []
+    for i in range(sections):
+        parts.append("## Section %s\n\nSome *emphasis* and **strong** text with a [link](http://example.com/%s).\n" % (i, i))
+        parts.append("* item one\n* item two\n* item `three`\n")
+        parts.append("    def f(x):\n        return x * %s\n" % i)
+    return "\n".join(parts)
+
+# 计算百分位数
+def percentile(values, p):
+    values = sorted(values)
+    k = min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))
+    return values[k]
+
+@asyncio.coroutine
+def heavy_request(blog):
+    yield from render.markdown(blog)
+
+# start为请求到达的时间,延迟包括了等待并发名额的排队时间
+@asyncio.coroutine
+def light_request(latencies, start):
+    yield from asyncio.sleep(0)  # 模拟一次I/O等待
+    markdown2.markdown("a short *comment*")
+    latencies.append(time.perf_counter() - start)
+
+@asyncio.coroutine
+def run(concurrency, requests, blog):
+    latencies = []
+    sem = asyncio.Semaphore(concurrency)
+
+    @asyncio.coroutine
+    def one(i):
+        arrived = time.perf_counter()
+        yield from sem.acquire()
+        try:
+            # 每10个请求中有1个是大博客
+            if i % 10 == 0:
+                yield from heavy_request(blog)
+            else:
+                yield from light_request(latencies, arrived)
+        finally:
+            sem.release()
+
+    start = time.perf_counter()
+    yield from asyncio.gather(*[one(i) for i in range(requests)])
+    return time.perf_counter() - start, latencies
+
+def report(name, elapsed, latencies):
+    ms = lambda v: "%.2fms" % (v * 1000)
+    print("%-8s total %.2fs  p50 %s  p95 %s  p99 %s  max %s" % (
+        name, elapsed, ms(percentile(latencies, 50)), ms(percentile(latencies, 95)),
+        ms(percentile(latencies, 99)), ms(max(latencies))))
+
+def main():
+    concurrency = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    requests = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    workers = int(sys.argv[3]) if len(sys.argv) > 3 else os.cpu_count() or 2
+    blog = make_blog()
+    # 关闭渲染缓存,保证每次都真正渲染
+    markdown2.set_convert_cache(None)
+    loop = asyncio.get_event_loop()
+    print("blog size: %s chars, concurrency: %s, requests: %s" % (len(blog), concurrency, requests))
+
+    render.init_executor(0)
+    report("inline", *loop.run_until_complete(run(concurrency, requests, blog)))
+
+    render.init_executor(workers, inline_threshold=4096)
+    # 先预热进程池,避免把创建进程的时间算进去
+    loop.run_until_complete(render.markdown(blog))
+    report("pool(%s)" % workers, *loop.run_until_complete(run(concurrency, requests, blog)))
+    render.shutdown_executor()
+    loop.close()
+
+if __name__ == "__main__":
+    main()
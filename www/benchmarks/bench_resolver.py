@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''路由匹配基准测试
+随着路由数量的增加,比较aiohttp默认路由与coroweb.RadixResource(路由树)的匹配速度.
+每组路由包括:
+    /api/res<i>/{id}            前缀各不相同的带参数路由
+    /api/res<i>/{id}/comments
+    /{user}/page<i>             以参数开头的路由,aiohttp只能逐个尝试正则表达式
+                                (路由树中文字段优先,{user}不能是api)
+每次匹配随机选取一条路由的路径,两种路由都通过app.router.resolve匹配.
+
+用法: python3 bench_resolver.py [每种规模的匹配次数]'''
+
+__author__ = 'Engine'
+
+import os
+import sys
+import time
+import random
+import asyncio
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiohttp import web
+from aiohttp.test_utils import make_mocked_request
+
+import coroweb
+
+@asyncio.coroutine
+def handler(request):
+    return web.Response()
+
+def make_routes(n):
+    routes = []
+    for i in range(n):
+        routes.append(("/api/res%s/{id}" % i, "/api/res%s/42" % i))
+        routes.append(("/api/res%s/{id}/comments" % i, "/api/res%s/42/comments" % i))
+        routes.append(("/{user}/page%s" % i, "/someone/page%s" % i))
+    return routes
+
+def make_app(routes, radix):
+    app = web.Application()
+    if radix:
+        resource = coroweb.RadixResource()
+        for path, _ in routes:
+            resource.add_route("GET", path, handler)
+        app.router.register_resource(resource)
+    else:
+        for path, _ in routes:
+            app.router.add_route("GET", path, handler)
+    app.freeze()
+    return app
+
+@asyncio.coroutine
+def resolve_all(app, requests):
+    start = time.perf_counter()
+    for request in requests:
+        match_info = yield from app.router.resolve(request)
+        assert match_info.http_exception is None, request.path
+    return time.perf_counter() - start
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    loop = asyncio.get_event_loop()
+    for size in (10, 100, 1000):
+        routes = make_routes(size)
+        paths = [random.choice(routes)[1] for i in range(n)]
+        line = ["%5s routes" % len(routes)]
+        for name, radix in (("aiohttp", False), ("radix", True)):
+            app = make_app(routes, radix)
+            requests = [make_mocked_request("GET", path, app=app) for path in paths]
+            elapsed = loop.run_until_complete(resolve_all(app, requests))
+            line.append("%s %8.0f match/s" % (name, n / elapsed))
+        print("  ".join(line))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''路由分发基准测试
+对handlers.py中的每个路由,用签名相同但什么也不做的函数代替处理函数,
+构造请求直接交给coroweb.RequestHandler,测量分发层(取参数,校验,调用)每秒能处理的请求数.
+不经过http与数据库,只衡量框架本身的开销.
+
+用法: python3 bench_router.py [每个路由的请求数]'''
+
+__author__ = 'Engine'
+
+import os
+import re
+import sys
+import time
+import asyncio
+import functools
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import coroweb
+import handlers
+
+_RE_PATH_ARG = re.compile(r"{(\w+)}")
+
+# 模拟的请求,只提供RequestHandler用到的属性
+class FakeRequest(object):
+
+    def __init__(self, method, match_info, query_string="", body=None):
+        self.method = method
+        self.match_info = match_info
+        self.query_string = query_string
+        self.content_type = "application/json" if body is not None else ""
+        self._body = body
+
+    @asyncio.coroutine
+    def json(self):
+        return dict(self._body)
+
+    @asyncio.coroutine
+    def post(self):
+        return dict(self._body)
+
+# 代替处理函数: 签名与原函数相同(inspect.signature会通过__wrapped__取得原函数的签名),直接返回参数
+def make_stub(fn):
+    @functools.wraps(fn)
+    @asyncio.coroutine
+    def stub(*args, **kw):
+        return kw
+    return stub
+
+# 为路由构造一个能通过参数校验的请求
+def make_request(fn):
+    method, path = fn.__method__, fn.__route__
+    match_info = dict((name, "1") for name in _RE_PATH_ARG.findall(path))
+    named = [name for name in coroweb.get_named_kw_args(fn) if name not in match_info]
+    if method == "GET":
+        return FakeRequest(method, match_info, "&".join("%s=1" % name for name in named))
+    return FakeRequest(method, match_info, body=dict((name, "1") for name in named))
+
+def routes():
+    for attr in dir(handlers):
+        fn = getattr(handlers, attr)
+        if not attr.startswith("_") and callable(fn) and getattr(fn, "__route__", None):
+            yield fn
+
+@asyncio.coroutine
+def run(n):
+    results = []
+    for fn in routes():
+        handler = coroweb.RequestHandler(None, make_stub(fn))
+        request = make_request(fn)
+        r = yield from handler(request)
+        if not isinstance(r, dict):
+            raise RuntimeError("%s %s rejected: %s" % (fn.__method__, fn.__route__, r))
+        start = time.perf_counter()
+        for i in range(n):
+            yield from handler(request)
+        results.append((fn.__method__, fn.__route__, n / (time.perf_counter() - start)))
+    return results
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    loop = asyncio.get_event_loop()
+    start = time.perf_counter()
+    results = loop.run_until_complete(run(n))
+    elapsed = time.perf_counter() - start
+    for method, path, rate in results:
+        print("%-5s %-28s %9.0f req/s" % (method, path, rate))
+    print("total: %s routes, %.0f req/s" % (len(results), len(results) * n / elapsed))
+
+if __name__ == "__main__":
+    main()
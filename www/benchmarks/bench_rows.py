@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''行对象基准测试
+比较model实例(继承自dict)与紧凑的行对象(findAll(rows=True)返回的__slots__对象):
+    memory - 构造n个对象占用的内存(tracemalloc)
+    build  - 由查询结果(dict)构造n个对象的耗时
+    attr   - 对每个对象读取全部字段的耗时
+    json   - 序列化为json的耗时
+不需要数据库,查询结果由程序生成.
+
+用法: python3 bench_rows.py [对象数]'''
+
+__author__ = 'Engine'
+
+import os
+import sys
+import time
+import json
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import orm
+from models import User, next_id
+
+def make_rows(n):
+    return [dict(id=next_id(), email="user%s@example.com" % i, passwd="*" * 40, admin=False,
+                 name="user %s" % i, image="about:blank", created_at=time.time()) for i in range(n)]
+
+def build(cls, rows):
+    return [cls(**r) for r in rows]
+
+def measure(name, cls, rows):
+    tracemalloc.start()
+    objs = build(cls, rows)
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    start = time.perf_counter()
+    build(cls, rows)
+    t_build = time.perf_counter() - start
+
+    fields = list(rows[0].keys())
+    start = time.perf_counter()
+    for o in objs:
+        for f in fields:
+            getattr(o, f)
+    t_attr = time.perf_counter() - start
+
+    start = time.perf_counter()
+    # model实例本身就是dict,行对象则与app.py的response_middleware一样通过_asdict()序列化
+    json.dumps(dict(users=objs), ensure_ascii=False, default=orm.Row._asdict)
+    t_json = time.perf_counter() - start
+
+    print("%-8s memory %7.1fKB (%4d B/obj)  build %6.1fms  attr %6.1fms  json %6.1fms" % (
+        name, memory / 1024, memory / len(objs), t_build * 1000, t_attr * 1000, t_json * 1000))
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    rows = make_rows(n)
+    print("objects: %s" % n)
+    measure("model", User, rows)
+    measure("row", User.__row__, rows)
+
+if __name__ == "__main__":
+    main()
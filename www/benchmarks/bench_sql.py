@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''SQL编译缓存基准测试
+1. 每次查询在Python中组装与编译sql的开销: 逐次拼接列表并替换占位符(旧做法)与缓存编译结果(orm._select_sql, orm._prepare)
+2. sqlite后端每条连接的预处理语句缓存: 关闭(statement_cache=0)与开启时,findAll的吞吐量
+
+用法: python3 bench_sql.py [次数]'''
+
+__author__ = 'Engine'
+
+import os
+import sys
+import time
+import timeit
+import asyncio
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import orm
+import backends
+from models import Blog
+
+WHERE = "`user_id`=?"
+ORDER_BY = "created_at desc"
+
+# 旧做法: 每次调用都拼接语句并替换占位符
+def build_uncached():
+    sql = [Blog.__select__]
+    sql.append("where")
+    sql.append(WHERE)
+    sql.append("order by")
+    sql.append(ORDER_BY)
+    sql.append("limit")
+    sql.append("?, ?")
+    return " ".join(sql).replace("%", "%%").replace("?", "%s")
+
+def build_cached():
+    return orm._prepare(orm._select_sql(Blog.__select__, WHERE, ORDER_BY, 2))
+
+def bench_build(n):
+    # 使用mysql的占位符风格,无需安装aiomysql
+    orm._backend = backends.Backend()
+    assert build_uncached() == build_cached()
+    for name, fn in (("uncached", build_uncached), ("cached", build_cached)):
+        t = timeit.timeit(fn, number=n)
+        print("build %-9s %6.3fus/query" % (name, t / n * 1e6))
+
+@asyncio.coroutine
+def find_all(n):
+    start = time.perf_counter()
+    for i in range(n):
+        yield from Blog.findAll(WHERE, ["u%s" % (i % 10)], orderBy=ORDER_BY, limit=(0, 10))
+    return time.perf_counter() - start
+
+def bench_statements(n):
+    loop = asyncio.get_event_loop()
+    for statement_cache in (0, 256):
+        loop.run_until_complete(orm.create_pool(loop=loop, backend="sqlite", maxsize=1, statement_cache=statement_cache, batch_find=False))
+        elapsed = loop.run_until_complete(find_all(n))
+        print("sqlite statement_cache=%-4s %6.1fus/query" % (statement_cache, elapsed / n * 1e6))
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    bench_build(n)
+    bench_statements(max(n // 20, 100))
+
+if __name__ == "__main__":
+    main()
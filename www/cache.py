@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'进程内缓存,带容量上限与过期时间的LRU缓存'
+
+__author__ = 'Engine'
+
+import sys
+import time
+import threading
+from collections import OrderedDict
+
+# 用于区分"不存在"与"值为None"
+_MISSING = object()
+
+
+# LRU(least recently used)缓存,最近最少使用的条目最先被淘汰
+# maxsize - 最多缓存的条目数,为0时缓存被禁用,为None时不限条目数
+# ttl - 条目的存活时间(秒),为None时永不过期
+# maxbytes - 缓存占用内存的上限(字节),为None时不限.超出上限时同样从最久未使用的条目开始淘汰
+# sizeof - 计算键或值所占内存的函数,默认为sys.getsizeof
+class LRUCache(object):
+
+    def __init__(self, maxsize=128, ttl=None, maxbytes=None, sizeof=sys.getsizeof):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.maxbytes = maxbytes
+        self._sizeof = sizeof
+        # OrderedDict保持插入顺序,每次命中都将条目移到末尾,因此最前面的就是最久未使用的
+        # 值为(value, expires, nbytes)元组
+        self._data = OrderedDict()
+        self._bytes = 0
+        # 缓存可能同时被事件循环与线程池访问,加锁保证一致
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING, count=False) is not _MISSING
+
+    # 缓存当前占用的内存(字节),仅在指定了maxbytes时统计
+    @property
+    def bytes(self):
+        return self._bytes
+
+    # 取得缓存值,若不存在或已过期,返回default
+    # count - 是否计入命中统计
+    def get(self, key, default=None, count=True):
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                value, expires, nbytes = item
+                if expires is None or expires > time.monotonic():
+                    self._data.move_to_end(key)
+                    if count:
+                        self.hits += 1
+                    return value
+                # 已过期,直接删除
+                del self._data[key]
+                self._bytes -= nbytes
+            if count:
+                self.misses += 1
+            return default
+
+    # 设置缓存值, ttl可覆盖缓存默认的存活时间
+    def set(self, key, value, ttl=None):
+        if self.maxsize is not None and self.maxsize <= 0:
+            return
+        nbytes = 0
+        if self.maxbytes is not None:
+            nbytes = self._sizeof(key) + self._sizeof(value)
+            # 单个条目就超过了内存上限,不缓存,以免把其他条目全部挤出去
+            if nbytes > self.maxbytes:
+                self.pop(key)
+                return
+        ttl = self.ttl if ttl is None else ttl
+        expires = None if ttl is None else time.monotonic() + ttl
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self._bytes -= old[2]
+            self._data[key] = (value, expires, nbytes)
+            self._bytes += nbytes
+            # 超出容量,从最久未使用的条目开始淘汰
+            while (self.maxsize is not None and len(self._data) > self.maxsize) or \
+                    (self.maxbytes is not None and self._bytes > self.maxbytes):
+                _, item = self._data.popitem(last=False)
+                self._bytes -= item[2]
+                self.evictions += 1
+
+    # 删除缓存值,返回被删除的值,不存在时返回default
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._data.pop(key, None)
+            if item is None:
+                return default
+            self._bytes -= item[2]
+            return item[0]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    # 返回缓存的统计信息,以dict形式方便直接输出为json
+    def stats(self):
+        total = self.hits + self.misses
+        return dict(
+            size = len(self._data),
+            maxsize = self.maxsize,
+            bytes = self._bytes,
+            maxbytes = self.maxbytes,
+            hits = self.hits,
+            misses = self.misses,
+            evictions = self.evictions,
+            hit_ratio = (self.hits / total) if total else 0.0
+        )
+
+    def __str__(self):
+        return "<LRUCache %s>" % ", ".join("%s: %s" % (k, v) for k, v in self.stats().items())
+
+    __repr__ = __str__
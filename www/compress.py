@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''响应压缩
+根据请求的Accept-Encoding选择压缩算法: 优先brotli(需要安装brotli模块),其次gzip.
+动态响应在app.py的compress_middleware中压缩,静态文件则由fabfile.build预先压缩为.br/.gz文件,
+coroweb.add_static直接返回压缩好的文件.
+压缩是纯CPU运算,较大的body交给线程池压缩(zlib与brotli压缩时都会释放GIL),不阻塞事件循环.'''
+
+__author__ = 'Engine'
+
+import zlib
+import asyncio
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# 值得压缩的内容类型,图片,字体(woff/woff2)等已经压缩过的格式不在其中
+COMPRESSIBLE_TYPES = ("text/", "application/json", "application/javascript", "application/xml", "image/svg+xml",
+                      "font/ttf", "font/otf", "application/vnd.ms-fontobject")
+
+# 支持的压缩算法,按优先级排列
+ENCODINGS = ("br", "gzip") if brotli is not None else ("gzip",)
+
+# 预压缩的静态文件的扩展名
+SUFFIXES = {"br": ".br", "gzip": ".gz"}
+
+def compressible(content_type):
+    return content_type is not None and content_type.startswith(COMPRESSIBLE_TYPES)
+
+# 根据Accept-Encoding选择压缩算法,客户端不接受任何支持的算法时返回None
+# 例如"gzip, deflate, br"选择br; "gzip;q=0"表示不接受gzip; "*"表示接受任何算法
+# encodings - 可选的算法,默认为全部支持的算法
+def negotiate(accept_encoding, encodings=ENCODINGS):
+    if not accept_encoding:
+        return None
+    accepted = {}
+    for item in accept_encoding.lower().split(","):
+        name, _, params = item.partition(";")
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        accepted[name.strip()] = q
+    best, best_q = None, 0.0
+    for encoding in encodings:
+        q = accepted.get(encoding, accepted.get("*", 0.0))
+        # q相同时按encodings的优先级
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
+
+# 压缩body, level为gzip的压缩级别(1-9)或brotli的quality(0-11)
+# wbits=31时zlib直接输出gzip格式,头部的mtime为0,相同的内容总是得到相同的结果
+def compress(body, encoding, level=6):
+    if encoding == "br":
+        return brotli.compress(body, quality=level)
+    if encoding == "gzip":
+        c = zlib.compressobj(level, zlib.DEFLATED, 31)
+        return c.compress(body) + c.flush()
+    raise ValueError("Unsupported encoding: %s" % encoding)
+
+# 压缩body,可在协程中通过yield from等待结果
+# 小于offload_size的body直接压缩,更大的交给线程池,省去小body在线程间切换的开销
+@asyncio.coroutine
+def compress_async(body, encoding, level=6, offload_size=64 * 1024, loop=None):
+    if len(body) < offload_size:
+        return compress(body, encoding, level)
+    loop = loop or asyncio.get_event_loop()
+    return (yield from loop.run_in_executor(None, compress, body, encoding, level))
@@ -7,13 +7,52 @@ __author__ = 'Engine'
 
 configs = {
     'db': {  # 定义数据库相关信息
+        "backend": "mysql",   # 数据库后端: "mysql"(aiomysql)或"sqlite"(内嵌的sqlite3,无需MySQL,用于基准测试)
+        "path": ":memory:",   # sqlite后端的数据库文件路径,":memory:"为内存数据库,启动时按schema.sql自动建表
+        "statement_cache": 256,  # sqlite后端每条连接缓存的预处理语句数(aiomysql不支持服务器端预处理语句)
         "host": "127.0.0.1",
         "port": 3306,
         "user": "www-data",
         "password": "www-data",
-        "database": "awesome"
+        "database": "awesome",
+        "count_ttl": 60,    # 分页所用的表行数缓存的最长存活时间(秒),设为0则每次都查询数据库
+        "batch_find": True, # 是否将同一时刻按主键的查询合并为一条查询
+        "slow_query_ms": 200, # 慢查询阈值(毫秒),超过该值的查询将记录到日志,设为None则不记录
+        "query_cache_bytes": 0,  # 查询结果缓存的内存上限(字节),设为0则关闭.任何增删改都会使被修改的表的缓存失效
+        "query_cache_ttl": 60,   # 查询结果缓存的最长存活时间(秒),有从库时也是缓存结果可能落后于主库的最长时间
+        "charset": "utf8",
+        "autocommit": True,
+        "minsize": 1,         # 连接池最小连接数,启动时即建立好这些连接
+        "maxsize": 10,        # 连接池最大连接数
+        "adaptive": False,    # 是否根据获取连接的等待时间,在minsize与maxsize之间自动调整连接池大小
+        "adaptive_interval": 5,  # 自适应调整的检查间隔(秒)
+        "adaptive_wait_ms": 10,  # 获取连接的平均等待时间超过该值(毫秒)时,扩大连接池
+        # 从库列表,每项为一个dict,只需写出与主库不同的连接参数,例如{"host": "10.0.0.2", "port": 3306}
+        # 查询将被分发到从库,增删改,事务以及读己之写时间窗口内的查询仍在主库执行
+        "replicas": [],
+        "read_policy": "round_robin",  # 分发查询的策略: "round_robin"(轮询)或"least_outstanding"(正在使用的连接最少者优先)
+        "read_your_writes": 5          # 用户写入之后,其查询在主库执行的时间窗口(秒)
         },
     "session": { # 定义会话信息
-        "secret": "AwEsOmE"
+        "secret": "AwEsOmE",
+        "cache_size": 1024,  # 会话缓存最多缓存的用户数,设为0则关闭会话缓存
+        "cache_ttl": 60      # 会话缓存中用户信息的存活时间(秒)
+        },
+    "render": { # 定义内容渲染相关信息
+        "markdown_cache_bytes": 32 * 1024 * 1024, # markdown渲染缓存的内存上限(字节),设为0则关闭
+        "text_cache_bytes": 4 * 1024 * 1024,      # 评论文本转html缓存的内存上限(字节),设为0则关闭
+        "workers": 0,                             # markdown渲染进程池的进程数,设为0则在事件循环中直接渲染
+        "inline_threshold": 32 * 1024             # 小于该长度(字符数)的内容不交给进程池,直接渲染
+        },
+    "page_cache": { # 整页缓存,只缓存匿名访客访问声明了@cache_page的页面
+        "max_bytes": 16 * 1024 * 1024, # 缓存页面的内存上限(字节),设为0则关闭
+        "stale": 30                    # 页面过期后仍可返回旧页面(同时在后台重新生成)的时间窗口(秒)
+        },
+    "compress": { # 动态响应的压缩,静态文件由fabfile.build预先压缩
+        "min_size": 1024,          # 小于该长度(字节)的响应不压缩,压缩的收益抵不上开销
+        "offload_size": 64 * 1024, # 大于该长度(字节)的响应交给线程池压缩
+        "gzip_level": 6,           # gzip压缩级别(1-9)
+        "brotli_quality": 4,       # brotli压缩质量(0-11),动态响应取较低的值以节省CPU;需安装brotli模块
+        "cache_bytes": 8 * 1024 * 1024  # 压缩结果缓存的内存上限(字节),按(body的摘要, 编码)缓存,设为0则关闭
         }
     }
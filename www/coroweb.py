@@ -10,9 +10,12 @@ import asyncio
 import os
 import inspect #the module provides several useful functions to help get informationabout live objects
 import logging
+import mimetypes
+import re
 from urllib import parse # 从urllib导入解析模块
 from aiohttp import web
 from apis import APIError #导入自定义的api错误模块
+import compress
 
 # 定义了一个装饰器
 # 将一个函数映射为一个URL处理函数
@@ -44,6 +47,35 @@ def post(path):
         return wrapper
     return decorator
 
+# 声明url处理函数的响应可以整页缓存(见app.py的page_cache_middleware),须写在@get之上
+# ttl - 缓存页面的新鲜时间(秒),过期后在stale窗口内仍可返回旧页面,同时在后台重新生成
+# 只有匿名访客的页面会被缓存,登录用户的页面包含其个人信息
+def cache_page(ttl):
+    def decorator(func):
+        func.__cache_ttl__ = ttl
+        return func
+    return decorator
+
+# 为url处理函数声明校验器,用于条件GET(见app.py的response_middleware),须写在@get之上
+# validator(request)是一个协程,在处理函数之前执行,返回(version, last_modified):
+#   version - 响应内容的版本,可以是任意能repr的值,内容改变时它也必须改变
+#   last_modified - 内容的最后修改时间(时间戳),无法确定时为None
+# 返回None表示无法校验(如资源不存在),照常执行处理函数
+# 客户端缓存的版本未改变时直接返回304,处理函数不再执行
+def conditional(validator):
+    def decorator(func):
+        func.__validator__ = validator
+        return func
+    return decorator
+
+# 取得请求所对应的url处理函数上声明的属性,如cache_page声明的__cache_ttl__
+# 未匹配到处理函数(如404)或处理函数未声明该属性时,返回default
+def handler_attr(request, name, default=None):
+    handler = getattr(request.match_info, "handler", None)
+    # 路由中注册的是RequestHandler的__call__方法(见add_route),由它找到RequestHandler
+    handler = getattr(handler, "__self__", handler)
+    return getattr(getattr(handler, "_func", None), name, default)
+
 # 获取函数的值为空的命名关键字
 def get_required_kw_args(fn):
     args = []
@@ -106,6 +138,8 @@ def has_request_arg(fn):
 # 定义RequestHandler类,封装url处理函数
 # RequestHandler的目的是从url函数中分析需要提取的参数,从request中获取必要的参数
 # 调用url参数,将结果转换为web.response
+# 处理函数的签名不会改变,因此在注册路由时(创建RequestHandler时)就分析好签名,
+# 并选定取参数的方法(binder),处理请求时不必再逐个判断
 class RequestHandler(object):
 
     def __init__(self, app, fn):
@@ -119,95 +153,344 @@ class RequestHandler(object):
         self._named_kw_args = get_named_kw_args(fn)
         self._required_kw_args = get_required_kw_args(fn)
 
+        # 只接收命名关键字参数的,请求中的其他参数将被丢弃;有**kw的全部保留
+        self._accepted_kw_args = None if self._has_var_kw_arg or not self._named_kw_args else frozenset(self._named_kw_args)
+        # 选择取参数的方法
+        # _bind不读取请求体,可以直接调用;只有POST请求的处理函数才需要读取请求体(_reads_body)
+        self._reads_body = False
+        if not (self._has_var_kw_arg or self._has_named_kw_args or self._required_kw_args):
+            # 没有关键字参数的,只需要路径中的参数,直接使用match_info,不必复制
+            self._bind = self._bind_match_info
+        else:
+            # GET请求没有请求体,只解析查询字符串
+            self._bind = self._bind_query
+            self._reads_body = getattr(fn, "__method__", None) != "GET"
+
+    # 将路径中的参数并入kw,只有命名关键字参数的,丢弃其他参数
+    def _merge(self, kw, request):
+        if self._accepted_kw_args is not None:
+            kw = dict((k, v) for k, v in kw.items() if k in self._accepted_kw_args)
+        # 遍历request.match_info(abstract math info), 若其key又存在于kw中,发出重复参数警告
+        for k, v in request.match_info.items():
+            if k in kw:
+                logging.warning("Duplicate arg name in named arg and kw args: %s" % k)
+            # 用math_info的值覆盖kw中的原值
+            kw[k] = v
+        # request参数由__call__传入,不允许被请求中的同名参数覆盖
+        if self._has_request_arg:
+            kw.pop("request", None)
+        return kw
+
+    def _bind_match_info(self, request):
+        return request.match_info
+
+    def _bind_query(self, request):
+        # request.query_string表示url中的查询字符串
+        # 比如"https://www.google.com/#newwindow=1&q=google",其中q=google就是query_string
+        qs = request.query_string
+        if not qs:
+            return request.match_info
+        # 解析query_string,以字典的形如储存到kw变量中
+        return self._merge(dict((k, v[0]) for k, v in parse.parse_qs(qs, True).items()), request)
+
+    @asyncio.coroutine
+    def _bind_body(self, request):
+        # http method 为post, 但request的content type为空, 返回丢失信息
+        if not request.content_type:
+            raise web.HTTPBadRequest(text="Missing Content-Type")
+        ct = request.content_type.lower() # 获得content type字段
+        # 以下为检查post请求的content type字段
+        # application/json表示消息主体是序列化后的json字符串
+        if ct.startswith("application/json"):
+            params = yield from request.json() # request.json方法的作用是读取request body, 并以json格式解码
+            if not isinstance(params, dict): # 解码得到的参数不是字典类型, 返回提示信息
+                raise web.HTTPBadRequest(text="JSON body must be object.")
+            kw = params # post, content type字段指定的消息主体是json字符串,且解码得到参数为字典类型的,将其赋给变量kw
+        # 以下2种content type都表示消息主体是表单
+        elif ct.startswith("application/x-www-form-urlencoded") or ct.startswith("multipart/form-data"):
+            # request.post方法从request body读取POST参数,即表单信息,并包装成字典赋给kw变量
+            params = yield from request.post()
+            kw = dict(**params)
+        else:
+            # 此处我们只处理以上三种post 提交数据方式
+            raise web.HTTPBadRequest(text="Unsupported Content-Type: %s" % request.content_type)
+        return self._merge(kw, request)
 
     # 定义了__call__,则其实例可以被视为函数
     # 此处参数为request
     @asyncio.coroutine
     def __call__(self, request):
-
-        kw = None # 设不存在关键字参数
-
-        # 存在关键字参数/命名关键字参数
-        if self._has_var_kw_arg or self._has_named_kw_args or self._required_kw_args:
-
-            # http method 为 post的处理
-            if request.method == "POST":
-                # http method 为post, 但request的content type为空, 返回丢失信息
-                if not request.content_type:
-                    return web.HTTPBadRequest("Missing Content-Type")
-                ct = request.content_type.lower() # 获得content type字段
-                # 以下为检查post请求的content type字段
-                # application/json表示消息主体是序列化后的json字符串
-                if ct.startswith("application/json"):
-                    params = yield from request.json() # request.json方法的作用是读取request body, 并以json格式解码
-                    if not isinstance(params, dict): # 解码得到的参数不是字典类型, 返回提示信息
-                        return web.HTTPBadRequest("JSON body must be object.")
-                    kw = params # post, content type字段指定的消息主体是json字符串,且解码得到参数为字典类型的,将其赋给变量kw
-                # 以下2种content type都表示消息主体是表单
-                elif ct.startswith("application/x-www-form-urlencoded") or ct.startswith("multipart/form-data"):
-                    # request.post方法从request body读取POST参数,即表单信息,并包装成字典赋给kw变量
-                    params = yield from request.post()
-                    kw = dict(**params)
-                else:
-                    # 此处我们只处理以上三种post 提交数据方式
-                    return web.HTTPBadRequest("Unsupported Content-Type: %s" % request.content_type)
-
-            # http method 为 get的处理
-            if request.method == "GET":
-                # request.query_string表示url中的查询字符串
-                # 比如"https://www.google.com/#newwindow=1&q=google",其中q=google就是query_string
-                qs = request.query_string
-                if qs:
-                    kw = dict() # 原来为None的kw变成字典
-                    for k, v in parse.parse_qs(qs, True).items(): # 解析query_string,以字典的形如储存到kw变量中
-                        kw[k] = v[0]
-        if kw is None: # 经过以上处理, kw仍未空,即以上全部不匹配,则获取请求的abstract math info(抽象数学信息),好吧,我也不知道这是什么鬼东西,并以字典形式存入kw
-            kw = dict(**request.match_info)
+        if self._reads_body and request.method == "POST":
+            kw = yield from self._bind_body(request)
         else:
-            # kw 不为空,且requesthandler只存在命名关键字的,则只取命名关键字参数名放入kw
-            if not self._has_var_kw_arg and self._named_kw_args:
-                copy = dict()
-                for name in self._named_kw_args:
-                    if name in kw:
-                        copy[name] = kw[name]
-                kw = copy
-            # 遍历request.match_info(abstract math info), 若其key又存在于kw中,发出重复参数警告
-            for k, v in request.match_info.items():
-                if k in kw:
-                    logging.warning("Duplicate arg name in named arg and kw args: %s" % k)
-                # 用math_info的值覆盖kw中的原值
-                kw[k] = v
-        # 若存在"request"关键字, 则添加
-        if self._has_request_arg:
-            kw["request"] = request
+            kw = self._bind(request)
         # 若存在未指定值的命名关键字参数,且参数名未在kw中,返回丢失参数信息
-        if self._required_kw_args:
-            for name in self._required_kw_args:
-                if not name in kw:
-                    return web.HTTPBadRequest()
-                    # return web.HTTPBadRequest("Missing argument: %s" % name)
-        logging.info("call with args: %s" % str(kw))
+        for name in self._required_kw_args:
+            if not name in kw:
+                raise web.HTTPBadRequest(text="Missing argument: %s" % name)
+        if logging.getLogger().isEnabledFor(logging.INFO):
+            logging.info("call with args: %s" % str(kw))
         # 以上过程即为从request中获得必要的参数
 
         # 以下调用handler处理,并返回response.
+        # 若存在"request"关键字, 则一并传入
         try:
-            r = yield from self._func(**kw)
+            if self._has_request_arg:
+                r = yield from self._func(request=request, **kw)
+            else:
+                r = yield from self._func(**kw)
             return r
         except APIError as e:
             return dict(error = e.error, data = e.data, message = e.message)
 
+# 路径参数的类型转换器,写作{name:type},例如/api/blogs/{id:hex}, /page/{n:int}
+# 转换器接收路径中的一段,返回转换后的值,不匹配时抛出ValueError
+def _str_segment(s):
+    if not s:
+        raise ValueError(s)
+    return s
+
+def _int_segment(s):
+    if not (s.isascii() and s.isdigit()):
+        raise ValueError(s)
+    return int(s)
+
+# 十六进制字符串,如next_id生成的id,值仍为字符串
+def _hex_segment(s):
+    int(s, 16)
+    return s
+
+SEGMENT_CONVERTERS = {
+    "str": _str_segment,
+    "int": _int_segment,
+    "hex": _hex_segment
+}
+
+# 路径参数: {name}, {name:type}或{name:正则表达式}(与aiohttp的写法兼容)
+_RE_SEGMENT_PARAM = re.compile(r"{(\w+)(?::((?:[^{}]|{[^{}]*})*))?}")
+
+# 将包含参数的一段路径编译为转换器,返回的转换器接收一段路径,返回参数dict
+def _compile_segment(segment):
+    m = _RE_SEGMENT_PARAM.fullmatch(segment)
+    if m is not None and (m.group(2) is None or m.group(2) in SEGMENT_CONVERTERS):
+        name, convert = m.group(1), SEGMENT_CONVERTERS[m.group(2) or "str"]
+        return lambda s: {name: convert(s)}
+    # 正则表达式参数,或参数与文字混合的一段(如"item{id}"),编译为一个正则表达式
+    pattern, pos = [], 0
+    for m in _RE_SEGMENT_PARAM.finditer(segment):
+        pattern.append(re.escape(segment[pos:m.start()]))
+        pattern.append("(?P<%s>%s)" % (m.group(1), m.group(2) or "[^{}/]+"))
+        pos = m.end()
+    pattern.append(re.escape(segment[pos:]))
+    regex = re.compile("".join(pattern))
+    def convert(s):
+        m = regex.fullmatch(s)
+        if m is None:
+            raise ValueError(s)
+        return m.groupdict()
+    return convert
+
+# 路由树的节点,每个节点对应路径中的一段
+class _RouteNode(object):
+
+    __slots__ = ("static", "params", "tail", "routes")
+
+    def __init__(self):
+        self.static = {}     # 文字段 => 子节点
+        self.params = []     # [(参数段, 转换器, 子节点)],按注册顺序尝试
+        self.tail = None     # {name:path}参数,匹配剩余的全部路径: (参数名, 子节点)
+        self.routes = {}     # http method => 路由
+
+# 路由树(前缀树): 路径按"/"分段,每段对应树的一层
+# 匹配时从根节点开始,每段只选择一个子节点: 先查文字子节点(一次dict查找),没有时再按注册顺序
+# 取第一个能转换该段的参数子节点,都没有时才由{name:path}匹配剩余的全部路径.
+# 选定之后不再回头尝试其他子节点,因此匹配的代价只与路径的段数有关,与路由的数量无关.
+# 代价是文字段总是优先: 注册了/api/blogs/new时,/api/blogs/new/comments不会再匹配/api/blogs/{id}/comments
+# aiohttp的默认路由对带参数的路由逐个尝试正则表达式,路由越多越慢
+class RadixRouter(object):
+
+    def __init__(self):
+        self._root = _RouteNode()
+
+    # 注册路由, route可以是任意对象,匹配时原样返回
+    def add(self, method, path, route):
+        if not path.startswith("/"):
+            raise ValueError("path must start with /: %s" % path)
+        node = self._root
+        segments = path[1:].split("/")
+        for i, segment in enumerate(segments):
+            if "{" not in segment:
+                node = node.static.setdefault(segment, _RouteNode())
+                continue
+            m = _RE_SEGMENT_PARAM.fullmatch(segment)
+            if m is not None and m.group(2) == "path":
+                if i != len(segments) - 1:
+                    raise ValueError("{%s:path} must be the last segment: %s" % (m.group(1), path))
+                if node.tail is None:
+                    node.tail = (m.group(1), _RouteNode())
+                node = node.tail[1]
+                break
+            for seg, _, child in node.params:
+                if seg == segment:
+                    node = child
+                    break
+            else:
+                child = _RouteNode()
+                node.params.append((segment, _compile_segment(segment), child))
+                node = child
+        if method in node.routes:
+            raise ValueError("Duplicate route: %s %s" % (method, path))
+        node.routes[method] = route
+
+    # 匹配路径,返回(method => 路由的dict, 路径参数), 没有匹配的路径返回(None, None)
+    # path为未解码的路径(如request.rel_url.raw_path),先按"/"分段再逐段解码,
+    # 因此参数中的%2F仍属于同一段,与aiohttp默认路由的结果一致
+    def match(self, path):
+        params = {}
+        node = self._root
+        segments = path[1:].split("/")
+        for i, raw in enumerate(segments):
+            segment = parse.unquote(raw)
+            child = node.static.get(segment)
+            if child is None:
+                for _, convert, c in node.params:
+                    try:
+                        values = convert(segment)
+                    except ValueError:
+                        continue
+                    params.update(values)
+                    child = c
+                    break
+            if child is None:
+                if node.tail is None:
+                    return None, None
+                params[node.tail[0]] = parse.unquote("/".join(segments[i:]))
+                node = node.tail[1]
+                break
+            node = child
+        if not node.routes:
+            return None, None
+        return node.routes, params
+
+# RadixResource中的路由
+# 只用到aiohttp公开的AbstractRoute接口,路由没有名字,也不能反向生成url
+class RadixRoute(web.AbstractRoute):
+
+    def __init__(self, method, handler, resource, path):
+        super().__init__(method, handler, resource=resource)
+        self._path = path
+
+    @property
+    def name(self):
+        return None
+
+    def url_for(self, *args, **kwargs):
+        raise RuntimeError("RadixRoute does not support url_for")
+
+    def get_info(self):
+        return {"path": self._path}
+
+    def __repr__(self):
+        return "<RadixRoute [%s] %s -> %r>" % (self.method, self._path, self.handler)
+
+# 以RadixRouter实现的aiohttp资源,所有url处理函数都注册在这一个资源中
+# aiohttp按路径前缀查找资源,该资源的前缀为"/",因此/static/等前缀更长的资源会先被匹配
+# 只用到aiohttp公开的AbstractResource, AbstractRoute与UrlMappingMatchInfo接口
+class RadixResource(web.AbstractResource):
+
+    def __init__(self, *, name=None):
+        super().__init__(name=name)
+        self._router = RadixRouter()
+        self._routes = []
+
+    @property
+    def canonical(self):
+        return "/"
+
+    def add_route(self, method, path, handler):
+        route = RadixRoute(method, handler, self, path)
+        self._router.add(method, path, route)
+        self._routes.append(route)
+        return route
+
+    @asyncio.coroutine
+    def resolve(self, request):
+        routes, params = self._router.match(request.rel_url.raw_path)
+        if routes is None:
+            return None, set()
+        route = routes.get(request.method)
+        if route is None:
+            return None, set(routes)
+        return web.UrlMappingMatchInfo(params, route), set(routes)
+
+    def url_for(self, **kwargs):
+        raise RuntimeError("RadixResource does not support url_for")
+
+    def add_prefix(self, prefix):
+        raise RuntimeError("RadixResource does not support sub-applications")
+
+    def get_info(self):
+        return {"routes": len(self._routes)}
+
+    def raw_match(self, path):
+        return False
+
+    def __len__(self):
+        return len(self._routes)
+
+    def __iter__(self):
+        return iter(self._routes)
+
+# 按StaticHandler选定的编码返回文件
+# aiohttp的FileResponse会按请求的Accept-Encoding自行查找同名的.gz(新版本还有.br)文件,且只检查其中是否出现"gzip"等字样,
+# 不理会q=0.编码已经由StaticHandler协商好了,因此让FileResponse看到的请求不带Accept-Encoding
+class _NegotiatedFileResponse(web.FileResponse):
+
+    @asyncio.coroutine
+    def prepare(self, request):
+        headers = request.headers.copy()
+        headers.popall("Accept-Encoding", None)
+        return (yield from super().prepare(request.clone(headers=headers)))
+
+# 静态文件处理函数
+# 客户端接受压缩且存在预先压缩好的同名.br/.gz文件(见fabfile.build)时,直接返回压缩文件,不必每次压缩
+# 可压缩类型的文件都带有Vary: Accept-Encoding,使中间的缓存按Accept-Encoding分别缓存
+class StaticHandler(object):
+
+    def __init__(self, root):
+        self._root = os.path.realpath(root)
+
+    @asyncio.coroutine
+    def __call__(self, request):
+        path = os.path.realpath(os.path.join(self._root, request.match_info["filename"]))
+        # 不允许访问静态目录之外的文件,如/static/../config.py
+        if not path.startswith(self._root + os.sep) or not os.path.isfile(path):
+            raise web.HTTPNotFound()
+        content_type, _ = mimetypes.guess_type(path)
+        headers = {"Content-Type": content_type or "application/octet-stream"}
+        if compress.compressible(content_type):
+            headers["Vary"] = "Accept-Encoding"
+            # 预压缩的文件不需要在运行时压缩,因此即使没有安装brotli模块也可以返回.br文件
+            encodings = [e for e in ("br", "gzip") if os.path.isfile(path + compress.SUFFIXES[e])]
+            encoding = compress.negotiate(request.headers.get("Accept-Encoding"), encodings)
+            if encoding is not None:
+                path += compress.SUFFIXES[encoding]
+                headers["Content-Encoding"] = encoding
+        return _NegotiatedFileResponse(path, headers=headers)
+
 def add_static(app):
     # os.path.abspath(__file__), 返回当前脚本的绝对路径(包括文件名)
     # os.path.dirname(), 去掉文件名,返回目录路径
     # os.path.join(), 将分离的各部分组合成一个路径名
     # 因此以下操作就是将本文件同目录下的static目录(即www/static/)加入到应用的路由管理器中
     path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
-    app.router.add_static("/static/", path)
+    app.router.add_route("GET", "/static/{filename:.+}", StaticHandler(path).__call__)
     logging.info("add static %s => %s" % ("/static/", path))
 
 # 将处理函数注册到app上
 # 处理将针对http method 和path进行
-def add_route(app, fn):
+# 指定了resource(RadixResource)的,注册到该资源的路由树中,否则注册到aiohttp的默认路由
+def add_route(app, fn, resource=None):
     method = getattr(fn, "__method__", None) # 获取fn.__method__属性,若不存在将返回None
     path = getattr(fn, "__route__", None) # 同上
     # http method 或 path 路径未知,将无法进行处理,因此报错
@@ -218,10 +501,17 @@ def add_route(app, fn):
         fn = asyncio.coroutine(fn)
     logging.info("add route %s %s => %s(%s)" % (method, path, fn.__name__, '. '.join(inspect.signature(fn).parameters.keys())))
     # 注册request handler
-    app.router.add_route(method, path, RequestHandler(app, fn))
+    # 注册的是RequestHandler实例的__call__方法: 它是协程函数,aiohttp会直接调用它,
+    # 而RequestHandler实例本身不是,aiohttp会把它当作普通函数包装,要求其返回值必须是响应
+    handler = RequestHandler(app, fn).__call__
+    if resource is not None:
+        resource.add_route(method, path, handler)
+    else:
+        app.router.add_route(method, path, handler)
 
 # 自动注册所有请求处理函数
-def add_routes(app, module_name):
+# radix为True时,所有处理函数注册到一个路由树(RadixResource)中,为False时逐个注册到aiohttp的默认路由
+def add_routes(app, module_name, radix=True):
     n = module_name.rfind(".") # n 记录模块名中最后一个.的位置
     if n == (-1): # -1 表示未找到,即module_name表示的模块直接导入
         # __import__()的作用同import语句,python官网说强烈不建议这么做
@@ -236,6 +526,7 @@ def add_routes(app, module_name):
         # 以下语句表示, 先用__import__表达式导入模块以及子模块
         # 再通过getattr()方法取得子模块名, 如datetime.datetime
         mod = getattr(__import__(module_name[:n], globals(), locals(), [name]), name)
+    resource = RadixResource() if radix else None
     # 遍历模块目录
     for attr in dir(mod):
         # 忽略以_开头的属性与方法,_xx或__xx(前导1/2个下划线)指示方法或属性为私有的,__xx__指示为特殊变量
@@ -250,4 +541,6 @@ def add_routes(app, module_name):
             path = getattr(fn, "__route__",None)
             # 注册request handler, 与add.router.add_route(method, path, handler)一样的
             if method and path:
-                add_route(app, fn)
+                add_route(app, fn, resource)
+    if resource is not None:
+        app.router.register_resource(resource)
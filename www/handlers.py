@@ -14,9 +14,12 @@ import base64
 import asyncio
 import markdown2
 from aiohttp import web
-from coroweb import get, post # 导入装饰器,这样就能很方便的生成request handler
+import orm
+import render
+from coroweb import get, post, cache_page, conditional # 导入装饰器,这样就能很方便的生成request handler
 from models import User, Comment, Blog, next_id
-from apis import APIResourceNotFoundError, APIValueError, APIError, APIPermissionError, Page
+from cache import LRUCache
+from apis import APIResourceNotFoundError, APIValueError, APIError, APIPermissionError, Page, CursorPage, decode_cursor
 from config import configs
 
 
@@ -30,6 +33,33 @@ _COOKIE_KEY = configs.session.secret   # cookie密钥,作为加密cookie的原
 _RE_EMAIL = re.compile(r'^[a-z0-9\.\-\_]+\@[a-z0-9\-\_]+(\.[a-z0-9\-\_]+){1,4}$')
 _RE_SHA1 = re.compile(r'[0-9a-f]{40}$')
 
+# 博客列表只显示标题与摘要,正文及其渲染结果(都是mediumtext)不必从数据库取出
+LISTING_DEFER = ("content", "html_content")
+
+# 会话缓存,以用户id为键,缓存从数据库中取得的用户记录(包括加密后的密码,用于验证cookie)
+# 这样,带cookie的请求就不必每次都查询数据库了
+_session_cache = LRUCache(configs.session.cache_size, configs.session.cache_ttl)
+
+# 用户记录变更时,使会话缓存中对应的用户失效
+@orm.add_listener
+def _invalidate_session(model, action):
+    if isinstance(model, User):
+        _session_cache.pop(model.id)
+    elif model is User:  # 批量删除用户,无法知道删除了哪些,清空缓存
+        _session_cache.clear()
+
+# markdown渲染缓存,以内容的摘要为键,按占用的内存大小淘汰
+# 即使有人发布了一篇超大的博客,缓存占用的内存也不会超过上限
+_markdown_cache = LRUCache(None, maxbytes=configs.render.markdown_cache_bytes)
+markdown2.set_convert_cache(_markdown_cache)
+
+# 评论文本转html的缓存,以评论文本本身为键
+_text_cache = LRUCache(None, maxbytes=configs.render.text_cache_bytes)
+
+# 返回各缓存的命中统计
+def cache_stats():
+    return dict(session=_session_cache.stats(), markdown=_markdown_cache.stats(), text=_text_cache.stats(), query=orm.query_cache_stats())
+
 # 验证用户身份
 def check_admin(request):
     # 检查用户是否管理员
@@ -54,9 +84,40 @@ def text2html(text):
     '''文本转html'''
     # 先用filter函数对输入的文本进行过滤处理: 断行,去首尾空白字符
     # 再用map函数对特殊符号进行转换,在将字符串装入html的<p>标签中
+    # 相同的评论文本会被反复转换,先查缓存
+    html = _text_cache.get(text)
+    if html is not None:
+        return html
     lines = map(lambda s: '<p>%s</p>' % s.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;'), filter(lambda s: s.strip() != '', text.split('\n')))
     # lines是一个字符串列表,将其组装成一个字符串,该字符串即表示html的段落
-    return ''.join(lines)
+    html = ''.join(lines)
+    _text_cache.set(text, html)
+    return html
+
+# 计算文本的摘要,用于判断博客内容在渲染html之后是否发生了变化
+def content_digest(text):
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+# 将博客内容(markdown格式)渲染为html,并记录渲染时内容的摘要
+# 较大的博客将交给渲染进程池(见render.py),不会阻塞事件循环
+@asyncio.coroutine
+def render_blog(blog):
+    blog.html_content = yield from render.markdown(blog.content)
+    blog.content_hash = content_digest(blog.content)
+
+# 将渲染结果写回数据库,只写html,摘要与修改时间三列,不写整行
+# 渲染期间博客可能已被修改,读到的记录也可能来自落后的只读副本,写回整行会覆盖较新的修改,
+# 因此以正文为条件:正文已变的不写回,留给下一次读取重新渲染;已由别处写回过的也不再重复写
+# html只是正文的派生数据,博客列表与首页都不含html,因此不通知监听器,以免每次补写都清空整页缓存
+# 修改时间随之更新,使博客的ETag改变.返回是否写入
+@asyncio.coroutine
+def save_rendered(blog):
+    blog.updated_at = time.time()
+    rows = yield from orm.execute(
+        "update `blogs` set `html_content`=?, `content_hash`=?, `updated_at`=? "
+        "where `id`=? and `content`=? and (`html_content` is null or `content_hash` is null or `content_hash`<>?)",
+        [blog.html_content, blog.content_hash, blog.updated_at, blog.id, blog.content, blog.content_hash])
+    return rows == 1
 
 # 通过用户信息计算加密cookie
 def user2cookie(user, max_age):
@@ -84,9 +145,16 @@ def cookie2user(cookie_str):
         uid, expires, sha1 = L
         if int(expires) < time.time(): # 时间是浮点表示的时间戳,一直在增大.因此失效时间小于当前时间,说明cookie已失效
             return None
-        user = yield from User.find(uid)  # 在拆分得到的id在数据库中查找用户信息
-        if user is None:
-            return None
+        # 先从会话缓存中查找用户,未命中再到数据库中查找
+        # 缓存中保存的是用户记录的原始字段,每次都复制出一个新的User,避免修改缓存中的记录
+        row = _session_cache.get(uid)
+        if row is None:
+            user = yield from User.find(uid)  # 在拆分得到的id在数据库中查找用户信息
+            if user is None:
+                return None
+            _session_cache.set(uid, dict(user))
+        else:
+            user = User(**row)
         # 利用用户id,加密后的密码,失效时间,加上cookie密钥,组合成待加密的原始字符串
         # 再对其进行加密,与从cookie分解得到的sha1进行比较.若相等,则该cookie合法
         s = "%s-%s-%s-%s" % (uid, user.passwd, expires, _COOKIE_KEY)
@@ -103,17 +171,19 @@ def cookie2user(cookie_str):
     return None
 
 # 对于首页的get请求的处理
+@cache_page(10)
 @get('/')
 def index(*, page="1"):
     page_index = get_page_index(page)
-    num = yield from Blog.findNumber("count(id)")
+    num = yield from Blog.findCount()
     page = Page(num)
     if num == 0:
         blogs = []
     else:
-        blogs = yield from Blog.findAll(orderBy = "created_at desc", limit=(page.offset, page.limit))
+        # 列表页只显示标题与摘要,不取出正文
+        blogs = yield from Blog.findAll(orderBy = "created_at desc", limit=(page.offset, page.limit), defer=LISTING_DEFER)
     # 返回一个字典, 其指示了使用何种模板,模板的内容
-    # app.py的response_factory将会对handler的返回值进行分类处理
+    # app.py的response_middleware将会对handler的返回值进行分类处理
     return {
         "__template__": "blogs.html",
         "page": page,
@@ -147,7 +217,30 @@ def signout(request):
     logging.info("user signed out.")
     return r
 
+# 条件GET的校验器(见coroweb.conditional),只查询很少的列,客户端缓存未过期时不必加载整篇博客
+# 博客的版本即其修改时间
+@asyncio.coroutine
+def _blog_version(request):
+    blog = yield from Blog.find(request.match_info["id"], fields=("updated_at",))
+    if blog is None:
+        return None
+    return blog.updated_at, blog.updated_at
+
+# 博客详情页还包含评论,其版本还取决于评论的数量与最新评论的时间,两者都由(blog_id, created_at)索引得出
+# 删除评论可能使最新评论的时间倒退,因此不提供Last-Modified
+@asyncio.coroutine
+def _blog_page_version(request):
+    id = request.match_info["id"]
+    blog = yield from Blog.find(id, fields=("updated_at",))
+    if blog is None:
+        return None
+    # 评论的数量与最新评论的时间由一次查询得出
+    rs = yield from orm.select("select count(`id`) _num_, max(`created_at`) _latest_ from `comments` where `blog_id`=?", [id], 1)
+    return (blog.updated_at, rs[0]["_num_"], rs[0]["_latest_"]), None
+
 # 博客详情页
+@conditional(_blog_page_version)
+@cache_page(30)
 @get('/blog/{id}')
 def get_blog(id):
     blog = yield from Blog.find(id) # 通过id从数据库拉取博客信息
@@ -156,7 +249,11 @@ def get_blog(id):
     # 将每条评论都转化为html格式(根据text2html代码可知,实际为html的<p>)
     for c in comments:
         c.html_content = text2html(c.content)
-    blog.html_content = markdown2.markdown(blog.content) # blog是markdown格式,将其转换为html格式
+    # blog是markdown格式,其html在写入时已经渲染好了
+    # 只有html缺失(如旧数据)或已过期时,才重新渲染,并写回数据库(见save_rendered)
+    if blog.html_content is None or blog.content_hash != content_digest(blog.content):
+        yield from render_blog(blog)
+        yield from save_rendered(blog)
     return {
         # 返回的参数将在jinja2模板中被解析
         "__template__": "blog.html",
@@ -219,14 +316,15 @@ def manage_users(*, page='1'):  # 管理页面默认从"1"开始
 @get('/api/users')
 def api_get_users(*, page="1"):
     page_index = get_page_index(page)
-    num = yield from User.findNumber("count(id)")
+    num = yield from User.findCount()
     p = Page(num, page_index)
     if num == 0:
         return dict(page=p, users=())
-    users = yield from User.findAll(orderBy="created_at desc")
+    # 用户列表只读不写,取紧凑的行对象
+    users = yield from User.findAll(orderBy="created_at desc", rows=True)
     for u in users:
         u.passwd = "*****"
-    # 以dict形式返回,并且未指定__template__,将被app.py的response factory处理为json
+    # 以dict形式返回,并且未指定__template__,将被app.py的response_middleware处理为json
     return dict(page=p, users=users)
 
 # API: 创建用户
@@ -266,7 +364,7 @@ def api_register_user(*,name, email, passwd): # 注册信息包括用户名,邮
     r.set_cookie(COOKIE_NAME, user2cookie(user, 600), max_age=600, httponly=True)  # 设置cookie最大存会时间为10min
     # r.set_cookie(COOKIE_NAME, user2cookie(user, 86400), max_age=86400, httponly=True)  #86400s=24h
     user.passwd = '*****' # 修改密码的外部显示为*
-    # 设置content_type,将在data_factory中间件中继续处理
+    # 设置content_type,将在data_middleware中间件中继续处理
     r.content_type = 'application/json'
     # json.dumps方法将对象序列化为json格式
     r.body = json.dumps(user, ensure_ascii=False).encode('utf-8')
@@ -307,18 +405,24 @@ def authenticate(*, email, passwd): # 通过邮箱与密码验证登录
 
 # API: 获取blog
 @get('/api/blogs')
-def api_blogs(*, page='1'):
+def api_blogs(*, page='1', after=None, before=None):
+    # 指定了after或before的(即使为空),使用游标分页
+    if after is not None or before is not None:
+        p = CursorPage(after, before)
+        blogs = yield from Blog.findAll(after=decode_cursor(after, "after"), before=decode_cursor(before, "before"), orderBy="created_at desc, id desc", limit=p.limit, defer=LISTING_DEFER)
+        return dict(page=p, blogs=p.trim(blogs))
     page_index = get_page_index(page)
-    num = yield from Blog.findNumber('count(id)')  # num为博客总数
+    num = yield from Blog.findCount()  # num为博客总数
     p = Page(num, page_index) # 创建page对象
     if num == 0:
         return dict(page=p, blogs=())  # 若博客数为0,返回字典,将被app.py的response中间件再处理
     # 博客总数不为0,则从数据库中抓取博客
     # limit强制select语句返回指定的记录数,前一个参数为偏移量,后一个参数为记录的最大数目
-    blogs = yield from Blog.findAll(orderBy="created_at desc", limit=(p.offset, p.limit))
+    blogs = yield from Blog.findAll(orderBy="created_at desc", limit=(p.offset, p.limit), defer=LISTING_DEFER)
     return dict(page=p, blogs=blogs)  # 返回字典,以供response中间件处理
 
 # API: 获取单条日志
+@conditional(_blog_version)
 @get('/api/blogs/{id}')
 def api_get_blog(*, id):
     blog = yield from Blog.find(id)
@@ -337,6 +441,7 @@ def api_create_blog(request, *, name, summary, content):
         raise APIValueError("content", "content cannot be empty")
     # 创建博客对象
     blog = Blog(user_id=request.__user__.id, user_name=request.__user__.name, user_image=request.__user__.image, name=name.strip(),summary=summary.strip(), content=content.strip())
+    yield from render_blog(blog) # 写入时就渲染好html,浏览博客时不必再渲染
     yield from blog.save() # 储存博客入数据库
     return blog # 返回博客信息
 
@@ -355,6 +460,8 @@ def api_update_blog(id, request, *, name, summary, content):
     blog.name = name.strip()
     blog.summary = summary.strip()
     blog.content = content.strip()
+    blog.updated_at = time.time()
+    yield from render_blog(blog) # 内容改变了,重新渲染html
     yield from blog.update() # 更新博客
     return blog # 返回博客信息
 
@@ -365,14 +472,30 @@ def api_delete_blog(request, *, id):
     # 根据model类的定义,只有查询才是类方法,其他增删改都是实例方法
     # 因此需要先创建对象,再删除
     blog = yield from Blog.find(id)  # 取出博客
-    yield from blog.remove()  # 删除博客
+    if blog is None:
+        raise APIResourceNotFoundError("Blog", "No such a blog.")
+    # 在同一个事务中删除博客及其全部评论,要么全部删除,要么都不删除
+    tx = orm.transaction()
+    yield from tx.begin()
+    try:
+        yield from Comment.removeAll("`blog_id`=?", [id])  # 删除博客的评论
+        yield from blog.remove()  # 删除博客
+    except BaseException:
+        yield from tx.rollback()
+        raise
+    yield from tx.commit()
     return dict(id=id)  # 返回被删博客的id
 
 # API: 获取评论
 @get("/api/comments")
-def api_comments(*, page="1"):
+def api_comments(*, page="1", after=None, before=None):
+    # 指定了after或before的(即使为空),使用游标分页
+    if after is not None or before is not None:
+        p = CursorPage(after, before)
+        comments = yield from Comment.findAll(after=decode_cursor(after, "after"), before=decode_cursor(before, "before"), orderBy="created_at desc, id desc", limit=p.limit)
+        return dict(page=p, comments=p.trim(comments))
     page_index = get_page_index(page)
-    num = yield from Comment.findNumber('count(id)')  # num为评论总数
+    num = yield from Comment.findCount()  # num为评论总数
     p = Page(num, page_index) # 创建page对象, 保存页面信息
     if num == 0:
         return dict(page=p, comments=())  # 若评论数0,返回字典,将被app.py的response中间件再处理
@@ -408,3 +531,14 @@ def api_delete_comment(id, request):
         raise APIResourceNotFoundError("Comment", "No such a Comment.")
     yield from comment.remove()  # 删除评论
     return dict(id=id)  # 返回被删评论的ID
+
+# API: 运行统计,只有管理员可以查看
+# 包括各缓存的命中率,查询耗时,连接池与批量加载器的统计;
+# 中间件的统计(请求合并,整页缓存)由app.py登记在app["__stats__"]中
+@get('/api/stats')
+def api_stats(request):
+    check_admin(request)
+    stats = dict(cache=cache_stats(), queries=orm.query_stats(), pool=orm.pool_stats(), loader=orm.loader_stats())
+    for name, fn in request.app.get("__stats__", {}).items():
+        stats[name] = fn()
+    return stats
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''索引顾问: 找出热点查询中缺少索引的语句,并生成建立索引的DDL
+1. 在本地数据库上重放各个页面与API的读请求,记录ORM实际发出的语句模板及参数样本
+2. 对每条语句执行EXPLAIN,找出全表扫描(type=ALL)与额外排序(Using filesort)的语句
+3. 根据语句的where与order by子句推荐组合索引: 等值条件的列在前,范围条件与排序的列在后,
+   已有索引覆盖的不再推荐
+推荐的索引以migration的形式输出,检查无误后放入migrations/目录执行.
+
+本地数据库的数据量太小时,MySQL可能认为全表扫描更快,请先导入一些数据.
+
+用法: python3 index_advisor.py [输出的migration文件]'''
+
+__author__ = 'Engine'
+
+import re
+import sys
+import logging
+logging.basicConfig(level=logging.WARNING)
+
+import asyncio
+
+import orm
+import handlers
+from config import configs
+from models import Blog
+
+_RE_TABLE = re.compile(r"\bfrom\s+`?(\w+)`?", re.I)
+_RE_WHERE = re.compile(r"\bwhere\s+(.*?)(?:\border\s+by\b|\blimit\b|$)", re.I | re.S)
+_RE_ORDER = re.compile(r"\border\s+by\s+(.*?)(?:\blimit\b|$)", re.I | re.S)
+_RE_CONDITION = re.compile(r"`?(\w+)`?\s*(=|<=|>=|<|>|\bin\b|\blike\b)\s*\(?\?", re.I)
+
+# 重放各个页面与API的读请求,记录ORM发出的语句
+# 只调用handler函数本身,不经过http,因此需要登录的页面也能重放
+@asyncio.coroutine
+def capture():
+    blogs = yield from Blog.findAll(limit=1)
+    orm.capture_queries()
+    calls = [
+        lambda: handlers.index(page="1"),
+        lambda: handlers.api_blogs(page="1"),
+        lambda: handlers.api_blogs(after=""),
+        lambda: handlers.api_comments(page="1"),
+        lambda: handlers.api_comments(after=""),
+        lambda: handlers.api_get_users(page="1"),
+        lambda: handlers.authenticate(email="nobody@example.com", passwd="0" * 40)
+    ]
+    if blogs:
+        calls.append(lambda: handlers.get_blog(blogs[0].id))
+        calls.append(lambda: handlers.api_get_blog(id=blogs[0].id))
+    else:
+        logging.warning("no blogs in local database, blog pages are skipped.")
+    for call in calls:
+        try:
+            yield from call()
+        except Exception as e:
+            # 例如authenticate找不到用户时会抛出APIValueError,但查询已经执行过了
+            logging.info("replay: %s", e)
+    samples = orm.captured_queries()
+    orm.capture_queries(False)
+    # 只分析查询语句
+    return dict((t, s) for t, s in samples.items() if t.lstrip().lower().startswith("select"))
+
+# 执行EXPLAIN,返回发现的问题列表
+# 按索引顺序扫描整个索引(只有order by与limit的分页查询)是正常的,但带where的查询也这样扫描,说明条件没有可用的索引
+@asyncio.coroutine
+def explain(sql, args):
+    problems = []
+    filtered = _RE_WHERE.search(sql) is not None
+    if orm._backend.name == "sqlite":
+        for row in (yield from orm.select("explain query plan " + sql, args)):
+            detail = row["detail"]
+            if detail.startswith("SCAN") and ("USING" not in detail or filtered):
+                problems.append("full scan (%s)" % detail)
+            if "TEMP B-TREE" in detail:
+                problems.append("filesort (%s)" % detail)
+        return problems
+    for row in (yield from orm.select("explain " + sql, args)):
+        extra = row.get("Extra") or ""
+        if row.get("type") == "ALL" or (row.get("type") == "index" and filtered):
+            problems.append("full scan of %s (%s rows)" % (row.get("table"), row.get("rows")))
+        if "Using filesort" in extra:
+            problems.append("filesort on %s" % row.get("table"))
+        if "Using temporary" in extra:
+            problems.append("temporary table on %s" % row.get("table"))
+    return problems
+
+# 根据语句推荐组合索引的列: 等值条件的列在前,范围条件的列其次,排序的列最后
+def suggest(template):
+    m = _RE_TABLE.search(template)
+    if m is None:
+        return None, []
+    table = m.group(1)
+    equal, ranged = [], []
+    where = _RE_WHERE.search(template)
+    if where:
+        for column, op in _RE_CONDITION.findall(where.group(1)):
+            target = equal if op in ("=", "in") else ranged
+            if column not in equal and column not in ranged:
+                target.append(column)
+    order = _RE_ORDER.search(template)
+    ordered = []
+    if order:
+        for item in order.group(1).split(","):
+            column = item.strip().split()[0].strip("`")
+            if column and column not in equal and column not in ordered:
+                ordered.append(column)
+    # 范围条件之后的列无法用于排序,只保留第一个范围条件
+    columns = equal + (ranged[:1] if ranged and (not ordered or ordered[0] != ranged[0]) else []) + ordered
+    return table, columns
+
+# 取得表上已有的索引, 返回各索引的列列表
+@asyncio.coroutine
+def existing_indexes(table):
+    indexes = {}
+    if orm._backend.name == "sqlite":
+        for index in (yield from orm.select("select `name` from sqlite_master where type='index' and tbl_name=?", [table])):
+            rows = yield from orm.select("pragma index_info(`%s`)" % index["name"], [])
+            indexes[index["name"]] = [r["name"] for r in sorted(rows, key=lambda r: r["seqno"])]
+        return list(indexes.values())
+    for row in (yield from orm.select("show index from `%s`" % table, [])):
+        indexes.setdefault(row["Key_name"], []).append((row["Seq_in_index"], row["Column_name"]))
+    indexes = dict((name, [c for _, c in sorted(cols)]) for name, cols in indexes.items())
+    # InnoDB的二级索引隐含了主键列,例如(created_at)实际上是(created_at, id)
+    primary = indexes.get("PRIMARY", [])
+    return [cols if name == "PRIMARY" else cols + [c for c in primary if c not in cols] for name, cols in indexes.items()]
+
+@asyncio.coroutine
+def advise():
+    samples = yield from capture()
+    suggestions = []  # [(table, columns, 原因)]
+    for template, (sql, args) in sorted(samples.items()):
+        problems = yield from explain(sql, args)
+        if not problems:
+            continue
+        print("-- %s\n--     %s" % (template, "; ".join(problems)))
+        table, columns = suggest(template)
+        if not columns:
+            print("--     no indexable columns")
+            continue
+        indexes = yield from existing_indexes(table)
+        if any(index[:len(columns)] == columns for index in indexes):
+            print("--     index on (%s) already exists" % ", ".join(columns))
+            continue
+        if (table, columns) not in [(t, c) for t, c, _ in suggestions]:
+            suggestions.append((table, columns, template))
+    print("-- %s statements analysed, %s indexes suggested" % (len(samples), len(suggestions)))
+    return suggestions
+
+# 生成migration
+def migration(suggestions):
+    lines = ["-- 由index_advisor.py生成,为热点查询增加索引", "", "use %s;" % configs.db.database, ""]
+    for table, columns, template in suggestions:
+        lines.append("-- %s" % template)
+        lines.append("alter table `%s` add index `idx_%s` (%s);" % (table, "_".join(columns), ", ".join("`%s`" % c for c in columns)))
+        lines.append("")
+    return "\n".join(lines)
+
+def main():
+    loop = asyncio.get_event_loop()
+    kw = dict(configs.db)
+    kw["db"] = kw.pop("database")
+    # 不需要从库,行数缓存与查询缓存,所有语句都在本地主库执行
+    kw.update(replicas=[], count_ttl=0, adaptive=False, query_cache_bytes=0)
+    loop.run_until_complete(orm.create_pool(loop=loop, **kw))
+    suggestions = loop.run_until_complete(advise())
+    if suggestions:
+        ddl = migration(suggestions)
+        if len(sys.argv) > 1:
+            with open(sys.argv[1], "w", encoding="utf-8") as f:
+                f.write(ddl)
+            print("-- migration written to %s" % sys.argv[1])
+        else:
+            print(ddl)
+
+if __name__ == "__main__":
+    main()
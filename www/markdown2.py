@@ -137,10 +137,44 @@ def markdown_path(path, encoding="utf-8",
 def markdown(text, html4tags=False, tab_width=DEFAULT_TAB_WIDTH,
              safe_mode=None, extras=None, link_patterns=None,
              use_file_vars=False):
-    return Markdown(html4tags=html4tags, tab_width=tab_width,
+    cache = _convert_cache
+    if cache is not None:
+        key = _convert_cache_key(text, (html4tags, tab_width, safe_mode,
+                                        extras, link_patterns, use_file_vars))
+        html = cache.get(key)
+        if html is not None:
+            return html
+    html = Markdown(html4tags=html4tags, tab_width=tab_width,
                     safe_mode=safe_mode, extras=extras,
                     link_patterns=link_patterns,
                     use_file_vars=use_file_vars).convert(text)
+    if cache is not None:
+        cache.set(key, html)
+    return html
+#---- conversion cache
+# Optional memoization for `markdown()`. Any object with `get(key)` and
+# `set(key, value)` will do; eviction policy and memory bounds are up to
+# the cache. Keys are a digest of the input text plus the conversion
+# options, so identical inputs rendered with different extras don't
+# collide. `Markdown.convert()` itself is never cached: an instance
+# carries per-conversion state (footnotes, toc, metadata).
+_convert_cache = None
+def set_convert_cache(cache):
+    """Install `cache` for `markdown()` conversions (None to disable)."""
+    global _convert_cache
+    _convert_cache = cache
+def get_convert_cache():
+    return _convert_cache
+def markdown_cache_key(text, html4tags=False, tab_width=DEFAULT_TAB_WIDTH,
+                       safe_mode=None, extras=None, link_patterns=None,
+                       use_file_vars=False):
+    """The key `markdown()` uses for `text` with these options."""
+    return _convert_cache_key(text, (html4tags, tab_width, safe_mode,
+                                     extras, link_patterns, use_file_vars))
+def _convert_cache_key(text, options):
+    h = md5(repr(options).encode("utf-8"))
+    h.update(text.encode("utf-8"))
+    return h.hexdigest()
 class Markdown(object):
     # The dict of "extras" to enable in processing -- a mapping of
     # extra name to argument for the extra. Most extras do not have an
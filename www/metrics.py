@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'运行指标,用于统计耗时等数值的分布'
+
+__author__ = 'Engine'
+
+import bisect
+
+# 默认的分桶上界(毫秒),最后一个桶收集所有更大的值
+DEFAULT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+# 直方图,按固定的分桶统计数值的分布,同时记录次数,总和与最大值
+# 分桶是固定的,因此无论记录多少次,占用的内存都不变
+class Histogram(object):
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    # 记录一个数值
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    # 估算百分位数,返回该百分位所在分桶的上界
+    def percentile(self, p):
+        if self.count == 0:
+            return 0.0
+        rank = p / 100.0 * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                return self.buckets[i] if i < len(self.buckets) else self.max
+        return self.max
+
+    # 以dict形式返回统计信息,方便直接输出为json
+    def stats(self):
+        labels = ["<=%s" % b for b in self.buckets] + [">%s" % self.buckets[-1]]
+        return dict(
+            count = self.count,
+            total = self.total,
+            mean = (self.total / self.count) if self.count else 0.0,
+            max = self.max,
+            p50 = self.percentile(50),
+            p99 = self.percentile(99),
+            buckets = dict(zip(labels, self.counts))
+        )
+
+    def __str__(self):
+        return "<Histogram count: %s, mean: %.2f, max: %.2f>" % (self.count, (self.total / self.count) if self.count else 0.0, self.max)
+
+    __repr__ = __str__
@@ -0,0 +1,8 @@
+-- 为博客增加预渲染的html与内容摘要
+-- 执行本文件与003_blog_updated_at.sql之后,再运行 python3 backfill_html.py 为已有的博客生成html
+
+use awesome;
+
+alter table blogs
+    add column `html_content` mediumtext after `content`,
+    add column `content_hash` varchar(40) after `html_content`;
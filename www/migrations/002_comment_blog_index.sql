@@ -0,0 +1,9 @@
+-- 为按博客查询评论增加组合索引
+-- 每次打开博客都要执行 select ... from comments where blog_id=? order by created_at desc,
+-- 没有该索引时是全表扫描再排序.删除博客时的 delete from comments where blog_id=? 同样受益
+-- 由index_advisor.py分析得出
+
+use awesome;
+
+alter table comments
+    add index `idx_blog_id_created_at` (`blog_id`, `created_at`);
@@ -0,0 +1,9 @@
+-- 为博客增加最后修改时间,用于条件GET(ETag/Last-Modified)
+-- 已有博客的修改时间取其创建时间
+
+use awesome;
+
+alter table blogs
+    add column `updated_at` real not null default 0 after `created_at`;
+
+update blogs set `updated_at` = `created_at`;
@@ -34,6 +34,7 @@ class User(Model):
 class Blog(Model):
 
     __table__ = "blogs"
+    __version_field__ = "updated_at"
 
     id = StringField(primary_key=True, default=next_id, ddl="varchar(50)")
     user_id = StringField(ddl="varchar(50)")
@@ -42,11 +43,18 @@ class Blog(Model):
     name = StringField(ddl="varchar(50)")
     summary = StringField(ddl="varchar(200)")
     content = TextField()
+    # 预先渲染好的html,以及生成该html时博客内容的摘要
+    # 在创建/修改博客时计算,摘要与当前内容不符时说明html已过期,需要重新渲染
+    html_content = TextField()
+    content_hash = StringField(ddl="varchar(40)")
     created_at = FloatField(default=time.time)
+    # 最后修改时间,修改博客时更新,用作ETag与Last-Modified
+    updated_at = FloatField(default=time.time)
 
 class Comment(Model):
 
     __table__ = "comments"
+    __version_field__ = "created_at" # 评论不会被修改
 
     id = StringField(primary_key=True, default=next_id, ddl="varchar(50)")
     blog_id = StringField(ddl="varchar(50)")
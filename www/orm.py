@@ -8,63 +8,604 @@ ORM通过打开数据库连接,再由连接创建游标,通过游标执行一系
 
 __author__ = 'Engine'
 
+import re
+import sys
+import time
+import hashlib
 import logging
 import asyncio
-import aiomysql
+import functools
+import contextvars
+from collections import deque
 
+import backends
+from cache import LRUCache
+from metrics import Histogram
 
 
 # 打印sql日志
+# 每条查询都会调用,因此先判断日志级别,未启用INFO时不做任何字符串格式化
 def log(sql, args=()):
-    logging.info("SQL: %s" % sql)
+    if logging.getLogger().isEnabledFor(logging.INFO):
+        logging.info("SQL: %s", sql)
+
+# 慢查询阈值(毫秒),执行时间超过该值的查询将以WARNING级别记录,为None时不记录
+_slow_query_ms = None
+
+# 每种语句模板的耗时统计, 语句模板 => [执行耗时直方图, 获取连接等待耗时直方图]
+_query_stats = {}
+
+_RE_PLACEHOLDERS = re.compile(r"\?(\s*,\s*\?)+")
+
+# 将sql归一化为语句模板: 把"?, ?, ?"这样的占位符列表合并为"?, ..."
+# 这样"where id in (?, ?)"与"where id in (?, ?, ?)"被视为同一种语句
+@functools.lru_cache(maxsize=1024)
+def _statement_template(sql):
+    return _RE_PLACEHOLDERS.sub("?, ...", sql)
+
+# 参数的摘要,慢查询日志中只记录参数的摘要,避免把用户数据写进日志
+def _args_digest(args):
+    return hashlib.sha1(repr(args).encode("utf-8")).hexdigest()[:12]
+
+# 记录一次查询的耗时
+# wait - 从连接池获取连接的等待时间(秒), elapsed - 在连接上执行查询的时间(秒)
+def _record_query(sql, args, wait, elapsed):
+    template = _statement_template(sql)
+    stats = _query_stats.get(template)
+    if stats is None:
+        stats = _query_stats[template] = (Histogram(), Histogram())
+    stats[0].observe(elapsed * 1000)
+    stats[1].observe(wait * 1000)
+    if _query_samples is not None and template not in _query_samples:
+        _query_samples[template] = (sql, args)
+    if _slow_query_ms is not None and elapsed * 1000 >= _slow_query_ms:
+        logging.warning("slow query: %.1fms (wait %.1fms): %s [args: %s]", elapsed * 1000, wait * 1000, sql, _args_digest(args))
+
+# 返回每种语句模板的耗时统计(毫秒)
+def query_stats():
+    return dict((template, dict(query=q.stats(), wait=w.stats())) for template, (q, w) in _query_stats.items())
+
+# 语句模板的样本, 语句模板 => (sql, args),只在capture_queries开启后记录,默认关闭
+# 样本中带有真实的参数,只用于在本地数据库上分析查询(见index_advisor.py),不要在生产环境开启
+_query_samples = None
+
+# 开启或关闭语句样本的记录,开启时清空已记录的样本
+def capture_queries(enabled=True):
+    global _query_samples
+    _query_samples = {} if enabled else None
+
+# 返回记录到的语句样本
+def captured_queries():
+    return dict(_query_samples or {})
 
 
 # 创建全局数据库连接池,使每个http请求都能从连接池中直接获取数据库连接
 # 避免了频繁地打开或关闭数据库连接
+# 若指定了replicas(从库列表,每项为一个dict,只需写出与主库不同的连接参数,如host, port),
+# 还将为每个从库创建一个连接池,查询将被分发到从库,增删改及事务中的查询仍在主库执行
 @asyncio.coroutine
 def create_pool(loop, **kw):
     logging.info("create database connection pool...")
-    global __pool
-    # 调用一个子协程来创建全局连接池,create_pool的返回值是一个pool实例对象
-    __pool = yield from aiomysql.create_pool(
-        # 前面几项为设置连接的属性
-        # dict.get(key, default)
-        host      = kw.get("host", "localhost"),# 数据库服务器的位置,设在本地
-        port      = kw.get("port", 3306),      # mysql的端口
-        user      = kw["user"],                # 登录用户名
-        password  = kw["password"],            # 口令
-        db        = kw["db"],            # 当前数据库名
-        charset   = kw.get("charset", "utf8"), # 设置连接使用的编码格式为utf-8
-        autocommit= kw.get("autocommit", True),# 自动提交模式,此处默认是False
-
-        #以下三项为可选项
-        # 最大连接池大小,默认是10,此处设为10
-        maxsize   = kw.get("maxsize", 10),
-        # 最小连接池大小,默认是10,此处设为1,保证了任何时候都有一个数据库连接
-        minsize   = kw.get("minsize", 1),
-        loop      = loop # 设置消息循环,何用?
+    # 选择数据库后端: "mysql"(aiomysql)或"sqlite"(内嵌的sqlite3,用于基准测试)
+    global __pool, _backend
+    _backend = backends.get_backend(kw.get("backend", "mysql"))
+    # 编译结果与后端的占位符风格有关,更换后端时需要清空
+    _prepare.cache_clear()
+    __pool = yield from _create_pool(loop, kw)
+    # 从库的连接池,以及分发查询的策略: "round_robin"(轮询)或"least_outstanding"(正在使用的连接最少者优先)
+    global _replicas, _read_policy, _ryw_window
+    _replicas = []
+    for replica in kw.get("replicas") or ():
+        logging.info("create replica connection pool: %s:%s", replica.get("host"), replica.get("port", 3306))
+        _replicas.append((yield from _create_pool(loop, dict(kw, **replica))))
+    _read_policy = kw.get("read_policy", "round_robin")
+    # 读己之写: 用户写入之后的这段时间(秒)内,该用户的查询都在主库执行,避免从库复制延迟使用户看不到自己刚写入的内容
+    _ryw_window = kw.get("read_your_writes", 5)
+    _recent_writers.ttl = _ryw_window
+    # 自适应模式: 根据获取连接的等待时间,在minsize与maxsize之间调整主库连接池的大小
+    if kw.get("adaptive", False):
+        asyncio.ensure_future(_adapt_pool(__pool, kw.get("minsize", 1), kw.get("maxsize", 10),
+                                          kw.get("adaptive_interval", 5), kw.get("adaptive_wait_ms", 10)), loop=loop)
+    # 行数缓存的最长存活时间(秒),超过该时间将重新查询数据库进行校正
+    global _count_ttl
+    _count_ttl = kw.get("count_ttl", _count_ttl)
+    # 是否合并同一时刻的按主键查询(见PrimaryKeyLoader)
+    global _batch_find
+    _batch_find = kw.get("batch_find", _batch_find)
+    # 慢查询阈值(毫秒)
+    global _slow_query_ms
+    _slow_query_ms = kw.get("slow_query_ms", _slow_query_ms)
+    # 查询结果缓存,内存上限为query_cache_bytes(字节),为0时关闭
+    global _query_cache
+    if kw.get("query_cache_bytes"):
+        _query_cache = LRUCache(None, ttl=kw.get("query_cache_ttl", 60), maxbytes=kw["query_cache_bytes"], sizeof=_sizeof)
+    else:
+        _query_cache = None
+
+# 按照连接参数创建一个连接池,连接池由当前的数据库后端创建
+@asyncio.coroutine
+def _create_pool(loop, kw):
+    pool = yield from _backend.create_pool(loop, kw)
+    # 预热: 启动时就建立好minsize条连接,并确认它们可用,避免第一批请求等待建立连接
+    yield from _warmup(pool, kw.get("minsize", 1))
+    return pool
+
+# 当前的数据库后端,由create_pool根据backend参数选择,默认为mysql(aiomysql)
+_backend = None
+
+# 将sql编译为数据库驱动可以直接执行的形式: ?占位符转换为驱动使用的占位符,
+# 对于"format"风格(%s)的驱动,sql中原有的%需要转义为%%,否则会被当作格式化符号.
+# 同一种语句只编译一次,编译结果缓存起来,之后的每次查询只是一次字典查找.
+# aiomysql(PyMySQL)不支持服务器端的预处理语句(prepared statement),参数总是在客户端代入;
+# sqlite3则会在每条连接上缓存预处理过的语句,见backends.SQLiteBackend
+@functools.lru_cache(maxsize=1024)
+def _prepare(sql):
+    if _backend.paramstyle == "qmark":
+        return sql
+    return sql.replace("%", "%%").replace("?", "%s")
+
+# 组装select语句,同一种形状的语句只组装一次
+# head为"select ... from ..."部分, limit为limit子句的参数个数(0, 1或2)
+@functools.lru_cache(maxsize=1024)
+def _select_sql(head, where=None, orderBy=None, limit=0):
+    sql = [head]
+    # 我们定义的默认的select语句是通过主键查询的,并不包括where子句
+    # 因此若指定有where,需要在select语句中追加关键字
+    if where:
+        sql.append("where")
+        sql.append(where)
+    if orderBy:
+        sql.append("order by")
+        sql.append(orderBy)
+    if limit == 1:
+        sql.append("limit ?")
+    elif limit == 2:
+        sql.append("limit ?, ?")
+    return " ".join(sql)
+
+# 读写分离
+_replicas = []                 # 从库的连接池
+_read_policy = "round_robin"   # 分发查询的策略
+_next_replica = 0              # 轮询时下一个使用的从库
+_outstanding = {}              # 连接池 => 正在使用的连接数
+_ryw_window = 5                # 读己之写的时间窗口(秒)
+
+# 当前请求所属的会话(通常是用户id),由bind_session设置
+# 每个请求在自己的Task中处理,contextvars保证各请求之间互不影响
+_session_key = contextvars.ContextVar("orm_session_key", default=None)
+# 当前请求是否已经写入过数据库
+_context_wrote = contextvars.ContextVar("orm_context_wrote", default=False)
+# 最近写入过数据库的会话,超过读己之写的时间窗口后自动过期
+_recent_writers = LRUCache(maxsize=10000, ttl=_ryw_window)
+
+# 将当前请求绑定到一个会话,该会话写入数据库之后的一段时间内,其查询都在主库执行
+def bind_session(key):
+    _session_key.set(key)
+
+# 记录当前请求/会话写入了数据库
+def _mark_write():
+    _context_wrote.set(True)
+    key = _session_key.get()
+    if key is not None:
+        _recent_writers.set(key, True)
+
+# 当前请求的查询是否必须在主库执行
+def _read_from_primary():
+    if _context_wrote.get():
+        return True
+    key = _session_key.get()
+    return key is not None and key in _recent_writers
+
+# 为查询选择一个连接池
+def _pick_pool(readonly):
+    global _next_replica
+    if not readonly or not _replicas or _read_from_primary():
+        return __pool
+    if _read_policy == "least_outstanding":
+        return min(_replicas, key=lambda p: _outstanding.get(p, 0))
+    _next_replica = (_next_replica + 1) % len(_replicas)
+    return _replicas[_next_replica]
+
+# 连接池的运行指标,主库与每个从库各自统计
+class _PoolMetrics(object):
+
+    def __init__(self):
+        self.waiters = 0              # 正在等待连接的协程数
+        self.acquire = Histogram()    # 获取连接的等待时间(毫秒)
+
+_pool_metrics = {}             # 连接池 => _PoolMetrics
+
+def _metrics(pool):
+    m = _pool_metrics.get(pool)
+    if m is None:
+        m = _pool_metrics[pool] = _PoolMetrics()
+    return m
+
+# 可以调整上限的信号量,自适应模式下限制同时从主库连接池取出的连接数
+# 连接池本身的maxsize保持不变;上限调高时立即唤醒排队的协程,调低时已取出的连接不受影响,归还后才生效
+class _PoolLimit(object):
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self._waiters = deque()
+
+    @asyncio.coroutine
+    def acquire(self):
+        if self.used < self.limit and not self._waiters:
+            self.used += 1
+            return
+        fut = asyncio.get_event_loop().create_future()
+        self._waiters.append(fut)
+        try:
+            yield from fut
+        except BaseException:
+            if fut.done() and not fut.cancelled():
+                # 已经分配到名额却被取消,把名额让给下一个
+                self.release()
+            else:
+                self._waiters.remove(fut)
+            raise
+
+    def release(self):
+        self.used -= 1
+        self._wakeup()
+
+    def resize(self, limit):
+        self.limit = limit
+        self._wakeup()
+
+    def _wakeup(self):
+        while self._waiters and self.used < self.limit:
+            fut = self._waiters.popleft()
+            if not fut.done():
+                self.used += 1
+                fut.set_result(None)
+
+_pool_limits = {}              # 连接池 => _PoolLimit,只有开启了自适应模式的连接池才有
+
+# 从连接池取得的一条连接,用with语句包裹,结束时自动归还连接池
+# wait为获取该连接等待的时间(秒), acquired为取得连接的时刻
+class _PooledConnection(object):
+
+    in_transaction = False
+
+    def __init__(self, pool, conn, wait, acquired):
+        self.pool = pool
+        self.conn = conn
+        self.wait = wait
+        self.acquired = acquired
+
+    def __enter__(self):
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
+
+    def release(self):
+        _outstanding[self.pool] -= 1
+        self.pool.release(self.conn)
+        limit = _pool_limits.get(self.pool)
+        if limit is not None:
+            limit.release()
+
+# 事务中的连接,由事务负责获取与归还,因此release什么也不做
+class _TransactionConnection(object):
+
+    in_transaction = True
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.wait = 0.0
+        self.acquired = time.perf_counter()
+
+    def __enter__(self):
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        pass
+
+    def release(self):
+        pass
+
+# 从连接池中取出一条连接,同时统计等待的协程数与等待的时间
+# 若当前处于事务中,直接返回事务所用的连接,这样事务中的所有语句都在同一条连接上执行
+# readonly - 只读的查询,可以在从库执行
+# 用法: ctx = yield from _connect()
+#      with ctx as conn:
+#          ...
+@asyncio.coroutine
+def _connect(readonly=False):
+    tx = _current_transaction()
+    if tx is not None:
+        return _TransactionConnection(tx.conn)
+    pool = _pick_pool(readonly)
+    metrics = _metrics(pool)
+    limit = _pool_limits.get(pool)
+    start = time.perf_counter()
+    metrics.waiters += 1
+    _outstanding[pool] = _outstanding.get(pool, 0) + 1
+    try:
+        if limit is not None:
+            yield from limit.acquire()
+        try:
+            conn = yield from pool.acquire()
+        except BaseException:
+            if limit is not None:
+                limit.release()
+            raise
+    except BaseException:
+        _outstanding[pool] -= 1
+        raise
+    finally:
+        metrics.waiters -= 1
+    acquired = time.perf_counter()
+    metrics.acquire.observe((acquired - start) * 1000)
+    return _PooledConnection(pool, conn, acquired - start, acquired)
+
+# 当前请求中进行中的(最内层)事务
+_transaction = contextvars.ContextVar("orm_transaction", default=None)
+
+# 返回当前Task中进行中的事务
+# 事务中创建的Task会继承contextvars,但事务的连接同一时刻只能执行一条语句,
+# 因此只有开启事务的Task才使用它,其他Task忽略该事务,像在事务之外一样从连接池取得连接
+def _current_transaction():
+    tx = _transaction.get()
+    if tx is not None and tx._task is not asyncio.current_task():
+        return None
+    return tx
+
+# 显式事务,事务中的select, execute以及Model的增删改查都将自动使用同一条主库连接
+# 全部语句只需一次提交,要么全部生效,要么全部回滚
+# 用法: async with orm.transaction() as tx:
+#           ...
+# 或在yield from风格的协程中:
+#       tx = orm.transaction()
+#       yield from tx.begin()
+#       try:
+#           ...
+#       except BaseException:
+#           yield from tx.rollback()
+#           raise
+#       yield from tx.commit()
+# 事务可以嵌套,内层事务使用保存点(savepoint),内层回滚不影响外层
+class Transaction(object):
+
+    def __init__(self):
+        self.conn = None
+        self._ctx = None        # 最外层事务从连接池取得的连接
+        self._parent = None     # 外层事务,为None时即为最外层事务
+        self._savepoint = None  # 内层事务的保存点名称
+        self._token = None
+        self._callbacks = []    # 事务提交之后才执行的回调
+        self._task = None       # 开启事务的Task
+
+    @asyncio.coroutine
+    def begin(self):
+        self._task = asyncio.current_task()
+        self._parent = _current_transaction()
+        if self._parent is None:
+            # 事务总是在主库执行
+            self._ctx = yield from _connect()
+            self.conn = self._ctx.conn
+            try:
+                yield from self.conn.begin()
+            except BaseException:
+                self._ctx.release()
+                raise
+        else:
+            self.conn = self._parent.conn
+            self._savepoint = "sp_%s" % id(self)
+            yield from self._execute("savepoint %s" % self._savepoint)
+        self._token = _transaction.set(self)
+        return self
+
+    @asyncio.coroutine
+    def commit(self):
+        _transaction.reset(self._token)
+        if self._parent is not None:
+            yield from self._execute("release savepoint %s" % self._savepoint)
+            # 内层事务的回调要等到最外层事务提交之后才执行
+            self._parent._callbacks.extend(self._callbacks)
+            return
+        try:
+            yield from self.conn.commit()
+        finally:
+            self._ctx.release()
+        for fn in self._callbacks:
+            fn()
+
+    @asyncio.coroutine
+    def rollback(self):
+        _transaction.reset(self._token)
+        if self._parent is not None:
+            yield from self._execute("rollback to savepoint %s" % self._savepoint)
+            return
+        try:
+            yield from self.conn.rollback()
+        finally:
+            self._ctx.release()
+
+    @asyncio.coroutine
+    def _execute(self, sql):
+        log(sql)
+        cur = yield from self.conn.cursor()
+        yield from cur.execute(sql)
+        yield from cur.close()
+
+    @asyncio.coroutine
+    def __aenter__(self):
+        return (yield from self.begin())
+
+    @asyncio.coroutine
+    def __aexit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            yield from self.commit()
+        else:
+            yield from self.rollback()
+        return False
+
+# 创建一个事务
+def transaction():
+    return Transaction()
+
+# 记录变更之后的处理: 调整行数缓存,并通知监听器
+# 处于事务中时,推迟到事务提交之后再处理,事务回滚则丢弃
+def _changed(model, action, delta=0):
+    def fn():
+        if delta:
+            _adjust_count(model.__table__, delta)
+        notify(model, action)
+    tx = _current_transaction()
+    if tx is None:
+        fn()
+    else:
+        tx._callbacks.append(fn)
+
+# 预热连接池: 同时取出n条连接并执行一次ping,再全部归还
+@asyncio.coroutine
+def _warmup(pool, n):
+    conns = []
+    try:
+        for i in range(min(n, pool.maxsize)):
+            conn = yield from pool.acquire()
+            conns.append(conn)
+            yield from conn.ping()
+    finally:
+        for conn in conns:
+            pool.release(conn)
+    logging.info("database connection pool warmed up: %s connections", len(conns))
+
+# 自适应调整连接池大小
+# 每interval秒检查一次: 这段时间内获取连接的平均等待时间超过wait_ms,或仍有协程在等待的,扩大连接池;
+# 没有等待且有多余空闲连接的,缩小连接池,并关闭多出的空闲连接.连接池大小始终在[minsize, maxsize]之间
+# 只根据该连接池自己的指标调整,从库的等待不会让主库扩大.
+# 连接池的maxsize不能在运行中修改,上限由_PoolLimit控制,从maxsize开始逐步缩小;
+# 关闭空闲连接也只用到连接池的公开接口: 取出空闲连接,关闭后再归还,已关闭的连接不会回到连接池
+@asyncio.coroutine
+def _adapt_pool(pool, minsize, maxsize, interval, wait_ms):
+    minsize = max(minsize, 1)
+    limit = _pool_limits[pool] = _PoolLimit(maxsize)
+    metrics = _metrics(pool)
+    count, total = metrics.acquire.count, metrics.acquire.total
+    try:
+        while not pool.closed:
+            yield from asyncio.sleep(interval)
+            n = metrics.acquire.count - count
+            mean = (metrics.acquire.total - total) / n if n else 0.0
+            count, total = metrics.acquire.count, metrics.acquire.total
+            if (mean > wait_ms or metrics.waiters > 0) and limit.limit < maxsize:
+                # 扩大时按当前大小的一半增长,尽快跟上负载;resize会立即唤醒排队的协程
+                limit.resize(min(maxsize, limit.limit + max(1, limit.limit // 2)))
+                logging.info("grow database connection pool to %s (mean wait %.1fms, waiters %s)", limit.limit, mean, metrics.waiters)
+            elif mean < wait_ms / 10 and metrics.waiters == 0 and pool.freesize > 1 and limit.limit > minsize:
+                # 缩小时每次只减1,避免负载波动时反复建立连接
+                limit.resize(limit.limit - 1)
+                logging.info("shrink database connection pool to %s", limit.limit)
+            # 关闭超出上限的空闲连接
+            while pool.size > limit.limit and pool.freesize > 0:
+                conn = yield from pool.acquire()
+                conn.close()
+                pool.release(conn)
+    finally:
+        _pool_limits.pop(pool, None)
+
+# 返回连接池的运行指标
+def pool_stats():
+    pool = __pool
+    metrics = _metrics(pool)
+    limit = _pool_limits.get(pool)
+    return dict(
+        size = pool.size,
+        minsize = pool.minsize,
+        maxsize = pool.maxsize if limit is None else limit.limit,
+        in_use = pool.size - pool.freesize,
+        free = pool.freesize,
+        waiters = metrics.waiters,
+        acquire = metrics.acquire.stats(),
+        replicas = [dict(size=p.size, free=p.freesize, outstanding=_outstanding.get(p, 0),
+                         waiters=_metrics(p).waiters, acquire=_metrics(p).acquire.stats()) for p in _replicas]
     )
 
+# 查询结果缓存
+# 缓存的键为(sql, 参数, size, 语句所查询的各表的版本号).任何增删改执行之后,被修改的表的版本号加1,
+# 该表的旧缓存就再也不会被命中,它们是最久未使用的,会被最先淘汰.
+# 查询开始前取得版本号,因此查询执行期间发生的写入也不会让旧结果以新版本号缓存下来.
+# 事务中的查询不使用缓存;事务中的写入在提交之后还会再次使缓存失效,避免其他请求在提交前缓存了旧数据.
+# 有从库时,写入之后从库可能还没有同步,此时缓存的结果可能是旧的,最长不超过query_cache_ttl
+_query_cache = None
+_table_versions = {}   # 表名 => 版本号
+
+_RE_READ_TABLES = re.compile(r"\b(?:from|join)\s+`?(\w+)`?", re.I)
+_RE_WRITE_TABLE = re.compile(r"^\s*(?:insert\s+into|update|delete\s+from|replace\s+into)\s+`?(\w+)`?", re.I)
+
+# 语句查询的表
+@functools.lru_cache(maxsize=1024)
+def _read_tables(sql):
+    return tuple(sorted(set(_RE_READ_TABLES.findall(sql))))
+
+# 语句修改的表,不是增删改语句的返回None
+@functools.lru_cache(maxsize=1024)
+def _write_table(sql):
+    m = _RE_WRITE_TABLE.match(sql)
+    return m and m.group(1)
+
+# 估算缓存条目占用的内存: 查询结果是dict的列表,需要把每个dict及其中的值都算上
+def _sizeof(obj):
+    if isinstance(obj, (list, tuple)):
+        return sys.getsizeof(obj) + sum(_sizeof(o) for o in obj)
+    if isinstance(obj, dict):
+        return sys.getsizeof(obj) + sum(sys.getsizeof(k) + sys.getsizeof(v) for k, v in obj.items())
+    return sys.getsizeof(obj)
+
+# 使表的缓存失效,也可用于在orm之外修改了数据库的情况
+def invalidate_table(table):
+    _table_versions[table] = _table_versions.get(table, 0) + 1
+
+# 使语句修改的表的缓存失效
+def _invalidate(sql):
+    table = _write_table(sql)
+    if table is None or _query_cache is None:
+        return
+    invalidate_table(table)
+    tx = _current_transaction()
+    if tx is not None:
+        tx._callbacks.append(functools.partial(invalidate_table, table))
+
+# 返回查询缓存的统计信息
+def query_cache_stats():
+    return _query_cache.stats() if _query_cache is not None else None
+
 # 将数据库的select操作封装在select函数中
 # sql形参即为sql语句,args表示填入sql的选项值
 # size用于指定最大的查询数量,不指定将返回所有查询结果
+# cache=False时不使用查询缓存,例如需要读取最新数据时.缓存的结果是共享的,调用者不要修改
 @asyncio.coroutine
-def select(sql, args, size=None):
+def select(sql, args, size=None, cache=True):
+    key = None
+    if cache and _query_cache is not None and _current_transaction() is None and not (_replicas and _read_from_primary()):
+        key = (sql, tuple(args or ()), size, tuple(_table_versions.get(t, 0) for t in _read_tables(sql)))
+        rs = _query_cache.get(key)
+        if rs is not None:
+            return rs
     log(sql, args)
-    global __pool
-    # 从连接池中获取一条数据库连接
-    with (yield from __pool) as conn:
+    # 从连接池中获取一条数据库连接,查询可以在从库执行
+    ctx = yield from _connect(readonly=True)
+    with ctx as conn:
         # 打开一个DictCursor,它与普通游标的不同在于,以dict形式返回结果
-        cur = yield from conn.cursor(aiomysql.DictCursor)
+        cur = yield from conn.cursor(_backend.DictCursor)
         # sql语句的占位符为"?", mysql的占位符为"%s",因此需要进行替换
         # 若没有指定args,将使用默认的select语句(在Metaclass内定义的)进行查询
-        yield from cur.execute(sql.replace("?", "%s"), args or ())
+        yield from cur.execute(_prepare(sql), args or ())
         if size: # 若指定了size, 则打印相应数量的查询信息
             rs = yield from cur.fetchmany(size)
         else: # 未指定size, 打印全部的查询信息
             rs = yield from cur.fetchall()
         yield from cur.close() # 关闭游标
-        logging.info("rows return %s" % len(rs))
+        _record_query(sql, args, ctx.wait, time.perf_counter() - ctx.acquired)
+        logging.info("rows return %s", len(rs))
+        if key is not None:
+            _query_cache.set(key, rs)
         return rs
 
 
@@ -72,24 +613,252 @@ def select(sql, args, size=None):
 @asyncio.coroutine
 def execute(sql, args):
     log(sql)
-    with (yield from __pool) as conn: # 从连接池中取出一条数据库连接
+    ctx = yield from _connect()
+    with ctx as conn: # 从连接池中取出一条数据库连接
+        # 处于显式事务中的,由事务负责提交与回滚
+        autocommit = ctx.in_transaction or conn.get_autocommit()
         # 若数据库的事务为非自动提交的,则调用协程启动连接
-        if not conn.get_autocommit(): # 根据aiomysql文档,修改autocommit为obj.get_autocommit()
+        if not autocommit: # 根据aiomysql文档,修改autocommit为obj.get_autocommit()
             yield from conn.begin()
         try:
             # 此处打开的是一个普通游标
             cur = yield from conn.cursor()
-            yield from cur.execute(sql.replace("?", "%s"), args) # 执行增删改
+            yield from cur.execute(_prepare(sql), args) # 执行增删改
             affected = cur.rowcount # 增删改影响的行数
             yield from cur.close() # 执行结束,关闭游标
-            if not conn.get_autocommit(): # 同上, 事务非自动提交型的,手动调用协程提交增删改事务
+            if not autocommit: # 同上, 事务非自动提交型的,手动调用协程提交增删改事务
+                yield from conn.commit()
+        except BaseException as e:
+            if not autocommit: # 出错, 回滚事务到增删改之前
+                yield from conn.rollback()
+            raise
+        _record_query(sql, args, ctx.wait, time.perf_counter() - ctx.acquired)
+        _mark_write()
+        _invalidate(sql)
+        return affected
+
+# 在同一条连接,同一个事务中批量执行增删改
+# sql为语句模板,args_list为每次执行所用参数的列表,每chunk_size组参数调用一次executemany
+# 对于"insert ... values (...)"语句,驱动会将一批参数合并为一条多行insert,一次往返即可插入一批记录
+# 全部成功才提交,任一条出错则整体回滚.返回影响的总行数
+@asyncio.coroutine
+def execute_many(sql, args_list, chunk_size=500):
+    log(sql)
+    ctx = yield from _connect()
+    with ctx as conn:
+        # 处于显式事务中的,直接加入该事务,由事务负责提交与回滚
+        if not ctx.in_transaction:
+            yield from conn.begin()
+        try:
+            cur = yield from conn.cursor()
+            affected = 0
+            for i in range(0, len(args_list), chunk_size):
+                yield from cur.executemany(_prepare(sql), args_list[i:i + chunk_size])
+                affected += cur.rowcount
+            yield from cur.close()
+            if not ctx.in_transaction:
                 yield from conn.commit()
         except BaseException as e:
-            if not conn.get_autocommit(): # 出错, 回滚事务到增删改之前
+            if not ctx.in_transaction:
                 yield from conn.rollback()
             raise
+        _record_query(sql, args_list, ctx.wait, time.perf_counter() - ctx.acquired)
+        _mark_write()
+        _invalidate(sql)
         return affected
 
+# 流式查询,通过"async for"逐条取出查询结果
+# 使用服务器端游标(SSDictCursor),结果集留在数据库服务器,每次只取batch条到内存中
+# 因此即使遍历整张表,内存中也只有一批记录
+# 遍历结束,出错或被取消时都会释放连接;提前break的,StreamResult对象被回收时(__del__)关闭连接,
+# 也可以用"async with"包裹,或调用close(),立即释放
+class StreamResult(object):
+
+    def __init__(self, model, sql, args, batch=100):
+        self._model = model  # 用于将每条记录转换为model实例
+        self._sql = sql
+        self._args = args
+        self._batch = batch
+        self._buffer = deque()
+        self._ctx = None
+        self._conn = None
+        self._cur = None
+        self._done = False
+
+    def __aiter__(self):
+        return self
+
+    @asyncio.coroutine
+    def __anext__(self):
+        if not self._buffer:
+            if self._done:
+                raise StopAsyncIteration
+            try:
+                if self._conn is None:
+                    log(self._sql, self._args)
+                    self._ctx = yield from _connect(readonly=True)
+                    self._conn = self._ctx.conn
+                    self._cur = yield from self._conn.cursor(_backend.SSDictCursor)
+                    yield from self._cur.execute(_prepare(self._sql), self._args or ())
+                rs = yield from self._cur.fetchmany(self._batch)
+            except BaseException:
+                # 出错或被取消,连接的状态未知,直接关闭
+                yield from self.close()
+                raise
+            if not rs:
+                # 结果集已全部取出,可以正常关闭游标,归还连接
+                self._done = True
+                yield from self.close()
+                raise StopAsyncIteration
+            self._buffer.extend(rs)
+        return self._model(**self._buffer.popleft())
+
+    # 释放连接
+    # 服务器端游标的结果未取完时,连接上还有未读的数据,不能直接归还给连接池
+    # 逐条读完剩下的结果可能很慢,因此直接关闭该连接,连接池会丢弃已关闭的连接
+    @asyncio.coroutine
+    def close(self):
+        exhausted = self._done and self._conn is not None and not self._buffer
+        self._done = True
+        self._buffer.clear()
+        conn, cur = self._conn, self._cur
+        self._conn = self._cur = None
+        if conn is None:
+            return
+        try:
+            # 事务中的连接不能关闭,只能读完剩下的结果
+            if cur is not None and (exhausted or self._ctx.in_transaction):
+                yield from cur.close()
+            elif not self._ctx.in_transaction:
+                conn.close()
+        finally:
+            self._ctx.release()
+
+    @asyncio.coroutine
+    def __aenter__(self):
+        return self
+
+    @asyncio.coroutine
+    def __aexit__(self, exc_type, exc, tb):
+        yield from self.close()
+
+    # 提前break而没有close()的,"async for"结束后对象即被回收,此时关闭连接并归还连接池
+    # __del__中不能等待协程,因此与close()不同,未读完的服务器端游标不读取剩余结果,而是直接关闭连接
+    # 事务中的连接不能关闭,只能在后台读完剩下的结果,之后事务中的语句才能继续执行
+    def __del__(self):
+        conn, cur, ctx = self._conn, self._cur, self._ctx
+        if conn is None:
+            return
+        self._conn = self._cur = None
+        if ctx.in_transaction:
+            if cur is not None:
+                asyncio.ensure_future(cur.close())
+            return
+        conn.close()
+        ctx.release()
+
+# 主键批量加载器,每个model一个
+# 同一轮事件循环中发起的所有find(pk)调用将被合并为一条"where pk in (...)"查询
+# 同一主键的并发查询(包括已经发往数据库,尚未返回的)只查询一次,共享结果
+class PrimaryKeyLoader(object):
+
+    # 一条查询中最多包含的主键数
+    max_batch = 500
+
+    def __init__(self, model):
+        self._model = model
+        self._pending = {}   # 等待下一轮事件循环发出查询的主键 => future
+        self._inflight = {}  # 已发出查询,尚未返回的主键 => future
+        self.calls = 0       # find调用次数
+        self.keys = 0        # 实际查询的主键数
+        self.queries = 0     # 实际执行的查询数
+
+    # 加载主键为pk的记录,返回一个future,其结果为记录的dict,不存在时为None
+    def load(self, pk):
+        self.calls += 1
+        fut = self._inflight.get(pk) or self._pending.get(pk)
+        if fut is not None:
+            return fut
+        loop = asyncio.get_event_loop()
+        if not self._pending:
+            # 本轮事件循环中的第一个查询,安排在下一轮统一发出
+            loop.call_soon(self._dispatch)
+        fut = self._pending[pk] = loop.create_future()
+        return fut
+
+    def _dispatch(self):
+        pending, self._pending = self._pending, {}
+        self._inflight.update(pending)
+        pks = list(pending)
+        for i in range(0, len(pks), self.max_batch):
+            asyncio.ensure_future(self._fetch(pks[i:i + self.max_batch], pending))
+
+    @asyncio.coroutine
+    def _fetch(self, pks, futures):
+        model = self._model
+        self.keys += len(pks)
+        self.queries += 1
+        try:
+            # 合并后的主键组合每次都不同,缓存它们没有意义,只缓存单个主键的查询
+            rs = yield from select("%s where `%s` in (%s)" % (model.__select__, model.__primary_key__, create_args_string(len(pks))), pks, cache=len(pks) == 1)
+            rows = dict((r[model.__primary_key__], r) for r in rs)
+            for pk in pks:
+                if not futures[pk].done():
+                    futures[pk].set_result(rows.get(pk))
+        except Exception as e:
+            for pk in pks:
+                if not futures[pk].done():
+                    futures[pk].set_exception(e)
+        except BaseException:
+            # 查询被取消(或进程退出)时,取消所有等待的future,否则合并到这条查询的find()将永远等待
+            for pk in pks:
+                futures[pk].cancel()
+            raise
+        finally:
+            for pk in pks:
+                self._inflight.pop(pk, None)
+
+    # 返回统计信息,batching_factor为平均每条查询合并的find调用数
+    def stats(self):
+        return dict(calls=self.calls, keys=self.keys, queries=self.queries,
+                    batching_factor=(self.calls / self.queries) if self.queries else 0.0)
+
+_batch_find = True
+
+# 返回所有model的主键批量加载器的统计信息
+def loader_stats():
+    return dict((model.__name__, model.__loader__.stats()) for model in _models if model.__loader__ is not None)
+
+# 表的行数缓存, 表名 => [行数, 查询数据库的时间]
+# 分页需要知道总行数,而InnoDB的count(*)需要扫描整个索引,因此将行数缓存下来
+# 缓存的行数随save()/remove()增减,并在超过_count_ttl之后重新从数据库查询校正
+_row_counts = {}
+_count_ttl = 60
+
+# 记录增删之后,调整缓存的行数
+def _adjust_count(table, delta):
+    item = _row_counts.get(table)
+    if item is not None:
+        item[0] += delta
+
+# 模型变更监听器
+# 每个监听器接收2个参数,一个model实例(批量删除时为model类),一个表示变更类型的字符串("save", "update", "remove")
+# 缓存等模块可借此在数据库记录变更之后使自身失效
+_listeners = []
+
+# 注册模型变更监听器,可作为装饰器使用
+def add_listener(fn):
+    _listeners.append(fn)
+    return fn
+
+# 在记录变更成功之后通知所有监听器
+def notify(model, action):
+    for fn in _listeners:
+        try:
+            fn(model, action)
+        except Exception as e:
+            logging.exception(e)
+
 # 构造占位符
 def create_args_string(num):
     L = []
@@ -147,6 +916,9 @@ class TextField(Field):
     def __init__(self, name=None, default=None):
         super().__init__(name, "text", False, default)
 
+# 所有已定义的model
+_models = []
+
 # 这是一个元类,它定义了如何来构造一个类,任何定义了__metaclass__属性或指定了metaclass的都会通过元类定义的构造方法构造类
 # 任何继承自Model的类,都会自动通过ModelMetaclass扫描映射关系,并存储到自身的类属性
 class ModelMetaclass(type):
@@ -203,11 +975,81 @@ class ModelMetaclass(type):
         attrs["__update__"] = "update `%s` set %s where `%s`=?" % (tableName, ', '.join(map(lambda f: "`%s`=?" % (mappings.get(f).name or f), fields)), primaryKey)
         # 通过主键删除
         attrs["__delete__"] = "delete from `%s` where `%s`=?" % (tableName, primaryKey)
-        return type.__new__(cls, name, bases, attrs)
+        attrs["__loader__"] = None  # 主键批量加载器,在第一次find时创建
+        attrs["__projections__"] = {} # 按投影(fields/defer)缓存的select语句,见_projection
+        # 只读查询使用的紧凑行对象类型,每个字段一个slot,见Row
+        attrs["__row__"] = _make_row_class(name, [primaryKey] + fields)
+        model = type.__new__(cls, name, bases, attrs)
+        model.__row__.__model__ = model
+        _models.append(model)
+        return model
+
+# 紧凑的行对象,由ModelMetaclass为每个model生成一个子类(如UserRow),每个字段一个slot
+# Model继承自dict,每个实例都带着一个完整的dict,取属性还要经过__getattr__和一次KeyError的捕获;
+# 行对象没有__dict__,属性直接从slot中读取,占用的内存更少,访问也更快.
+# 适用于只需读取而不再写回的大批量查询,通过findAll(rows=True)取得.
+# 行对象同样支持row["name"], row.get("name")与dict(row),因此可以直接交给jinja2模板;
+# 序列化为json时使用_asdict(),需要增删改时用to_model()转换回model实例
+class Row(object):
+
+    __slots__ = ()
+    __model__ = None
+
+    def __init__(self, **kw):
+        for k in self.__slots__:
+            setattr(self, k, kw.get(k))
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def keys(self):
+        return self.__slots__
+
+    def _asdict(self):
+        return dict((k, getattr(self, k)) for k in self.__slots__)
+
+    # 转换为model实例
+    def to_model(self):
+        return self.__model__(**self._asdict())
+
+    def __eq__(self, other):
+        return type(self) is type(other) and all(getattr(self, k) == getattr(other, k) for k in self.__slots__)
+
+    def __repr__(self):
+        return "<%s %s>" % (type(self).__name__, ", ".join("%s=%r" % (k, getattr(self, k)) for k in self.__slots__))
+
+# 生成model对应的行对象类型
+# 与collections.namedtuple的做法一样,为每个类型生成专门的__init__与_asdict,逐个字段直接赋值,
+# 省去循环与setattr的开销.字段名来自model的定义,都是合法的标识符
+def _make_row_class(name, names):
+    source = "def __init__(self, **kw):\n    get = kw.get\n%s\n" % "\n".join("    self.%s = get(%r)" % (k, k) for k in names)
+    source += "def _asdict(self):\n    return {%s}\n" % ", ".join("%r: self.%s" % (k, k) for k in names)
+    namespace = {}
+    exec(source, namespace)
+    return type("%sRow" % name, (Row,), dict(__slots__=tuple(names), __init__=namespace["__init__"], _asdict=namespace["_asdict"]))
+
+# 访问或写回被延迟加载的字段时抛出
+# 继承自AttributeError,因此getattr(obj, key, default)与jinja2模板的行为不变
+class DeferredFieldError(AttributeError):
+    pass
 
 # ORM映射基类,继承自dict,通过ModelMetaclass元类来构造类
 class Model(dict, metaclass=ModelMetaclass):
 
+    # 查询时被延迟加载(未取出)的字段,见findAll的fields/defer参数
+    # 实例的该属性保存在实例的__dict__中,不属于dict的内容,因此不会被序列化为json
+    __deferred__ = ()
+
+    # 每次修改都会改变的字段(如修改时间),为None时说明无法据此判断实例是否被修改过
+    # 用于条件GET: 处理函数返回单个实例时,以该字段生成ETag与Last-Modified,见app.py的response_middleware
+    __version_field__ = None
+
     # 初始化函数,调用其父类(dict)的方法
     def __init__(self, **kw):
         super(Model, self).__init__(**kw)
@@ -217,6 +1059,8 @@ class Model(dict, metaclass=ModelMetaclass):
         try:
             return self[key]
         except KeyError:
+            if key in self.__deferred__:
+                raise DeferredFieldError("'%s' field '%s' is deferred, load it first: yield from obj.load()" % (self.__class__.__name__, key))
             raise AttributeError(r"'Model' object has no attribute'%s'" % key)
 
     # 增加__setattr__方法,使设置属性更方便,可通过"a.b=c"的形式
@@ -245,81 +1089,252 @@ class Model(dict, metaclass=ModelMetaclass):
                 setattr(self, key, value)
         return value
 
+    # 按投影取得select语句与被延迟加载的字段
+    # fields - 只取这些字段, defer - 不取这些字段,两者可以同时指定.主键总是会被取出,以便之后load
+    # 同一种投影的select语句只生成一次,缓存在__projections__中
+    @classmethod
+    def _projection(cls, fields=None, defer=None):
+        if fields is None and defer is None:
+            return cls.__select__, ()
+        # 字段可以写成单个字符串,也可以是列表或元组,统一为元组作为缓存的键
+        fields = (fields,) if isinstance(fields, str) else (None if fields is None else tuple(fields))
+        defer = (defer,) if isinstance(defer, str) else (None if defer is None else tuple(defer))
+        key = (fields, defer)
+        projection = cls.__projections__.get(key)
+        if projection is None:
+            unknown = [f for f in (fields or ()) + (defer or ()) if f not in cls.__mappings__]
+            if unknown:
+                raise ValueError("Unknown fields for %s: %s" % (cls.__name__, ", ".join(unknown)))
+            all_fields = [cls.__primary_key__] + cls.__fields__
+            selected = [f for f in all_fields if (fields is None or f in fields or f == cls.__primary_key__) and f not in (defer or ())]
+            if cls.__primary_key__ not in selected:
+                selected.insert(0, cls.__primary_key__)
+            deferred = tuple(f for f in all_fields if f not in selected)
+            sql = "select %s from `%s`" % (", ".join("`%s`" % f for f in selected), cls.__table__)
+            projection = cls.__projections__[key] = (sql, deferred)
+        return projection
+
+    # 由查询结果构造实例,并记录被延迟加载的字段
+    @classmethod
+    def _from_row(cls, r, deferred=()):
+        obj = cls(**r)
+        if deferred:
+            object.__setattr__(obj, "__deferred__", deferred)
+        return obj
+
     # classmethod装饰器将方法定义为类方法
     # 对于查询相关的操作,我们都定义为类方法,就可以方便查询,而不必先创建实例再查询
+    # fields/defer与findAll相同, cache=False时不使用查询缓存
     @classmethod
     @asyncio.coroutine
-    def find(cls, pk):
+    def find(cls, pk, fields=None, defer=None, cache=True):
         'find object by primary key'
+        sql, deferred = cls._projection(fields, defer)
+        # 事务中的查询必须在事务的连接上执行,必须读主库的请求(刚写入过数据库)也不参与合并,
+        # 以免共享到一条在从库执行的查询.指定了投影的查询也不合并,批量加载器总是取出全部字段
+        if not deferred and cache and _batch_find and _current_transaction() is None and not (_replicas and _read_from_primary()):
+            # 交给主键批量加载器,与同一时刻的其他find合并为一条查询
+            # shield保证当前调用被取消时,不会连带取消其他共享该查询的调用
+            if cls.__loader__ is None:
+                cls.__loader__ = PrimaryKeyLoader(cls)
+            r = yield from asyncio.shield(cls.__loader__.load(pk))
+            return None if r is None else cls(**r)
         # 我们之前已将将数据库的select操作封装在了select函数中,以下select的参数依次就是sql, args, size
-        rs = yield from select("%s where `%s`=?" % (cls.__select__, cls.__primary_key__), [pk], 1)
+        rs = yield from select("%s where `%s`=?" % (sql, cls.__primary_key__), [pk], 1, cache=cache)
         if len(rs) == 0:
             return None
         # **表示关键字参数,我当时还疑惑怎么用到了指针?知识交叉了- -
         # 注意,我们在select函数中,打开的是DictCursor,它会以dict的形式返回结果
-        return cls(**rs[0])
+        return cls._from_row(rs[0], deferred)
 
+    # 列投影: fields=("id", "name")只取出这些字段, defer=("content",)取出除这些字段以外的全部字段
+    # 列表页只需要标题与摘要,延迟加载正文这样的大字段,可以大大减少从数据库传输的数据量.
+    # 被延迟加载的字段不在实例中,访问它将抛出DeferredFieldError,需要时通过load或undefer取出
     @classmethod
     @asyncio.coroutine
     def findAll(cls, where=None, args=None, **kw):
-        sql = [cls.__select__]
-        # 我们定义的默认的select语句是通过主键查询的,并不包括where子句
-        # 因此若指定有where,需要在select语句中追加关键字
-        if where:
-            sql.append("where")
-            sql.append(where)
-        if args is None:
-            args = []
+        select_sql, deferred = cls._projection(kw.get("fields"), kw.get("defer"))
+        # 拷贝一份args,避免修改调用者传入的列表
+        args = list(args) if args else []
         orderBy = kw.get("orderBy", None)
-        # 解释同where, 此处orderBy通过关键字参数传入
-        if orderBy:
-            sql.append("order by")
-            sql.append(orderBy)
-        # 解释同where
+        # 键集分页(keyset pagination): after/before为(created_at, 主键)元组,表示从该记录之后/之前开始取
+        # 与limit offset不同,数据库不必扫描并丢弃offset条记录,翻到多深的页都一样快
+        # 结果总是按created_at desc, 主键desc排序
+        after = kw.get("after", None)
+        before = kw.get("before", None)
+        if after is not None or before is not None:
+            if "created_at" not in cls.__mappings__:
+                raise ValueError("Keyset pagination requires created_at field: %s" % cls.__name__)
+            created_at, pk = after if after is not None else before
+            # 取before之前的记录时,需要按升序取出紧挨着它的几条,再倒过来
+            op, order = ("<", "desc") if after is not None else (">", "asc")
+            keyset = "(`created_at` %s ? or (`created_at` = ? and `%s` %s ?))" % (op, cls.__primary_key__, op)
+            where = "(%s) and %s" % (where, keyset) if where else keyset
+            args.extend([created_at, created_at, pk])
+            orderBy = "`created_at` %s, `%s` %s" % (order, cls.__primary_key__, order)
+        # limit的值作为参数传入,语句中只有占位符,因此不同的页码共用同一条语句
         limit = kw.get("limit", None)
-        if limit is not None:
-            sql.append("limit")
-            if isinstance(limit, int):
-                sql.append("?")
-                args.append(limit)
-            elif isinstance(limit, tuple) and len(limit) == 2:
-                sql.append("?, ?")
-                args.extend(limit)
-            else:
-                raise ValueError("Invalid limit value: %s" % str(limit))
-        rs = yield from select(' '.join(sql), args) #没有指定size,因此会fetchall
-        return [cls(**r) for r in rs]
+        if limit is None:
+            placeholders = 0
+        elif isinstance(limit, int):
+            placeholders = 1
+            args.append(limit)
+        elif isinstance(limit, tuple) and len(limit) == 2 and after is None and before is None:
+            placeholders = 2
+            args.extend(limit)
+        else:
+            raise ValueError("Invalid limit value: %s" % str(limit))
+        # where与orderBy通过关键字参数传入
+        sql = _select_sql(select_sql, where, orderBy, placeholders)
+        rs = yield from select(sql, args, cache=kw.get("cache", True)) #没有指定size,因此会fetchall
+        if before is not None and after is None:
+            rs = list(reversed(rs))
+        # rows=True时返回紧凑的行对象而不是model实例,行对象中被延迟加载的字段为None
+        if kw.get("rows", False):
+            return [cls.__row__(**r) for r in rs]
+        return [cls._from_row(r, deferred) for r in rs]
+
+    # 取出实例中被延迟加载的字段, names为要取出的字段,默认为全部被延迟的字段
+    # 属性访问是同步的,无法在其中查询数据库,因此延迟加载的字段需要显式地取出:
+    #     blog = yield from Blog.find(id, defer="content")
+    #     yield from blog.load()
+    @asyncio.coroutine
+    def load(self, *names):
+        yield from self.undefer([self], *names)
+        return self
+
+    # 批量取出多个实例中被延迟加载的字段,只执行一条查询,避免逐个load
+    @classmethod
+    @asyncio.coroutine
+    def undefer(cls, objs, *names):
+        names = names or tuple(sorted(set(f for obj in objs for f in obj.__deferred__)))
+        objs = [obj for obj in objs if any(f in obj.__deferred__ for f in names)]
+        if not objs:
+            return objs
+        sql, _ = cls._projection(fields=names)
+        pks = [obj[cls.__primary_key__] for obj in objs]
+        rs = yield from select("%s where `%s` in (%s)" % (sql, cls.__primary_key__, create_args_string(len(pks))), pks)
+        rows = dict((r[cls.__primary_key__], r) for r in rs)
+        for obj in objs:
+            r = rows.get(obj[cls.__primary_key__])
+            if r is None:
+                continue
+            for f in names:
+                obj[f] = r[f]
+            object.__setattr__(obj, "__deferred__", tuple(f for f in obj.__deferred__ if f not in names))
+        return objs
 
     @classmethod
     @asyncio.coroutine
-    def findNumber(cls, selectField, where=None, args=None):
-        sql = ["select %s _num_ from `%s`" % (selectField, cls.__table__)]
-        if where:
-            sql.append("where")
-            sql.append(where)
-        rs = yield from select(' '.join(sql), args, 1)
+    def findNumber(cls, selectField, where=None, args=None, cache=True):
+        sql = _select_sql("select %s _num_ from `%s`" % (selectField, cls.__table__), where)
+        rs = yield from select(sql, args, 1, cache=cache)
         if len(rs) == 0:
             return None
         return rs[0]["_num_"]
 
+    # 流式查询,返回StreamResult,通过"async for"逐条取得model实例,例如:
+    #     async for comment in Comment.stream("blog_id=?", [blog_id], batch=500):
+    #         ...
+    @classmethod
+    def stream(cls, where=None, args=None, batch=100, **kw):
+        return StreamResult(cls, _select_sql(cls.__select__, where, kw.get("orderBy", None)), args, batch)
+
+    # 取得表的总行数,优先使用缓存的行数
+    # 缓存的行数最多比数据库旧_count_ttl秒(只在绕过Model直接修改数据库时才会有偏差)
+    @classmethod
+    @asyncio.coroutine
+    def findCount(cls):
+        'find number of rows in table, cached'
+        item = _row_counts.get(cls.__table__)
+        if item is not None and time.monotonic() - item[1] < _count_ttl:
+            return item[0]
+        num = yield from cls.findNumber("count(`%s`)" % cls.__primary_key__, cache=False)
+        _row_counts[cls.__table__] = [num, time.monotonic()]
+        return num
+
     @asyncio.coroutine
     def save(self):
+        self._check_deferred()
         # 我们在定义__insert__时,将主键放在了末尾.因为属性与值要一一对应,因此通过append的方式将主键加在最后
         args = list(map(self.getValueOrDefault, self.__fields__)) #使用getValueOrDefault方法,可以调用time.time这样的函数来获取值
         args.append(self.getValueOrDefault(self.__primary_key__))
         rows = yield from execute(self.__insert__, args)
         if rows != 1: #插入一条记录,结果影响的条数不等于1,肯定出错了
             logging.warn("failed to insert recored: affected rows: %s" % rows)
+        else:
+            _changed(self, "save", 1)
 
 
+    # 批量插入,objs为同一model的实例列表
+    # 每chunk_size条记录合并为一条多行insert语句,所有记录在同一个事务中插入
+    # 这样插入N条记录只需N/chunk_size次数据库往返,以及一次提交
+    @classmethod
+    @asyncio.coroutine
+    def save_many(cls, objs, chunk_size=500):
+        objs = list(objs)
+        if not objs:
+            return 0
+        args_list = []
+        for obj in objs:
+            obj._check_deferred()
+            args = list(map(obj.getValueOrDefault, cls.__fields__))
+            args.append(obj.getValueOrDefault(cls.__primary_key__))
+            args_list.append(args)
+        rows = yield from execute_many(cls.__insert__, args_list, chunk_size)
+        if rows != len(objs):
+            logging.warn("failed to insert records: affected rows: %s, expected %s" % (rows, len(objs)))
+        # 行数缓存按实际插入的行数调整一次,监听器仍对每个对象收到通知
+        _changed(objs[0], "save", rows)
+        for obj in objs[1:]:
+            _changed(obj, "save")
+        return rows
+
+    # 批量更新,objs为同一model的实例列表
+    # 所有记录在同一个事务中更新,只提交一次
+    @classmethod
+    @asyncio.coroutine
+    def update_many(cls, objs, chunk_size=500):
+        objs = list(objs)
+        if not objs:
+            return 0
+        args_list = []
+        for obj in objs:
+            obj._check_deferred()
+            args = list(map(obj.getValue, cls.__fields__))
+            args.append(obj.getValue(cls.__primary_key__))
+            args_list.append(args)
+        rows = yield from execute_many(cls.__update__, args_list, chunk_size)
+        for obj in objs:
+            _changed(obj, "update")
+        return rows
+
+    # 按条件批量删除记录,返回删除的行数
+    # 监听器收到的model参数为model类本身,而非实例
+    @classmethod
+    @asyncio.coroutine
+    def removeAll(cls, where, args=None):
+        rows = yield from execute("delete from `%s` where %s" % (cls.__table__, where), args or [])
+        if rows:
+            _changed(cls, "remove", -rows)
+        return rows
+
     @asyncio.coroutine
     def update(self):
+        self._check_deferred()
         # 像time.time,next_id之类的函数在插入的时候已经调用过了,没有其他需要实时更新的值,因此调用getValue
         args = list(map(self.getValue, self.__fields__))
         args.append(self.getValue(self.__primary_key__))
         rows = yield from execute(self.__update__, args)
         if rows != 1:
             logging.warn("failed to update by primary key: affected rows %s" % rows)
+        else:
+            _changed(self, "update")
+
+    # 实例中还有未取出的字段时不能写回数据库,否则这些字段将被写为默认值或NULL
+    def _check_deferred(self):
+        if self.__deferred__:
+            raise DeferredFieldError("Cannot write %s with deferred fields %s, load them first" % (self.__class__.__name__, ", ".join(self.__deferred__)))
 
     @asyncio.coroutine
     def remove(self):
@@ -327,3 +1342,5 @@ class Model(dict, metaclass=ModelMetaclass):
         rows = yield from execute(self.__delete__, args) # 调用默认的delete语句
         if rows != 1:
             logging.warn("failed to remove by primary key: affected rows %s" % rows)
+        else:
+            _changed(self, "remove", -1)
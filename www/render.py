@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''markdown渲染
+markdown转html是纯CPU的正则运算,较大的博客直接在协程中渲染会阻塞事件循环,拖慢其他所有连接.
+因此超过一定大小的内容将交给进程池渲染,协程只需等待结果;较小的内容仍直接渲染,省去进程间通信的开销.'''
+
+__author__ = 'Engine'
+
+import asyncio
+import logging
+from concurrent.futures import ProcessPoolExecutor
+
+import markdown2
+
+_executor = None          # 渲染用的进程池,为None时全部在事件循环中直接渲染
+_inline_threshold = 0     # 小于该长度(字符数)的内容直接渲染
+
+# 创建渲染进程池
+# workers - 进程数,为0时不创建进程池
+# inline_threshold - 小于该长度的内容不交给进程池
+def init_executor(workers=0, inline_threshold=32 * 1024):
+    global _executor, _inline_threshold
+    shutdown_executor()
+    _inline_threshold = inline_threshold
+    if workers > 0:
+        logging.info("create markdown render pool: %s workers, inline threshold %s" % (workers, inline_threshold))
+        _executor = ProcessPoolExecutor(max_workers=workers)
+
+# 关闭渲染进程池
+def shutdown_executor(wait=True):
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=wait)
+        _executor = None
+
+# 在子进程中执行的渲染函数
+# 直接使用Markdown.convert,不经过子进程中(fork而来)的那份缓存
+def _convert(text):
+    return markdown2.Markdown().convert(text)
+
+# 将markdown渲染为html,可在协程中通过yield from等待结果
+# 先查markdown2的渲染缓存,未命中且内容较大时才交给进程池
+@asyncio.coroutine
+def markdown(text, loop=None):
+    if _executor is None or len(text) < _inline_threshold:
+        return markdown2.markdown(text)
+    cache = markdown2.get_convert_cache()
+    if cache is not None:
+        key = markdown2.markdown_cache_key(text)
+        html = cache.get(key)
+        if html is not None:
+            return html
+    loop = loop or asyncio.get_event_loop()
+    html = yield from loop.run_in_executor(_executor, _convert, text)
+    if cache is not None:
+        cache.set(key, html)
+    return html
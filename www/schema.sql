@@ -27,7 +27,10 @@ create table blogs(
     `name` varchar(50) not null,
     `summary` varchar(50) not null,
     `content` mediumtext not null,
+    `html_content` mediumtext,
+    `content_hash` varchar(40),
     `created_at` real  not null,
+    `updated_at` real  not null,
     key `idx_created_at` (`created_at`),
     primary key (`id`)
 ) engine=innodb default charset=utf8;
@@ -41,5 +44,6 @@ create table comments(
     `content` mediumtext not null,
     `created_at` real  not null,
     key `idx_created_at` (`created_at`),
+    key `idx_blog_id_created_at` (`blog_id`, `created_at`),
     primary key (`id`)
 ) engine=innodb default charset=utf8;
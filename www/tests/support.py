@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''测试的公共部分
+测试使用内嵌的sqlite后端(见backends.py),每个测试一个新的数据库文件与事件循环,无需MySQL.
+不使用内存数据库,因为测试中关闭连接池的最后一条连接时,内存数据库会随之销毁.
+用法: 在www目录下执行 python3 -m pytest tests'''
+
+__author__ = 'Engine'
+
+import os
+import sys
+import shutil
+import asyncio
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import orm
+from models import Blog, Comment
+
+# 构造测试用的博客与评论,只需给出测试关心的字段
+def make_blog(**kw):
+    fields = dict(user_id="u", user_name="n", user_image="i", name="b", summary="s", content="c")
+    fields.update(kw)
+    return Blog(**fields)
+
+def make_comment(blog_id, **kw):
+    fields = dict(blog_id=blog_id, user_id="u", user_name="n", user_image="i", content="c")
+    fields.update(kw)
+    return Comment(**fields)
+
+class OrmTestCase(unittest.TestCase):
+
+    # 传给orm.create_pool的参数,子类可以覆盖
+    pool_kw = {}
+    # 从库的个数,每个从库是一个独立的数据库文件,与主库之间没有复制
+    replicas = 0
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.tmpdir = tempfile.mkdtemp()
+        kw = dict(backend="sqlite", path=os.path.join(self.tmpdir, "test.db"), db="test", user="", password="", minsize=1, maxsize=2,
+                  replicas=[dict(path=os.path.join(self.tmpdir, "replica%s.db" % i)) for i in range(self.replicas)])
+        kw.update(self.pool_kw)
+        # 行数缓存是全局的,不能带到下一个测试的数据库
+        orm._row_counts.clear()
+        self.run_async(orm.create_pool(loop=self.loop, **kw))
+
+    def tearDown(self):
+        for pool in [self.pool] + list(orm._replicas):
+            pool.close()
+        # 取消测试留下的后台任务,如自适应模式调整连接池大小的任务
+        tasks = asyncio.all_tasks(self.loop)
+        for task in tasks:
+            task.cancel()
+        self.loop.run_until_complete(asyncio.gather(*tasks, asyncio.sleep(0), return_exceptions=True))
+        self.loop.close()
+        asyncio.set_event_loop(None)
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    # 主库的连接池
+    @property
+    def pool(self):
+        return vars(orm)["__pool"]
+
+    def run_async(self, coro):
+        return self.loop.run_until_complete(coro)
+
+# 通过http请求测试整个应用(app.make_app),包括全部中间件与路由
+class AppTestCase(OrmTestCase):
+
+    def setUp(self):
+        super().setUp()
+        from aiohttp.test_utils import TestClient, TestServer
+        import app
+        self.app = app
+        # 整页缓存是全局的,不能带到下一个测试
+        app._page_cache.clear()
+        # TestClient需要在事件循环中创建
+        async def start():
+            client = TestClient(TestServer(app.make_app()), auto_decompress=False)
+            await client.start_server()
+            return client
+        self.client = self.run_async(start())
+
+    def tearDown(self):
+        self.run_async(self.client.close())
+        super().tearDown()
+
+    # 发出请求,返回(响应, body)
+    def request(self, method, path, **kw):
+        async def run():
+            resp = await self.client.request(method, path, **kw)
+            return resp, await resp.read()
+        return self.run_async(run())
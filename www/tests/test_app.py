@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'应用(中间件与url处理函数)的测试'
+
+__author__ = 'Engine'
+
+import json
+
+import handlers
+
+from support import AppTestCase, make_blog, make_comment
+
+from models import Blog, User
+
+class AppTest(AppTestCase):
+
+    def test_json_handler(self):
+        blog = make_blog()
+        self.run_async(blog.save())
+        resp, body = self.request("GET", "/api/blogs/%s" % blog.id)
+        self.assertEqual(resp.status, 200)
+        self.assertEqual(json.loads(body.decode("utf-8"))["name"], "b")
+
+    def test_bad_request(self):
+        resp, body = self.request("POST", "/api/authenticate", data=b"x", headers={"Content-Type": "text/plain"})
+        self.assertEqual(resp.status, 400)
+        self.assertIn(b"Unsupported Content-Type", body)
+
+    def test_manage_redirects_to_signin(self):
+        resp, body = self.request("GET", "/manage/blogs", allow_redirects=False)
+        self.assertEqual(resp.status, 302)
+        self.assertEqual(resp.headers["Location"], "/signin")
+
+    def test_rendering_html_changes_etag(self):
+        blog = make_blog()
+        self.run_async(blog.save())
+        resp, body = self.request("GET", "/api/blogs/%s" % blog.id)
+        etag = resp.headers["ETag"]
+        resp, body = self.request("GET", "/api/blogs/%s" % blog.id, headers={"If-None-Match": etag})
+        self.assertEqual(resp.status, 304)
+        # 详情页渲染博客的html并写回数据库,博客的json随之改变
+        self.request("GET", "/blog/%s" % blog.id)
+        resp, body = self.request("GET", "/api/blogs/%s" % blog.id, headers={"If-None-Match": etag})
+        self.assertEqual(resp.status, 200)
+        self.assertIsNotNone(json.loads(body.decode("utf-8"))["html_content"])
+
+    def test_rendering_does_not_overwrite_concurrent_update(self):
+        blog = make_blog()
+        self.run_async(blog.save())
+        # 渲染期间博客被修改了标题与正文
+        stale = self.run_async(Blog.find(blog.id))
+        fresh = self.run_async(Blog.find(blog.id))
+        fresh.name, fresh.content = "b2", "c2"
+        self.run_async(fresh.update())
+        self.run_async(handlers.render_blog(stale))
+        self.assertFalse(self.run_async(handlers.save_rendered(stale)))
+        blog = self.run_async(Blog.find(blog.id))
+        self.assertEqual((blog.name, blog.content, blog.html_content), ("b2", "c2", None))
+        # 只修改了标题的,渲染结果照常写回,但不覆盖标题
+        stale = self.run_async(Blog.find(blog.id))
+        blog.name = "b3"
+        self.run_async(blog.update())
+        self.run_async(handlers.render_blog(stale))
+        self.assertTrue(self.run_async(handlers.save_rendered(stale)))
+        blog = self.run_async(Blog.find(blog.id))
+        self.assertEqual(blog.name, "b3")
+        self.assertEqual(blog.content_hash, handlers.content_digest("c2"))
+        # 已写回的不再重复写
+        self.assertFalse(self.run_async(handlers.save_rendered(stale)))
+
+    def test_page_etag_is_weak_and_follows_comments(self):
+        blog = make_blog()
+        self.run_async(blog.save())
+        resp, body = self.request("GET", "/blog/%s" % blog.id)
+        etag = resp.headers["ETag"]
+        # 页面含有相对时间,字节会变化,由版本生成的只能是弱ETag
+        self.assertTrue(etag.startswith('W/"'))
+        # 弱比较: 客户端去掉W/前缀同样匹配
+        resp, body = self.request("GET", "/blog/%s" % blog.id, headers={"If-None-Match": etag[2:]})
+        self.assertEqual(resp.status, 304)
+        comment = make_comment(blog.id)
+        self.run_async(comment.save())
+        resp, body = self.request("GET", "/blog/%s" % blog.id, headers={"If-None-Match": etag})
+        self.assertEqual(resp.status, 200)
+        self.assertNotEqual(resp.headers["ETag"], etag)
+
+    def test_etag_salt_is_stable(self):
+        # 同样的代码与模板(如同一次部署的另一个进程)得到同样的ETag
+        self.assertEqual(self.app.deploy_version(), self.app._etag_salt)
+
+    def test_encoded_slash_in_parameter(self):
+        blog = make_blog()
+        blog.id = "a/b"
+        self.run_async(blog.save())
+        resp, body = self.request("GET", "/api/blogs/a%2Fb")
+        self.assertEqual(resp.status, 200)
+        self.assertEqual(json.loads(body.decode("utf-8"))["id"], "a/b")
+
+    def test_stats_requires_admin(self):
+        resp, body = self.request("GET", "/api/stats", headers={"Accept-Encoding": "identity"})
+        self.assertEqual(json.loads(body.decode("utf-8"))["error"], "permission:forbidden")
+        admin = User(email="a@b.c", passwd="p", admin=True, name="a", image="i")
+        self.run_async(admin.save())
+        self.request("GET", "/")
+        cookie = "%s=%s" % (handlers.COOKIE_NAME, handlers.user2cookie(admin, 600))
+        resp, body = self.request("GET", "/api/stats", headers={"Cookie": cookie, "Accept-Encoding": "identity"})
+        stats = json.loads(body.decode("utf-8"))
+        self.assertEqual(set(stats), {"cache", "queries", "pool", "loader", "singleflight", "page_cache"})
+        self.assertGreaterEqual(stats["page_cache"]["misses"], 1)
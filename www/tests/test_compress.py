@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'响应压缩的测试'
+
+__author__ = 'Engine'
+
+import os
+import gzip
+import zlib
+import asyncio
+
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer, make_mocked_request
+
+from support import AppTestCase, make_blog
+
+import orm
+import coroweb
+
+class CompressTest(AppTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.blog = make_blog(content="hello " * 1000)
+        self.run_async(self.blog.save())
+        self.url = "/api/blogs/%s" % self.blog.id
+
+    def get(self, path, accept_encoding, **headers):
+        headers["Accept-Encoding"] = accept_encoding
+        return self.request("GET", path, headers=headers)
+
+    def test_coalesced_requests_negotiate_separately(self):
+        select = orm.select
+        async def slow_select(*args, **kw):
+            # 让三个请求同时处于执行中,由单飞合并
+            await asyncio.sleep(0.05)
+            return await select(*args, **kw)
+        stats = dict(self.app._flight_stats)
+        orm.select = slow_select
+        try:
+            async def run():
+                return await asyncio.gather(*[self.client.get(self.url, headers={"Accept-Encoding": ae}) for ae in ("gzip", "", "identity")])
+            responses = self.run_async(run())
+            bodies = [self.run_async(r.read()) for r in responses]
+        finally:
+            orm.select = select
+        self.assertEqual(self.app._flight_stats["flights"] - stats["flights"], 1)
+        self.assertEqual(self.app._flight_stats["coalesced"] - stats["coalesced"], 2)
+        gzipped, plain, identity = zip(responses, bodies)
+        self.assertEqual(gzipped[0].headers["Content-Encoding"], "gzip")
+        self.assertEqual(zlib.decompress(gzipped[1], 47), plain[1])
+        for resp, body in (plain, identity):
+            self.assertNotIn("Content-Encoding", resp.headers)
+            self.assertTrue(body.startswith(b"{"))
+
+    def test_not_modified_keeps_validator_and_vary(self):
+        resp, body = self.get(self.url, "gzip")
+        etag = resp.headers["ETag"]
+        self.assertTrue(etag.startswith("W/"))
+        resp, body = self.get(self.url, "gzip", **{"If-None-Match": etag})
+        self.assertEqual(resp.status, 304)
+        self.assertEqual(resp.headers["ETag"], etag)
+        self.assertIn("Accept-Encoding", resp.headers["Vary"])
+
+    def test_compressed_body_is_reused(self):
+        self.get(self.url, "gzip")
+        hits = self.app._compressed_cache.hits
+        resp, body = self.get(self.url, "gzip")
+        self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+        self.assertEqual(self.app._compressed_cache.hits - hits, 1)
+
+    def test_same_etag_different_body_is_recompressed(self):
+        # 由版本生成的ETag不变,页面中的相对时间却可能变化,压缩结果不能按ETag复用
+        bodies = [("1分钟前 " * 500).encode("utf-8"), ("2分钟前 " * 500).encode("utf-8")]
+        async def run(body):
+            async def handler(request):
+                return web.Response(body=body, content_type="text/html", headers={"ETag": '"v1"'})
+            request = make_mocked_request("GET", "/", headers={"Accept-Encoding": "gzip"})
+            return await self.app.compress_middleware(request, handler)
+        for body in bodies:
+            resp = self.run_async(run(body))
+            self.assertEqual(resp.headers["ETag"], 'W/"v1"')
+            self.assertEqual(zlib.decompress(resp.body, 47), body)
+
+class StaticTest(AppTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.css = b"body { color: red; }\n" * 100
+        with open(os.path.join(self.tmpdir, "site.css"), "wb") as f:
+            f.write(self.css)
+        with open(os.path.join(self.tmpdir, "site.css.gz"), "wb") as f:
+            f.write(gzip.compress(self.css))
+        async def start():
+            app = web.Application()
+            app.router.add_route("GET", "/static/{filename:.+}", coroweb.StaticHandler(self.tmpdir).__call__)
+            client = TestClient(TestServer(app), auto_decompress=False)
+            await client.start_server()
+            return client
+        self.static = self.run_async(start())
+
+    def tearDown(self):
+        self.run_async(self.static.close())
+        super().tearDown()
+
+    def get(self, accept_encoding):
+        async def run():
+            resp = await self.static.get("/static/site.css", headers={"Accept-Encoding": accept_encoding})
+            return resp, await resp.read()
+        return self.run_async(run())
+
+    def test_refused_encoding_serves_plain_file(self):
+        resp, body = self.get("gzip;q=0")
+        self.assertNotIn("Content-Encoding", resp.headers)
+        self.assertEqual(body, self.css)
+
+    def test_precompressed_file(self):
+        resp, body = self.get("gzip")
+        self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+        self.assertEqual(gzip.decompress(body), self.css)
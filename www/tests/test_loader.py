@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'主键批量加载器的测试'
+
+__author__ = 'Engine'
+
+import asyncio
+
+from support import OrmTestCase, make_blog
+
+import orm
+from models import Blog
+
+class LoaderTest(OrmTestCase):
+
+    # 加载器在第一次find时才创建,每个测试使用新的加载器,不依赖其他测试的执行顺序
+    def setUp(self):
+        super().setUp()
+        Blog.__loader__ = orm.PrimaryKeyLoader(Blog)
+
+    def tearDown(self):
+        Blog.__loader__ = None
+        super().tearDown()
+
+    def test_coalesce(self):
+        blogs = [make_blog(name=str(i)) for i in range(3)]
+        self.run_async(Blog.save_many(blogs))
+        queries = Blog.__loader__.queries
+        async def run():
+            return await asyncio.gather(*[Blog.find(b.id) for b in blogs + blogs])
+        found = self.run_async(run())
+        self.assertEqual([b.name for b in found], ["0", "1", "2"] * 2)
+        self.assertEqual(Blog.__loader__.queries - queries, 1)
+
+    def test_cancelled_fetch_cancels_waiters(self):
+        blocked = asyncio.Event()
+        async def hang(sql, args, size=None, cache=True):
+            blocked.set()
+            await asyncio.sleep(3600)
+        async def run():
+            finds = [asyncio.ensure_future(Blog.find(pk)) for pk in ("a", "b", "a")]
+            await blocked.wait()
+            fetch = [t for t in asyncio.all_tasks() if t.get_coro().__qualname__ == "PrimaryKeyLoader._fetch"]
+            self.assertEqual(len(fetch), 1)
+            fetch[0].cancel()
+            # 未修复时等待的find()永远不会结束
+            done, pending = await asyncio.wait(finds, timeout=5)
+            self.assertFalse(pending)
+            return [t.cancelled() for t in finds]
+        select, orm.select = orm.select, hang
+        try:
+            self.assertEqual(self.run_async(run()), [True] * 3)
+        finally:
+            orm.select = select
+        self.assertEqual(Blog.__loader__._inflight, {})
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'查询缓存与延迟加载的测试'
+
+__author__ = 'Engine'
+
+from support import OrmTestCase, make_blog
+
+import orm
+from models import Blog
+
+class QueryCacheTest(OrmTestCase):
+
+    pool_kw = dict(query_cache_bytes=1 << 20)
+
+    def names(self):
+        return [b.name for b in self.run_async(Blog.findAll(orderBy="name"))]
+
+    def test_cached_until_written(self):
+        blog = make_blog(name="a")
+        self.run_async(blog.save())
+        self.assertEqual(self.names(), ["a"])
+        hits = orm._query_cache.hits
+        self.assertEqual(self.names(), ["a"])
+        self.assertEqual(orm._query_cache.hits - hits, 1)
+        # save, update, remove之后都不再返回缓存的结果
+        self.run_async(make_blog(name="b").save())
+        self.assertEqual(self.names(), ["a", "b"])
+        blog.name = "c"
+        self.run_async(blog.update())
+        self.assertEqual(self.names(), ["b", "c"])
+        self.run_async(blog.remove())
+        self.assertEqual(self.names(), ["b"])
+
+    def test_write_in_transaction(self):
+        self.run_async(make_blog(name="a").save())
+        self.assertEqual(self.names(), ["a"])
+        async def run():
+            async with orm.transaction():
+                await make_blog(name="b").save()
+        self.run_async(run())
+        self.assertEqual(self.names(), ["a", "b"])
+
+class DeferTest(OrmTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.blog = make_blog(content="long content")
+        self.run_async(self.blog.save())
+
+    def test_deferred_field(self):
+        blog = self.run_async(Blog.find(self.blog.id, defer="content"))
+        self.assertEqual(blog.__deferred__, ("content",))
+        self.assertEqual(blog.name, "b")
+        with self.assertRaises(orm.DeferredFieldError):
+            blog.content
+        # 缺少的字段会被写成NULL,因此拒绝写回
+        with self.assertRaises(orm.DeferredFieldError):
+            self.run_async(blog.update())
+        with self.assertRaises(orm.DeferredFieldError):
+            self.run_async(blog.save())
+        self.run_async(blog.load())
+        self.assertEqual(blog.content, "long content")
+        blog.name = "b2"
+        self.run_async(blog.update())
+        self.assertEqual(self.run_async(Blog.find(self.blog.id)).content, "long content")
+
+    def test_fields_and_undefer(self):
+        self.run_async(make_blog(content="other").save())
+        blogs = self.run_async(Blog.findAll(fields=("name",), orderBy="content"))
+        self.assertTrue(all("content" in b.__deferred__ for b in blogs))
+        queries = sum(q.count for q, w in orm._query_stats.values())
+        self.run_async(Blog.undefer(blogs, "content"))
+        # 多个实例只执行一条查询
+        self.assertEqual(sum(q.count for q, w in orm._query_stats.values()) - queries, 1)
+        self.assertEqual([b.content for b in blogs], ["long content", "other"])
+        self.assertTrue(all("content" not in b.__deferred__ for b in blogs))
+        # 其余字段仍未取出
+        self.assertIn("summary", blogs[0].__deferred__)
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'整页缓存的测试'
+
+__author__ = 'Engine'
+
+import asyncio
+
+from aiohttp import web
+
+from support import AppTestCase, make_blog, make_comment
+
+class PageCacheTest(AppTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.blog = make_blog()
+        self.run_async(self.blog.save())
+        self.key = ("/blog/%s" % self.blog.id, "", True)
+
+    def test_write_during_render_is_not_cached(self):
+        comment = make_comment(self.blog.id)
+        async def render(request):
+            # 生成页面期间写入了评论,页面是写入之前的内容
+            await comment.save()
+            return web.Response(body=b"old")
+        async def quiet(request):
+            return web.Response(body=b"new")
+        self.run_async(self.app._fill_page(render, None, self.key, 30))
+        self.assertIsNone(self.app._page_cache.get(self.key))
+        self.run_async(self.app._fill_page(quiet, None, self.key, 30))
+        self.assertEqual(self.app._page_cache.get(self.key).body, b"new")
+
+    def test_refresh_ignores_client_conditional_headers(self):
+        # 第一次访问时渲染博客的html并写回数据库,写回渲染结果不清空整页缓存
+        resp, body = self.request("GET", "/blog/%s" % self.blog.id)
+        self.assertEqual(resp.headers["X-Cache"], "MISS")
+        page = self.app._page_cache.get(self.key)
+        self.assertIsNotNone(page)
+        page.stored -= 1000
+        # 客户端缓存仍有效,过期的页面以304返回,后台重新生成的页面仍要存入缓存
+        resp, body = self.request("GET", "/blog/%s" % self.blog.id, headers={"If-None-Match": resp.headers["ETag"]})
+        self.assertEqual(resp.status, 304)
+        async def refreshed():
+            while self.key in self.app._page_refreshing:
+                await asyncio.sleep(0.01)
+        self.run_async(asyncio.wait_for(refreshed(), 5))
+        fresh = self.app._page_cache.get(self.key)
+        self.assertIsNotNone(fresh)
+        self.assertIsNot(fresh, page)
+        self.assertEqual(fresh.body, page.body)
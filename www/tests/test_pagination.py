@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'游标分页的测试'
+
+__author__ = 'Engine'
+
+import json
+
+from support import AppTestCase, make_blog
+
+from models import Blog
+
+class CursorPaginationTest(AppTestCase):
+
+    def setUp(self):
+        super().setUp()
+        # 创建时间全部相同,只能靠主键区分先后,每页10条,共3页
+        self.run_async(Blog.save_many([make_blog(name=str(i), created_at=1000.0) for i in range(25)]))
+        ids = self.run_async(Blog.findAll(fields=("created_at",), orderBy="created_at desc, id desc"))
+        self.ids = [b.id for b in ids]
+
+    def page(self, **cursor):
+        query = "&".join("%s=%s" % item for item in cursor.items())
+        resp, body = self.request("GET", "/api/blogs?" + query, headers={"Accept-Encoding": "identity"})
+        r = json.loads(body.decode("utf-8"))
+        return r["page"], [b["id"] for b in r["blogs"]]
+
+    def test_forward_and_backward(self):
+        pages = []
+        page, ids = self.page(after="")
+        pages.append(ids)
+        while page["has_next"]:
+            page, ids = self.page(after=page["next_cursor"])
+            pages.append(ids)
+        self.assertEqual([len(ids) for ids in pages], [10, 10, 5])
+        # 不重复,不遗漏,顺序与按(created_at, id)降序排序相同
+        self.assertEqual(sum(pages, []), self.ids)
+        self.assertFalse(page["has_next"])
+        # 从最后一页往回翻,得到同样的各页
+        back = [ids]
+        while page["has_previous"]:
+            page, ids = self.page(before=page["previous_cursor"])
+            back.append(ids)
+        self.assertEqual(back, pages[::-1])
+        self.assertTrue(page["has_next"])
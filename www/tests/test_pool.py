@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'自适应连接池的测试'
+
+__author__ = 'Engine'
+
+import asyncio
+
+from support import OrmTestCase
+
+import orm
+
+class AdaptivePoolTest(OrmTestCase):
+
+    pool_kw = dict(minsize=1, maxsize=4, adaptive=True, adaptive_interval=0.01, adaptive_wait_ms=10)
+
+    # 等待cond()成立,最多timeout秒
+    async def until(self, cond, timeout=2):
+        deadline = self.loop.time() + timeout
+        while not cond():
+            self.assertLess(self.loop.time(), deadline)
+            await asyncio.sleep(0.01)
+
+    def test_resize_wakes_waiters(self):
+        async def run():
+            limit = orm._PoolLimit(1)
+            await limit.acquire()
+            waiter = asyncio.ensure_future(limit.acquire())
+            await asyncio.sleep(0)
+            self.assertFalse(waiter.done())
+            limit.resize(2)
+            await asyncio.wait_for(waiter, 1)
+            self.assertEqual(limit.used, 2)
+        self.run_async(run())
+
+    def test_shrink_and_grow(self):
+        async def run():
+            # 自适应模式从maxsize开始,而不是立即缩小到minsize
+            await asyncio.sleep(0)
+            self.assertEqual(orm.pool_stats()["maxsize"], 4)
+            ctxs = await asyncio.gather(*[orm._connect() for i in range(3)])
+            for ctx in ctxs:
+                ctx.release()
+            # 空闲时逐步缩小到minsize,并关闭多出的空闲连接
+            await self.until(lambda: orm.pool_stats()["maxsize"] == 1 and self.pool.size == 1)
+            # 有协程在等待时扩大,排队的协程随即取得连接
+            held = await orm._connect()
+            waiter = asyncio.ensure_future(orm._connect())
+            ctx = await asyncio.wait_for(waiter, 2)
+            self.assertGreater(orm.pool_stats()["maxsize"], 1)
+            ctx.release()
+            held.release()
+        self.run_async(run())
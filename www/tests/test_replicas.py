@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''读写分离的测试
+主库与两个从库是三个独立的sqlite数据库文件,它们之间没有复制:
+写入主库的数据在从库中查不到,由此可以判断一个查询在哪个库执行'''
+
+__author__ = 'Engine'
+
+import asyncio
+
+from support import OrmTestCase, make_blog
+
+import orm
+
+class ReplicaTest(OrmTestCase):
+
+    pool_kw = dict(read_your_writes=0.2)
+    replicas = 2
+
+    # 在一个新的Task中执行,相当于一个新的请求,有自己的contextvars
+    def in_request(self, coro):
+        return self.run_async(asyncio.ensure_future(coro))
+
+    # 按id查询博客,不使用查询缓存,返回找到的行数
+    async def count_blog(self, blog_id):
+        rs = await orm.select("select `id` from `blogs` where `id`=?", [blog_id], cache=False)
+        return len(rs)
+
+    def new_blog(self):
+        return make_blog()
+
+    def test_round_robin(self):
+        primary, replicas = self.pool, orm._replicas
+        picked = [orm._pick_pool(True) for i in range(4)]
+        self.assertEqual(set(picked), set(replicas))
+        self.assertNotEqual(picked[0], picked[1])
+        self.assertEqual(picked[0], picked[2])
+        self.assertIs(orm._pick_pool(False), primary)
+
+    def test_least_outstanding(self):
+        orm._read_policy = "least_outstanding"
+        async def run():
+            busy = await orm._connect(readonly=True)
+            try:
+                # 正在使用一条连接的从库不会被选中
+                for i in range(3):
+                    self.assertIsNot(orm._pick_pool(True), busy.pool)
+            finally:
+                busy.release()
+        self.in_request(run())
+
+    def test_write_goes_to_primary(self):
+        blog = self.new_blog()
+        self.in_request(blog.save())
+        async def on_pool(pool):
+            conn = await pool.acquire()
+            try:
+                cur = await conn.cursor(orm._backend.DictCursor)
+                await cur.execute("select count(*) as n from `blogs`")
+                rs = await cur.fetchall()
+                await cur.close()
+                return rs[0]["n"]
+            finally:
+                pool.release(conn)
+        self.assertEqual(self.run_async(on_pool(self.pool)), 1)
+        for replica in orm._replicas:
+            self.assertEqual(self.run_async(on_pool(replica)), 0)
+        # 未绑定会话的其他请求从从库读取
+        self.assertEqual(self.in_request(self.count_blog(blog.id)), 0)
+
+    def test_read_your_writes(self):
+        blog = self.new_blog()
+        async def write():
+            orm.bind_session("alice")
+            await blog.save()
+            # 同一请求写入之后的查询在主库执行
+            return await self.count_blog(blog.id)
+        async def read(session):
+            orm.bind_session(session)
+            return await self.count_blog(blog.id)
+        self.assertEqual(self.in_request(write()), 1)
+        # 同一会话的后续请求在时间窗口内仍在主库读取,其他会话则读从库
+        self.assertEqual(self.in_request(read("alice")), 1)
+        self.assertEqual(self.in_request(read("bob")), 0)
+        # 超过时间窗口之后回到从库
+        self.run_async(asyncio.sleep(0.3))
+        self.assertEqual(self.in_request(read("alice")), 0)
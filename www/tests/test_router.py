@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'路由树的测试'
+
+__author__ = 'Engine'
+
+import unittest
+
+import support
+from coroweb import RadixRouter
+
+class RadixRouterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.router = RadixRouter()
+        for path in ("/", "/api/blogs", "/api/blogs/new", "/api/blogs/{id}", "/api/blogs/{id}/comments",
+                     "/page/{n:int}", "/page/{name}", "/static/{filename:path}"):
+            self.router.add("GET", path, path)
+
+    def match(self, path):
+        routes, params = self.router.match(path)
+        return (None, None) if routes is None else (routes["GET"], params)
+
+    def test_static_and_params(self):
+        self.assertEqual(self.match("/"), ("/", {}))
+        self.assertEqual(self.match("/api/blogs/new"), ("/api/blogs/new", {}))
+        self.assertEqual(self.match("/api/blogs/42"), ("/api/blogs/{id}", {"id": "42"}))
+        self.assertEqual(self.match("/api/blogs/42/comments"), ("/api/blogs/{id}/comments", {"id": "42"}))
+        self.assertEqual(self.match("/api/blogs/42/other"), (None, None))
+
+    def test_converters_in_order(self):
+        self.assertEqual(self.match("/page/3"), ("/page/{n:int}", {"n": 3}))
+        self.assertEqual(self.match("/page/about"), ("/page/{name}", {"name": "about"}))
+
+    def test_tail(self):
+        self.assertEqual(self.match("/static/css/site.css"), ("/static/{filename:path}", {"filename": "css/site.css"}))
+
+    def test_static_wins_without_backtracking(self):
+        # 选定文字段之后不再回头尝试参数段
+        self.assertEqual(self.match("/api/blogs/new/comments"), (None, None))
+
+    def test_encoded_slash_stays_in_segment(self):
+        # 路径按未解码的形式分段,参数中的%2F不会把一段拆成两段
+        self.assertEqual(self.match("/api/blogs/a%2Fb"), ("/api/blogs/{id}", {"id": "a/b"}))
+        self.assertEqual(self.match("/api/blogs/a%2Fb/comments"), ("/api/blogs/{id}/comments", {"id": "a/b"}))
+        self.assertEqual(self.match("/api/blog%73/new"), ("/api/blogs/new", {}))
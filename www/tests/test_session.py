@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'会话缓存的测试'
+
+__author__ = 'Engine'
+
+from support import OrmTestCase
+
+import handlers
+from models import User
+
+class SessionCacheTest(OrmTestCase):
+
+    def setUp(self):
+        super().setUp()
+        # 会话缓存是全局的,不能带到下一个测试
+        handlers._session_cache.clear()
+        self.user = User(email="a@b.c", passwd="p", admin=False, name="a", image="i")
+        self.run_async(self.user.save())
+        self.cookie = handlers.user2cookie(self.user, 600)
+
+    def cookie2user(self, cookie=None):
+        return self.run_async(handlers.cookie2user(cookie or self.cookie))
+
+    def test_cached(self):
+        self.assertEqual(self.cookie2user().name, "a")
+        hits = handlers._session_cache.hits
+        self.assertEqual(self.cookie2user().name, "a")
+        self.assertEqual(handlers._session_cache.hits - hits, 1)
+
+    def test_update_invalidates(self):
+        self.cookie2user()
+        self.user.name = "b"
+        self.run_async(self.user.update())
+        self.assertEqual(self.cookie2user().name, "b")
+        # 修改密码之后,旧的cookie立即失效
+        self.user.passwd = "p2"
+        self.run_async(self.user.update())
+        self.assertIsNone(self.cookie2user())
+        self.assertEqual(self.cookie2user(handlers.user2cookie(self.user, 600)).name, "b")
+
+    def test_remove_invalidates(self):
+        self.cookie2user()
+        self.run_async(self.user.remove())
+        self.assertIsNone(self.cookie2user())
+        other = User(email="d@e.f", passwd="p", admin=False, name="d", image="i")
+        self.run_async(other.save())
+        self.cookie2user(handlers.user2cookie(other, 600))
+        # 批量删除无法知道删除了哪些用户,清空整个缓存
+        self.run_async(User.removeAll("`admin`=?", [False]))
+        self.assertIsNone(self.cookie2user(handlers.user2cookie(other, 600)))
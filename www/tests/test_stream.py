@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'流式查询的测试'
+
+__author__ = 'Engine'
+
+import gc
+import asyncio
+
+from support import OrmTestCase, make_comment
+
+import orm
+from models import Comment
+
+class StreamTest(OrmTestCase):
+
+    pool_kw = dict(maxsize=1)
+
+    def setUp(self):
+        super().setUp()
+        self.run_async(Comment.save_many([make_comment("b", content=str(i)) for i in range(10)]))
+
+    def test_stream_all(self):
+        async def run():
+            return [c.content async for c in Comment.stream(orderBy="created_at", batch=3)]
+        self.assertEqual(len(self.run_async(run())), 10)
+        self.assertEqual(orm.pool_stats()["in_use"], 0)
+
+    def test_early_break_releases_connection(self):
+        async def run():
+            async for c in Comment.stream(batch=3):
+                break
+            gc.collect()
+            # 连接池只有一条连接,未释放时下面的查询会一直等待
+            return (await asyncio.wait_for(Comment.findNumber("count(`id`)", cache=False), 5))
+        num = self.run_async(run())
+        self.assertEqual(num, 10)
+        self.assertEqual(orm.pool_stats()["in_use"], 0)
+
+    def test_async_with(self):
+        async def run():
+            async with Comment.stream(batch=3) as rs:
+                async for c in rs:
+                    break
+            return orm.pool_stats()["in_use"]
+        self.assertEqual(self.run_async(run()), 0)
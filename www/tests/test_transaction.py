@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'事务与批量写入的测试'
+
+__author__ = 'Engine'
+
+import asyncio
+
+from support import OrmTestCase, make_blog
+
+import orm
+from models import Blog
+
+class TransactionTest(OrmTestCase):
+
+    def new_blogs(self, n):
+        return [make_blog(name=str(i)) for i in range(n)]
+
+    def test_child_task_ignores_transaction(self):
+        async def child():
+            ctx = await orm._connect()
+            ctx.release()
+            return ctx.in_transaction
+        async def run():
+            async with orm.transaction():
+                self.assertTrue((await orm._connect()).in_transaction)
+                # 事务中创建的Task继承了contextvars,但不能与父Task同时使用事务的连接
+                self.assertFalse(await asyncio.ensure_future(child()))
+        self.run_async(run())
+        self.assertEqual(orm.pool_stats()["in_use"], 0)
+
+    def test_save_many_counts_affected_rows(self):
+        self.assertEqual(self.run_async(Blog.findCount()), 0)
+        execute_many = orm.execute_many
+        async def partial(sql, args_list, chunk_size):
+            # 模拟只插入了第一条记录
+            return await execute_many(sql, args_list[:1], chunk_size)
+        orm.execute_many = partial
+        try:
+            self.assertEqual(self.run_async(Blog.save_many(self.new_blogs(3))), 1)
+        finally:
+            orm.execute_many = execute_many
+        self.assertEqual(self.run_async(Blog.findCount()), 1)